@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+
+"""Measure the per-packet cost of decoding an EIGRP UPDATE.
+
+The packet is a full-size UPDATE carrying internal IPv4 routes, decoded the
+way ReliableTransportProtocol.datagramReceived does it: the RTP header is
+skipped and every TLV in the rest of the packet is built by a TLVFactory.
+
+To compare against an older version of the decoder, pass a git revision
+with -r. Its rtptlv.py is loaded straight from git and timed on the same
+packet. The working tree's lazy and columnar (TLVFactory.build_columns)
+decoders are timed as well.
+
+Usage: ./bench_decode.py [-r REVISION] [-n PACKETS] [-t ROUTES]
+"""
+
+import os
+import sys
+import imp
+import time
+import inspect
+import optparse
+import subprocess
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.append(ROOT)
+
+import rtptlv
+
+# Length of the RTP header in front of the TLVs. rtp isn't imported here
+# because it installs a reactor.
+RTP_HDR_LEN = 20
+
+DEFAULT_ROUTES  = 50
+DEFAULT_PACKETS = 20000
+
+
+def make_packet(routes):
+    """Return an UPDATE with the given number of internal routes. The RTP
+    header is left zeroed since only the TLVs are decoded."""
+    tlvs = list()
+    for n in xrange(routes):
+        dest = "10.{}.{}.0".format(n >> 8 & 0xff, n & 0xff)
+        tlvs.append(rtptlv.TLVInternal4("0.0.0.0", 256000, 25600, 1500, 1, 255,
+                                        1, 0, 0, 24, dest))
+    return "\x00" * RTP_HDR_LEN + "".join([t.pack() for t in tlvs])
+
+
+def load_revision(rev):
+    """Return the rtptlv module as it was at the given git revision."""
+    src = subprocess.check_output(["git", "show", rev + ":rtptlv.py"],
+                                  cwd=ROOT)
+    mod = imp.new_module("rtptlv_" + rev)
+    exec src in mod.__dict__
+    # Python 2 clears a module's globals when the module object goes away,
+    # so keep it registered.
+    sys.modules[mod.__name__] = mod
+    return mod
+
+
+def make_decoder(mod, **kwargs):
+    """Return a function that decodes a whole packet with the given
+    version of rtptlv. kwargs are passed to its TLVFactory."""
+    factory = mod.TLVFactory([mod.TLVInternal4], **kwargs)
+    if "offset" in inspect.getargspec(factory.build_all).args:
+        def decode(data):
+            return factory.build_all(data, RTP_HDR_LEN)
+    else:
+        # Older decoders need the payload sliced off first.
+        def decode(data):
+            return factory.build_all(data[RTP_HDR_LEN:])
+    return decode
+
+
+def make_column_decoder(mod):
+    """Return a function that decodes a whole packet into columns. Returns
+    the Internal4Columns, which has one entry per route."""
+    factory = mod.TLVFactory([mod.TLVInternal4])
+    def decode(data):
+        return factory.build_columns(data, RTP_HDR_LEN)[0]
+    return decode
+
+
+def bench(decode, data, packets):
+    """Return the average time in microseconds to decode one packet."""
+    ntlvs = len(decode(data))
+    start = time.time()
+    for i in xrange(packets):
+        decode(data)
+    elapsed = time.time() - start
+    return elapsed / packets * 1e6, ntlvs
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.rstrip())
+    parser.add_option("-r", "--revision", help="Also time rtptlv.py from "
+                      "this git revision.")
+    parser.add_option("-n", "--packets", type="int", default=DEFAULT_PACKETS,
+                      help="Number of packets to decode. Default: "
+                      "%default")
+    parser.add_option("-t", "--routes", type="int", default=DEFAULT_ROUTES,
+                      help="Number of routes in the UPDATE. Default: "
+                      "%default")
+    options, args = parser.parse_args(argv[1:])
+
+    data = make_packet(options.routes)
+    decoders = [("working tree", make_decoder(rtptlv)),
+                ("lazy", make_decoder(rtptlv, lazy=True)),
+                ("columns", make_column_decoder(rtptlv))]
+    if options.revision:
+        decoders.insert(0, (options.revision,
+                            make_decoder(load_revision(options.revision))))
+
+    print("{}-byte UPDATE with {} routes, {} packets".format(len(data),
+                                                          options.routes,
+                                                          options.packets))
+    print("{:>14} {:>16} {:>12}".format("rtptlv", "us per packet",
+                                        "us per TLV"))
+    results = list()
+    for name, decode in decoders:
+        usec, ntlvs = bench(decode, data, options.packets)
+        results.append(usec)
+        print("{:>14} {:>16.1f} {:>12.2f}".format(name, usec, usec / ntlvs))
+    if options.revision:
+        print("Speedup over {}: {:.2f}x".format(options.revision,
+                                               results[0] / results[1]))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""Measure the memory and transition cost of the DUAL FSM per prefix.
+
+A topology table is filled with the given number of prefixes, and the
+memory it takes is reported per prefix. Every entry is then taken through
+the Passive -> Active1 -> Passive cycle (IE4, IE8, IE15) to time state
+transitions, and through a REPLY in Passive to time dispatching to the
+state handlers.
+
+If fysom is installed, the per-prefix Fysom machines that the FSM used to
+be built from are measured the same way for comparison.
+
+Memory is measured with tracemalloc where it is available, and from the
+process's resident set size otherwise.
+
+Usage: ./bench_dual.py [PREFIXES ...]
+       (default: 10000 100000 1000000)
+"""
+
+import gc
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             ".."))
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    from fysom import Fysom
+except ImportError:
+    Fysom = None
+
+# dualfsm has to be imported before topology.
+import dualfsm
+from topology import TopologyTable
+
+CYCLE = (dualfsm.IE4, dualfsm.IE8, dualfsm.IE15)
+
+
+def get_kvalues():
+    return 1, 0, 1, 0, 0
+
+
+def make_prefixes(count):
+    """Return count distinct /24 prefixes."""
+    return [ (n << 8, 24) for n in xrange(count) ]
+
+
+class MemoryMeter(object):
+    """Reports the memory allocated between start() and stop()."""
+
+    def start(self):
+        gc.collect()
+        if tracemalloc:
+            tracemalloc.start()
+        else:
+            self._start = self._rss()
+
+    def stop(self):
+        """Return the number of bytes allocated since start()."""
+        gc.collect()
+        if tracemalloc:
+            used = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            return used
+        return self._rss() - self._start
+
+    @staticmethod
+    def _rss():
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+def bench_table(prefixes):
+    """Return (table, bytes, transitions per second, dispatches per second)
+    for a topology table using the shared FSM."""
+    meter = MemoryMeter()
+    meter.start()
+    table = TopologyTable(get_kvalues)
+    for prefix in prefixes:
+        table.update_prefix(prefix)
+    used = meter.stop()
+
+    fsm = dualfsm.DUAL_FSM
+    entries = table.values()
+    start = time.time()
+    for t_entry in entries:
+        for event in CYCLE:
+            fsm.transition(t_entry, event)
+    transition_rate = len(entries) * len(CYCLE) / (time.time() - start)
+
+    start = time.time()
+    for t_entry in entries:
+        fsm.handle_reply(None, None, t_entry)
+    dispatch_rate = len(entries) / (time.time() - start)
+    return table, used, transition_rate, dispatch_rate
+
+
+def bench_fysom(count):
+    """Return (bytes, transitions per second) for one Fysom machine per
+    prefix, as DUAL used to be implemented."""
+    events = [ {"name": "IE{}".format(event),
+                "src": dualfsm.STATE_NAMES[src],
+                "dst": dualfsm.STATE_NAMES[dst]}
+               for event, src, dst in dualfsm.DUAL_EVENTS ]
+    meter = MemoryMeter()
+    meter.start()
+    machines = [ Fysom({"initial": "Passive", "events": events})
+                 for i in xrange(count) ]
+    used = meter.stop()
+
+    names = [ "IE{}".format(event) for event in CYCLE ]
+    start = time.time()
+    for fsm in machines:
+        for name in names:
+            getattr(fsm, name)()
+    rate = count * len(CYCLE) / (time.time() - start)
+    return used, rate
+
+
+def main(argv):
+    try:
+        counts = [int(arg) for arg in argv[1:]] or [10000, 100000, 1000000]
+    except ValueError:
+        sys.stderr.write(__doc__)
+        return 1
+
+    print("Memory measured with {}".format("tracemalloc" if tracemalloc
+                                           else "RSS"))
+    print("{:>10} {:>18} {:>16} {:>16} {:>16}".format("Prefixes",
+                                                      "Table bytes/prefix",
+                                                      "Transitions/s",
+                                                      "Dispatches/s",
+                                                      "Fysom bytes/FSM"))
+    for count in counts:
+        prefixes = make_prefixes(count)
+        table, used, transition_rate, dispatch_rate = bench_table(prefixes)
+        del table
+        if Fysom:
+            fysom_used, fysom_rate = bench_fysom(count)
+            fysom = "{:>16.0f}".format(float(fysom_used) / count)
+        else:
+            fysom = "{:>16}".format("-")
+        print("{:>10} {:>18.0f} {:>16.0f} {:>16.0f} {}".format(count,
+                                                float(used) / count,
+                                                transition_rate,
+                                                dispatch_rate,
+                                                fysom))
+        if Fysom:
+            print("{:>10} Fysom transitions/s: {:.0f}".format("",
+                                                              fysom_rate))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
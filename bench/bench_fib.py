@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+
+"""Compare writing route changes one at a time with fibwriter.FibWriter.
+
+A convergence event is simulated by changing the route to every prefix a
+few times, as happens when updates for the same prefixes arrive from
+several neighbors. The changes are written:
+
+- one at a time: a netlink request and acknowledgement per change, which
+  is what LinuxSystem.modify_route does.
+- FibWriter: changes are queued and coalesced, and written in batches of
+  up to the given size.
+
+By default routes are written to an rtnetlink.FakeKernel. With -k they
+are written to the given table in the real kernel (this needs root), and
+the "ip -batch" fallback is timed as well. The table is emptied of the
+benchmark's routes afterwards.
+
+Usage: ./bench_fib.py [-r ROUTES] [-c CHANGES] [-b BATCH] [-k TABLE -g GATEWAY]
+"""
+
+import os
+import sys
+import time
+import optparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             ".."))
+
+import ipv4
+import rtnetlink
+import fibwriter
+import sysiface
+from bench_dual import make_prefixes
+
+DEFAULT_ROUTES  = 20000
+DEFAULT_CHANGES = 3
+DEFAULT_TABLE   = 52
+
+# Routes in a full-size UPDATE.
+PACKET_ROUTES = 50
+
+
+class Clock(object):
+    """Never fires, so FibWriter only writes when the queue fills or is
+    flushed."""
+    def seconds(self):
+        return time.time()
+
+    def callLater(self, delay, func, *args, **kwargs):
+        return None
+
+
+class BatchSystem(object):
+    """The part of sysiface.LinuxSystem FibWriter uses, without reading the
+    interfaces or installing a routing rule."""
+    def __init__(self, writer):
+        self.apply_routes = writer.apply
+
+
+def make_changes(routes, changes, gateway):
+    """Return (net, plen, metric, nexthop) changes, changing every prefix
+    the given number of times. The prefixes are changed in groups the size
+    of an UPDATE packet, as if each group was received from every neighbor
+    in turn. The last change to each prefix is the one that should be left
+    in the table."""
+    prefixes = list(make_prefixes(routes))
+    ops = list()
+    for start in xrange(0, routes, PACKET_ROUTES):
+        for n in xrange(changes):
+            for prefix in prefixes[start:start + PACKET_ROUTES]:
+                ops.append(prefix + (100 + n, gateway))
+    return ops
+
+
+def make_writer(options, ip_batch=False):
+    if options.kernel:
+        if ip_batch:
+            return sysiface.IpBatchRouteWriter(sysiface.LinuxSystem.IP_CMD,
+                                               options.kernel)
+        return rtnetlink.RouteWriter(options.kernel)
+    return rtnetlink.RouteWriter(DEFAULT_TABLE, rtnetlink.FakeKernel())
+
+
+def clear(writer, ops):
+    writer.apply([ (net, plen, None, None)
+                   for net, plen in set([op[:2] for op in ops]) ])
+
+
+def one_at_a_time(writer, ops):
+    for net, plen, metric, nexthop in ops:
+        writer.replace_route(net, plen, metric, nexthop)
+
+
+def batched(writer, ops, batch_size):
+    fib = fibwriter.FibWriter(BatchSystem(writer), Clock(), batch_size)
+    for net, plen, metric, nexthop in ops:
+        fib.modify_route(net, plen, metric, nexthop)
+    fib.flush()
+    return fib.stats()
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.rstrip())
+    parser.add_option("-r", "--routes", type="int", default=DEFAULT_ROUTES,
+                      help="Number of prefixes. Default: %default")
+    parser.add_option("-c", "--changes", type="int",
+                      default=DEFAULT_CHANGES, help="Changes to each "
+                      "prefix. Default: %default")
+    parser.add_option("-b", "--batch", type="int",
+                      default=fibwriter.FibWriter.DEFAULT_BATCH_SIZE,
+                      help="FibWriter batch size. Default: %default")
+    parser.add_option("-k", "--kernel", type="int", help="Write routes to "
+                      "this table in the kernel instead of a FakeKernel.")
+    parser.add_option("-g", "--gateway", default="127.0.0.1",
+                      help="Nexthop for the routes. With -k it has to be "
+                      "reachable. Default: %default")
+    options, args = parser.parse_args(argv[1:])
+
+    ops = make_changes(options.routes, options.changes,
+                       ipv4.aton(options.gateway))
+    print("{} prefixes, {} changes each, batches of up to "
+          "{}".format(options.routes, options.changes, options.batch))
+    print("{:>16} {:>10} {:>14}".format("writer", "seconds", "changes/s"))
+
+    runs = [("one at a time", make_writer(options),
+             lambda w: one_at_a_time(w, ops)),
+            ("FibWriter", make_writer(options),
+             lambda w: batched(w, ops, options.batch))]
+    if options.kernel:
+        runs.append(("FibWriter ip", make_writer(options, ip_batch=True),
+                     lambda w: batched(w, ops, options.batch)))
+
+    for name, writer, run in runs:
+        start = time.time()
+        stats = run(writer)
+        elapsed = time.time() - start
+        print("{:>16} {:>10.2f} {:>14.0f}".format(name, elapsed,
+                                                   len(ops) / elapsed))
+        if stats:
+            print("{:>16} {} batches, {} written, {} coalesced, "
+                  "{:.1f} ms max batch".format("", stats["batches"],
+                                              stats["ops"],
+                                              stats["coalesced"],
+                                              stats["max_batch_latency"] *
+                                              1000))
+        clear(writer, ops)
+        writer.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
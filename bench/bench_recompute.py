@@ -0,0 +1,151 @@
+#!/usr/bin/env python
+
+"""Compare recomputing the whole topology table one neighbor at a time with
+bulkmetric.BulkMetrics.
+
+The table is filled with the given number of prefixes, each reported by
+the same neighbors, which are spread over two interfaces. The delay of the
+first interface is then raised, which changes the successor of some of the
+prefixes, and the table is recomputed:
+
+- per object: update_full_distance and the composite metrics on every
+  TopologyNeighborInfo, then a new successor and feasible successors
+  chosen for every prefix.
+- BulkMetrics: load a snapshot of the table, then recompute it. This uses
+  NumPy if it is installed, and is also timed with its array.array
+  fallback.
+
+Usage: ./bench_recompute.py [-r ROUTES] [-n NEIGHBORS]
+"""
+
+import os
+import sys
+import time
+import optparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             ".."))
+
+from bench_dual import make_prefixes
+from bench_topology_memory import Interface, Neighbor
+
+# dualfsm has to be imported before topology.
+import dualfsm
+import rtptlv
+import bulkmetric
+from topology import TopologyTable, TopologyNeighborInfo
+
+DEFAULT_ROUTES    = 100000
+DEFAULT_NEIGHBORS = 8
+
+DELAY_INCREASE = 5000
+
+
+def get_kvalues():
+    return 1, 0, 1, 0, 0
+
+
+def make_table(routes, neighbors):
+    """Return a topology table and its interfaces. Each prefix's successor
+    is the neighbor with the lowest full distance."""
+    ifaces = [ Interface(), Interface() ]
+    neighbors = [ Neighbor(ifaces[n % 2]) for n in xrange(neighbors) ]
+    table = TopologyTable(get_kvalues)
+    for n, prefix in enumerate(make_prefixes(routes)):
+        t_entry = table.update_prefix(prefix)
+        for i, neighbor in enumerate(neighbors):
+            # Vary the delays so that which neighbor is best differs between
+            # prefixes, and the increase on the first interface changes some
+            # of them.
+            dly = 1000 + (n * 7 + i * 1237) % (DELAY_INCREASE * 2)
+            metric = rtptlv.ValueClassicMetric(dly, 25600, 1500, 1, 255, 1,
+                                               0, 0)
+            t_entry.add_neighbor(TopologyNeighborInfo(neighbor, metric,
+                                                      get_kvalues))
+        t_entry.successor = min(t_entry.neighbors.itervalues(),
+                                key=TopologyNeighborInfo.full_metric)
+    return table, ifaces
+
+
+def recompute_objects(table):
+    """Recompute the table one neighbor at a time, and return the list of
+    prefixes whose successor changed."""
+    rtptlv.ValueClassicMetric.new_kvalue_generation()
+    changed = list()
+    for prefix, t_entry in table.iteritems():
+        best = None
+        for n_info in t_entry.neighbors.itervalues():
+            n_info.update_full_distance()
+            if best is None or n_info.full_metric() < best.full_metric():
+                best = n_info
+        if best.full_metric() == t_entry.successor.full_metric():
+            best = t_entry.successor
+        feasible_distance = best.full_metric()
+        feasible_successors = [ n_info for n_info in
+                                t_entry.neighbors.itervalues()
+                                if n_info is not best and
+                                n_info.reported_metric() < feasible_distance ]
+        if best is not t_entry.successor:
+            changed.append(prefix)
+    return changed
+
+
+def recompute_bulk(table, use_numpy):
+    """Return (prefixes whose successor changed, load time, recompute
+    time)."""
+    bulk = bulkmetric.BulkMetrics(get_kvalues, use_numpy)
+    start = time.time()
+    bulk.load(table)
+    loaded = time.time()
+    changes = bulk.recompute()
+    done = time.time()
+    return [ prefix for prefix, t_entry, n_info in changes ], \
+           loaded - start, done - loaded
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.rstrip())
+    parser.add_option("-r", "--routes", type="int", default=DEFAULT_ROUTES,
+                      help="Number of prefixes in the table. Default: "
+                      "%default")
+    parser.add_option("-n", "--neighbors", type="int",
+                      default=DEFAULT_NEIGHBORS,
+                      help="Number of neighbors reporting each prefix. "
+                      "Default: %default")
+    options, args = parser.parse_args(argv[1:])
+
+    table, ifaces = make_table(options.routes, options.neighbors)
+    phy_iface = ifaces[0].phy_iface
+    phy_iface.get_delay = lambda: 10 + DELAY_INCREASE
+
+    runs = [("array", False)]
+    if bulkmetric.numpy is not None:
+        runs.append(("numpy", True))
+    results = list()
+    for name, use_numpy in runs:
+        results.append((name,) + recompute_bulk(table, use_numpy))
+
+    start = time.time()
+    expected = recompute_objects(table)
+    base = time.time() - start
+
+    print("{} routes x {} neighbors, {} successors changed".format(
+          options.routes, options.neighbors, len(expected)))
+    print("{:>12} {:>10} {:>13} {:>10} {:>9}".format("", "Load (s)",
+                                                     "Recompute (s)",
+                                                     "Total (s)", "Speedup"))
+    print("{:>12} {:>10} {:>13.3f} {:>10.3f} {:>8.1f}x".format("per object",
+                                                              "-", base,
+                                                              base, 1))
+    for name, changed, load, recompute in results:
+        if sorted(changed) != sorted(expected):
+            print("Warning: {} found {} changed successors".format(
+                  name, len(changed)))
+        print("{:>12} {:>10.3f} {:>13.3f} {:>10.3f} {:>8.1f}x".format(name,
+                                                 load, recompute,
+                                                 load + recompute,
+                                                 base / (load + recompute)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
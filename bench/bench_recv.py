@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+
+"""Measure packets per second received from a raw IP socket.
+
+Packets are sent to a raw socket on 127.0.0.1 in bursts, and each burst is
+read back the ways IPTransport can read it:
+
+- recvfrom: one system call per packet, as without sockmsg.
+- recvmsg: one call per packet, with the input interface from
+  IP_PKTINFO, as with pktinfo=True.
+- recvmmsg: up to the batch size per call, with the IP headers checked in
+  the buffer pool, as with batchSize > 1.
+
+Only receiving is timed. Each packet's IP header is checked and its
+payload copied out, which is what IPTransport does before passing it to
+the protocol. Raw sockets need root.
+
+Usage: ./bench_recv.py [-p PACKETS] [-s SIZE] [-b BATCH] [-n BURST] [-P PROTO]
+"""
+
+import os
+import sys
+import time
+import errno
+import socket
+import struct
+import optparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             ".."))
+
+import sockmsg
+
+DEFAULT_PACKETS = 200000
+DEFAULT_SIZE    = 500
+DEFAULT_BATCH   = 32
+DEFAULT_BURST   = 256
+# Reserved for experimentation (RFC 3692), so a running EIGRP process
+# doesn't see the packets.
+DEFAULT_PROTO   = 253
+
+# from asm-generic/socket.h. Lets root set a receive buffer larger than
+# net.core.rmem_max, so bursts aren't dropped.
+SO_RCVBUFFORCE = 33
+RCVBUF = 8 << 20
+
+
+def header_length(data, offset, length):
+    """The checks IPTransport makes on each packet's IP header. Returns the
+    header's length or None."""
+    iphdrlen = (ord(data[offset]) & 0x0f) << 2
+    if iphdrlen < 20 or length <= iphdrlen:
+        return None
+    if struct.unpack_from(">H", data, offset + 2)[0] != length:
+        return None
+    return iphdrlen
+
+
+def read_recvfrom(sock, size):
+    """Read the packets waiting on sock. Returns (packets, calls)."""
+    packets = calls = 0
+    while True:
+        calls += 1
+        try:
+            data, addr = sock.recvfrom(size)
+        except socket.error as e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+            return packets, calls
+        iphdrlen = header_length(data, 0, len(data))
+        if iphdrlen is not None:
+            data[iphdrlen:]
+            packets += 1
+
+
+def read_recvmsg(receiver):
+    packets = calls = 0
+    while True:
+        calls += 1
+        try:
+            data, addr, ifindex = receiver.recv()
+        except socket.error as e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+            return packets, calls
+        iphdrlen = header_length(data, 0, len(data))
+        if iphdrlen is not None:
+            data[iphdrlen:]
+            packets += 1
+
+
+def read_recvmmsg(receiver):
+    packets = calls = 0
+    buf = receiver.buffer
+    while True:
+        calls += 1
+        try:
+            batch = receiver.recv()
+        except socket.error as e:
+            if e.args[0] != errno.EAGAIN:
+                raise
+            return packets, calls
+        for offset, length, addr, ifindex in batch:
+            iphdrlen = header_length(buf, offset, length)
+            if iphdrlen is not None:
+                buf[offset + iphdrlen:offset + length]
+                packets += 1
+        if len(batch) < receiver.count:
+            # As IPTransport does, stop once a call comes back short.
+            return packets, calls
+
+
+def make_socket(proto, pktinfo=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_RAW, proto)
+    sock.setblocking(0)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, RCVBUF)
+    except socket.error:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RCVBUF)
+    if pktinfo:
+        sockmsg.enable_pktinfo(sock)
+    return sock
+
+
+def run(name, sock, read, options):
+    """Send the packets in bursts and time reading each burst with read.
+    Prints the receive rate."""
+    sender = socket.socket(socket.AF_INET, socket.SOCK_RAW, options.proto)
+    payload = "x" * options.size
+    received = calls = 0
+    elapsed = 0.
+    for start in xrange(0, options.packets, options.burst):
+        count = min(options.burst, options.packets - start)
+        for n in xrange(count):
+            sender.sendto(payload, ("127.0.0.1", 0))
+        before = time.time()
+        packets, burst_calls = read()
+        elapsed += time.time() - before
+        received += packets
+        calls += burst_calls
+    sender.close()
+    sock.close()
+    print("{:>20} {:>10.2f} {:>12.0f} {:>10.2f} {:>8}".format(name, elapsed,
+          received / elapsed, float(calls) / received,
+          options.packets - received))
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.rstrip())
+    parser.add_option("-p", "--packets", type="int",
+                      default=DEFAULT_PACKETS, help="Number of packets. "
+                      "Default: %default")
+    parser.add_option("-s", "--size", type="int", default=DEFAULT_SIZE,
+                      help="Payload bytes per packet. Default: %default")
+    parser.add_option("-b", "--batch", type="int", default=DEFAULT_BATCH,
+                      help="recvmmsg batch size. Default: %default")
+    parser.add_option("-n", "--burst", type="int", default=DEFAULT_BURST,
+                      help="Packets sent before each read. Default: "
+                      "%default")
+    parser.add_option("-P", "--proto", type="int", default=DEFAULT_PROTO,
+                      help="IP protocol number. Default: %default")
+    options, args = parser.parse_args(argv[1:])
+
+    size = options.size + 20
+    print("{} packets of {} bytes, in bursts of {}".format(options.packets,
+          size, options.burst))
+    print("{:>20} {:>10} {:>12} {:>10} {:>8}".format("reader", "seconds",
+          "packets/s", "calls/pkt", "dropped"))
+
+    sock = make_socket(options.proto)
+    run("recvfrom", sock, lambda: read_recvfrom(sock, size), options)
+    if not sockmsg.available:
+        print("recvmsg isn't available on this platform.")
+        return
+    sock = make_socket(options.proto, pktinfo=True)
+    receiver = sockmsg.PacketReceiver(sock, size)
+    run("recvmsg pktinfo", sock, lambda: read_recvmsg(receiver), options)
+    if not sockmsg.batch_available:
+        print("recvmmsg isn't available on this platform.")
+        return
+    for pktinfo in (False, True):
+        sock = make_socket(options.proto, pktinfo)
+        receiver = sockmsg.BatchReceiver(sock, size, options.batch)
+        name = "recvmmsg {}{}".format(options.batch,
+                                      " pktinfo" if pktinfo else "")
+        run(name, sock, lambda: read_recvmmsg(receiver), options)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
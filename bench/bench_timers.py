@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""Compare RTP's timer load on a TimerWheel against one reactor.callLater
+per timer.
+
+Each simulated neighbor has a holdtime timer that is reset by every hello,
+and some hellos are followed by a reliable packet whose retransmit timer is
+normally cancelled by an ACK shortly afterwards. The same precomputed event
+schedule is replayed against both implementations using a simulated clock,
+so only the cost of scheduling, resetting, cancelling and expiring timers is
+measured.
+
+Usage: ./bench_timers.py [NEIGHBORS ...]
+       (default: 1000 10000)
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             ".."))
+
+from twisted.internet import reactor
+
+import timerwheel
+
+HELLO_INTERVAL     = 5
+HOLDTIME           = 15
+RETRANSMIT_TIMEOUT = .2
+ACK_DELAY          = .02
+UPDATE_PROBABILITY = .2
+ACK_LOSS           = .01
+STEP               = .01
+DURATION           = 60
+
+
+class SimulatedTime(object):
+    def __init__(self):
+        self.now = 0.
+
+    def seconds(self):
+        return self.now
+
+
+def make_schedule(neighbors, seed=0):
+    """Return a list with one (hellos, updates, acks) tuple per clock step.
+    Each is a list of neighbor indexes."""
+    rand = random.Random(seed)
+    nsteps = int(DURATION / STEP)
+    ack_steps = int(ACK_DELAY / STEP)
+    schedule = [([], [], []) for i in xrange(nsteps + ack_steps + 1)]
+    for n in xrange(neighbors):
+        t = rand.uniform(0, HELLO_INTERVAL)
+        while t < DURATION:
+            step = int(t / STEP)
+            hellos, updates, acks = schedule[step]
+            hellos.append(n)
+            if rand.random() < UPDATE_PROBABILITY:
+                updates.append(n)
+                if rand.random() >= ACK_LOSS:
+                    schedule[step + ack_steps][2].append(n)
+            # Hellos are jittered a little, like most implementations do.
+            t += HELLO_INTERVAL * rand.uniform(.9, 1)
+    return schedule[:nsteps]
+
+
+def replay(schedule, neighbors, call_later, advance):
+    fired = [0]
+    def expire():
+        fired[0] += 1
+    holds = [call_later(HOLDTIME, expire) for n in xrange(neighbors)]
+    retransmits = [None] * neighbors
+
+    start = time.time()
+    for hellos, updates, acks in schedule:
+        advance(STEP)
+        for n in hellos:
+            holds[n].reset(HOLDTIME)
+        for n in updates:
+            retransmit = retransmits[n]
+            if retransmit and retransmit.active():
+                retransmit.cancel()
+            retransmits[n] = call_later(RETRANSMIT_TIMEOUT, expire)
+        for n in acks:
+            retransmit = retransmits[n]
+            if retransmit and retransmit.active():
+                retransmit.cancel()
+    elapsed = time.time() - start
+
+    for timer in holds + retransmits:
+        if timer and timer.active():
+            timer.cancel()
+    return elapsed, fired[0]
+
+
+def run_simulated(schedule, neighbors, call_later):
+    """Replay the schedule on the reactor, with its clock replaced by a
+    simulated one."""
+    clock = SimulatedTime()
+    reactor.seconds = clock.seconds
+    def advance(seconds):
+        clock.now += seconds
+        reactor.runUntilCurrent()
+    try:
+        return replay(schedule, neighbors, call_later(), advance)
+    finally:
+        del reactor.seconds
+        reactor.runUntilCurrent()
+
+
+def bench_calllater(schedule, neighbors):
+    """One DelayedCall per timer in the reactor's heap."""
+    return run_simulated(schedule, neighbors, lambda: reactor.callLater)
+
+
+def bench_wheel(schedule, neighbors):
+    """All timers in a TimerWheel, which has one DelayedCall of its own in
+    the same reactor."""
+    return run_simulated(schedule, neighbors,
+                         lambda: timerwheel.TimerWheel(reactor).call_later)
+
+
+def main(argv):
+    try:
+        counts = [int(arg) for arg in argv[1:]] or [1000, 10000]
+    except ValueError:
+        sys.stderr.write(__doc__)
+        return 1
+
+    print("{} simulated seconds, hello every {}s, {}% of hellos followed "
+          "by a reliable packet".format(DURATION, HELLO_INTERVAL,
+                                         int(UPDATE_PROBABILITY * 100)))
+    print("{:>10} {:>14} {:>14} {:>9}".format("Neighbors", "callLater (s)",
+                                              "TimerWheel (s)", "Speedup"))
+    for neighbors in counts:
+        schedule = make_schedule(neighbors)
+        base, base_fired = bench_calllater(schedule, neighbors)
+        wheel, wheel_fired = bench_wheel(schedule, neighbors)
+        if base_fired != wheel_fired:
+            print("Warning: {} timers expired with callLater, {} with "
+                  "TimerWheel".format(base_fired, wheel_fired))
+        print("{:>10} {:>14.3f} {:>14.3f} {:>8.1f}x".format(neighbors, base,
+                                                           wheel,
+                                                           base / wheel))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+"""Report how much memory the topology table takes per 100k routes.
+
+A topology table is filled with the given number of prefixes, each
+reported by the same set of neighbors with a classic metric, the way
+EIGRP builds it from UPDATEs. The memory used by the table and its
+entries, and then by the per-neighbor information, is reported scaled to
+100k routes.
+
+Memory is measured with tracemalloc where it is available, and from the
+process's resident set size otherwise.
+
+Usage: ./bench_topology_memory.py [-r ROUTES] [-n NEIGHBORS]
+"""
+
+import os
+import sys
+import optparse
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             ".."))
+
+from bench_dual import MemoryMeter, get_kvalues, make_prefixes, tracemalloc
+
+# dualfsm has to be imported before topology.
+import dualfsm
+import rtptlv
+from topology import TopologyTable, TopologyNeighborInfo
+
+DEFAULT_ROUTES    = 100000
+DEFAULT_NEIGHBORS = 4
+
+PER_ROUTES = 100000
+
+
+class PhysicalInterface(object):
+    """Stands in for the physical interface of a neighbor's RTP interface,
+    which is all update_for_iface looks at."""
+
+    def get_bandwidth(self):
+        return 100000
+
+    def get_delay(self):
+        return 10
+
+    def get_load(self):
+        return 1
+
+    def get_reliability(self):
+        return 255
+
+    def get_mtu(self):
+        return 1500
+
+
+class Interface(object):
+    def __init__(self):
+        self.logical_iface = self
+        self.phy_iface = PhysicalInterface()
+
+
+class Neighbor(object):
+    def __init__(self, iface):
+        self.iface = iface
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage=__doc__.rstrip())
+    parser.add_option("-r", "--routes", type="int", default=DEFAULT_ROUTES,
+                      help="Number of prefixes in the table. Default: "
+                      "%default")
+    parser.add_option("-n", "--neighbors", type="int",
+                      default=DEFAULT_NEIGHBORS,
+                      help="Number of neighbors reporting each prefix. "
+                      "Default: %default")
+    options, args = parser.parse_args(argv[1:])
+
+    iface = Interface()
+    neighbors = [ Neighbor(iface) for i in xrange(options.neighbors) ]
+    prefixes = make_prefixes(options.routes)
+    meter = MemoryMeter()
+
+    meter.start()
+    table = TopologyTable(get_kvalues)
+    entries = [ table.update_prefix(prefix) for prefix in prefixes ]
+    entries_used = meter.stop()
+
+    meter.start()
+    for n, t_entry in enumerate(entries):
+        for neighbor in neighbors:
+            metric = rtptlv.ValueClassicMetric(256 * (n % 1000 + 1), 25600,
+                                               1500, 1, 255, 1, 0, 0)
+            t_entry.add_neighbor(TopologyNeighborInfo(neighbor, metric,
+                                                      get_kvalues))
+    neighbors_used = meter.stop()
+
+    scale = float(PER_ROUTES) / options.routes
+    print("{} routes, {} neighbors each, memory measured with "
+          "{}".format(options.routes, options.neighbors,
+                      "tracemalloc" if tracemalloc else "RSS"))
+    print("Per {} routes:".format(PER_ROUTES))
+    print("{:>24} {:>8.1f} MiB".format("Table and entries",
+                                       entries_used * scale / 2**20))
+    print("{:>24} {:>8.1f} MiB".format("Neighbor information",
+                                       neighbors_used * scale / 2**20))
+    print("{:>24} {:>8.1f} MiB".format("Total", (entries_used +
+                                                 neighbors_used) *
+                                                scale / 2**20))
+    print("{:>24} {:>8.0f} bytes".format("Per neighbor per route",
+                                         float(neighbors_used) /
+                                         (options.routes * options.neighbors)))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+
+"""Whole-table metric recomputation.
+
+When the K-values or an interface's metrics change, the full distance and
+composite metric of every neighbor in the topology table have to be
+recomputed, and every prefix's successor re-ranked. Doing that through the
+TopologyNeighborInfo objects means building and updating metric objects one
+neighbor at a time. BulkMetrics instead copies the reported distances of the
+whole table into arrays once, and then recomputes full distances, composite
+metrics, successors and feasible successors for every prefix in a few
+passes over those arrays. Only the prefixes whose successor changed are
+returned:
+
+    bulk = BulkMetrics(get_kvalues)
+    bulk.load(topology)
+    for prefix, t_entry, successor in bulk.recompute():
+        ...
+
+The passes are vectorised with NumPy if it is installed. Otherwise the
+same computation runs over array.array columns in plain Python, which is
+slower but still avoids the per-neighbor metric objects."""
+
+# Python-EIGRP (http://python-eigrp.googlecode.com)
+# Copyright (C) 2013 Patrick F. Allen
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import array
+
+import rtptlv
+
+# NumPy is optional. Without it the array.array fallback is used.
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+_METRIC = rtptlv.ValueClassicMetric
+
+_DLY  = _METRIC.FIELDS.index("dly")
+_BW   = _METRIC.FIELDS.index("bw")
+_REL  = _METRIC.FIELDS.index("rel")
+_LOAD = _METRIC.FIELDS.index("load")
+_NFIELDS = len(_METRIC.FIELDS)
+
+# Composite metric used for unreachable routes, so they sort after every
+# reachable one and are never chosen as successor.
+INFINITY = 1 << 62
+
+NO_SUCCESSOR = -1
+
+
+class BulkMetrics(object):
+    """Recomputes metrics and successors for a whole TopologyTable.
+
+    load() takes a snapshot of the table's neighbors and their reported
+    distances, and recompute() can then be called as often as needed, for
+    example after each K-value or interface change. The snapshot doesn't
+    follow later changes to the table, so load() again after adding or
+    removing neighbors or prefixes.
+
+    recompute() doesn't change the topology entries. It returns the
+    prefixes whose successor changed since the previous recompute (or since
+    load(), for the first one), and the caller is expected to act on all of
+    them."""
+
+    def __init__(self, get_kvalues, use_numpy=True):
+        """get_kvalues - a function to retrieve the current K-values
+        use_numpy - set to False to use the array.array implementation even
+        if NumPy is installed"""
+        self._get_kvalues = get_kvalues
+        self._numpy = use_numpy and numpy is not None
+        self._clear()
+
+    def _clear(self):
+        # One item per prefix.
+        self._prefixes   = list()
+        self._entries    = list()
+        self._starts     = array.array("l")
+        self._successors = array.array("l")
+        self._index      = dict()
+
+        # One item per neighbor of each prefix. The rows of a prefix are
+        # contiguous, starting at its _starts item.
+        self._n_infos    = list()
+        self._reported   = array.array("I")
+        self._row_ifaces = array.array("l")
+
+        self._ifaces     = list()
+
+        # Results of the last recompute.
+        self._feasible_distance = None
+        self._feasible          = None
+
+    def __len__(self):
+        """Return the number of prefixes in the snapshot."""
+        return len(self._prefixes)
+
+    def load(self, table):
+        """Take a snapshot of a TopologyTable. Prefixes that no neighbor
+        has reported are left out."""
+        self.load_entries(table.iteritems())
+
+    def load_entries(self, entries):
+        """Take a snapshot of part of a TopologyTable, given as
+        (prefix, TopologyEntry) pairs such as TopologyTable.iface_entries
+        returns. Prefixes that no neighbor has reported are left out."""
+        self._clear()
+        iface_index = dict()
+        for prefix, t_entry in entries:
+            if not t_entry.neighbors:
+                continue
+            self._index[prefix] = len(self._prefixes)
+            self._prefixes.append(prefix)
+            self._entries.append(t_entry)
+            self._starts.append(len(self._n_infos))
+            successor = NO_SUCCESSOR
+            for n_info in t_entry.neighbors.itervalues():
+                if n_info is t_entry.successor:
+                    successor = len(self._n_infos)
+                iface = n_info.neighbor.iface
+                try:
+                    index = iface_index[iface]
+                except KeyError:
+                    index = iface_index[iface] = len(self._ifaces)
+                    self._ifaces.append(iface)
+                self._n_infos.append(n_info)
+                self._reported.extend(n_info.reported_fields())
+                self._row_ifaces.append(index)
+            self._successors.append(successor)
+
+    def recompute(self):
+        """Recompute every neighbor's full distance and composite metric
+        using the current K-values and interface metrics, then choose each
+        prefix's successor and feasible successors again.
+
+        Returns a list of (prefix, TopologyEntry, successor) for each prefix
+        whose successor changed, where successor is the TopologyNeighborInfo
+        of the new successor or TopologyEntry.NO_SUCCESSOR."""
+        if not self._prefixes:
+            return list()
+        kvalues = self._get_kvalues()
+        ifaces = self._iface_metrics()
+        if self._numpy:
+            successors = self._recompute_numpy(kvalues, ifaces)
+        else:
+            successors = self._recompute_array(kvalues, ifaces)
+
+        changes = list()
+        for index, (old, new) in enumerate(zip(self._successors, successors)):
+            if old == new:
+                continue
+            t_entry = self._entries[index]
+            if new == NO_SUCCESSOR:
+                successor = t_entry.NO_SUCCESSOR
+            else:
+                successor = self._n_infos[new]
+            changes.append((self._prefixes[index], t_entry, successor))
+        self._successors = array.array("l", successors)
+        return changes
+
+    def get_feasible_distance(self, prefix):
+        """Return prefix's feasible distance from the last recompute, or
+        None if it has no successor."""
+        fd = self._feasible_distance[self._index[prefix]]
+        if fd >= INFINITY:
+            return None
+        return int(fd)
+
+    def get_feasible_successors(self, prefix):
+        """Return a list of the TopologyNeighborInfo of each of prefix's
+        feasible successors as of the last recompute."""
+        index = self._index[prefix]
+        start = self._starts[index]
+        if index + 1 < len(self._starts):
+            end = self._starts[index + 1]
+        else:
+            end = len(self._n_infos)
+        return [ self._n_infos[row] for row in xrange(start, end)
+                 if self._feasible[row] ]
+
+    def _iface_metrics(self):
+        """Return (bandwidth, delay, load, reliability) lists with one item
+        per interface, as update_for_iface would use them."""
+        bws, dlys, loads, rels = list(), list(), list(), list()
+        for iface in self._ifaces:
+            phy_iface = iface.logical_iface.phy_iface
+            bws.append(phy_iface.get_bandwidth())
+            dlys.append(phy_iface.get_delay())
+            loads.append(phy_iface.get_load())
+            rels.append(phy_iface.get_reliability())
+        return bws, dlys, loads, rels
+
+    def _recompute_numpy(self, kvalues, ifaces):
+        if_bw, if_dly, if_load, if_rel = [ numpy.array(column,
+                                                       dtype=numpy.int64)
+                                           for column in ifaces ]
+        reported = numpy.frombuffer(self._reported, dtype=numpy.uint32)
+        reported = reported.reshape(-1, _NFIELDS).astype(numpy.int64)
+        row_ifaces = numpy.frombuffer(self._row_ifaces, dtype=numpy.int_)
+        starts = numpy.frombuffer(self._starts, dtype=numpy.int_)
+
+        dly  = reported[:, _DLY]
+        bw   = reported[:, _BW]
+        rel  = reported[:, _REL]
+        load = reported[:, _LOAD]
+        reported_metric = self._composite_numpy(dly, bw, rel, load, kvalues)
+
+        # The same adjustments as ValueClassicMetric.update_for_iface.
+        full_bw   = numpy.maximum(bw, if_bw[row_ifaces])
+        full_dly  = numpy.minimum(dly + if_dly[row_ifaces],
+                                  _METRIC.METRIC_UNREACHABLE)
+        full_load = numpy.maximum(load, if_load[row_ifaces])
+        full_rel  = numpy.minimum(rel, if_rel[row_ifaces])
+        full_metric = self._composite_numpy(full_dly, full_bw, full_rel,
+                                            full_load, kvalues)
+
+        # Rank each prefix's rows. The successor is the row with the lowest
+        # full metric, keeping the current successor on a tie.
+        counts = numpy.diff(numpy.append(starts, len(full_metric)))
+        owner = numpy.repeat(numpy.arange(len(starts)), counts)
+        best = numpy.minimum.reduceat(full_metric, starts)
+        is_best = full_metric == best[owner]
+        best_rows = numpy.flatnonzero(is_best)
+        first = numpy.ones(len(best_rows), dtype=bool)
+        first[1:] = owner[best_rows[1:]] != owner[best_rows[:-1]]
+        successors = best_rows[first]
+
+        old = numpy.frombuffer(self._successors, dtype=numpy.int_)
+        keep = old != NO_SUCCESSOR
+        keep[keep] = is_best[old[keep]]
+        successors = numpy.where(keep, old, successors)
+        successors[best >= INFINITY] = NO_SUCCESSOR
+
+        # A neighbor is a feasible successor if its reported distance is
+        # less than the feasible distance.
+        feasible = reported_metric < best[owner]
+        has_successor = successors != NO_SUCCESSOR
+        feasible[successors[has_successor]] = False
+
+        self._feasible_distance = best
+        self._feasible = feasible
+        return successors.tolist()
+
+    @staticmethod
+    def _composite_numpy(dly, bw, rel, load, kvalues):
+        """ValueClassicMetric.compute_metric over arrays of fields."""
+        k1, k2, k3, k4, k5 = kvalues
+        scale = _METRIC.METRIC_SCALE
+        metric = k1 * bw * scale + k3 * dly * scale
+        if k2:
+            divisor = 256 - load
+            nonzero = divisor != 0
+            metric += numpy.where(nonzero,
+                                  (k2 * bw) // numpy.where(nonzero, divisor, 1),
+                                  0)
+        if k5:
+            divisor = k4 + rel
+            multiplier = numpy.where(divisor > 0,
+                                     k5 // numpy.maximum(divisor, 1), 1)
+            multiplier[multiplier == 0] = 1
+            metric *= multiplier
+        metric[dly == _METRIC.METRIC_UNREACHABLE] = INFINITY
+        return metric
+
+    def _recompute_array(self, kvalues, ifaces):
+        if_bw, if_dly, if_load, if_rel = ifaces
+        reported = self._reported
+        row_ifaces = self._row_ifaces
+        unreachable = _METRIC.METRIC_UNREACHABLE
+        composite = self._composite
+
+        nrows = len(self._n_infos)
+        reported_metric = array.array("l", [0]) * nrows
+        full_metric = array.array("l", [0]) * nrows
+        for row in xrange(nrows):
+            base = row * _NFIELDS
+            dly = reported[base + _DLY]
+            bw = reported[base + _BW]
+            rel = reported[base + _REL]
+            load = reported[base + _LOAD]
+            reported_metric[row] = composite(dly, bw, rel, load, kvalues)
+
+            # The same adjustments as ValueClassicMetric.update_for_iface.
+            iface = row_ifaces[row]
+            full_metric[row] = composite(min(dly + if_dly[iface],
+                                             unreachable),
+                                         max(bw, if_bw[iface]),
+                                         min(rel, if_rel[iface]),
+                                         max(load, if_load[iface]),
+                                         kvalues)
+
+        # Rank each prefix's rows. The successor is the row with the lowest
+        # full metric, keeping the current successor on a tie.
+        starts = self._starts
+        nprefixes = len(starts)
+        successors = list()
+        feasible_distance = array.array("l", [0]) * nprefixes
+        feasible = array.array("b", [0]) * nrows
+        for index in xrange(nprefixes):
+            start = starts[index]
+            end = starts[index + 1] if index + 1 < nprefixes else nrows
+            best_row = start
+            best = full_metric[start]
+            for row in xrange(start + 1, end):
+                if full_metric[row] < best:
+                    best_row = row
+                    best = full_metric[row]
+            old = self._successors[index]
+            if old != NO_SUCCESSOR and full_metric[old] == best:
+                best_row = old
+            if best >= INFINITY:
+                best_row = NO_SUCCESSOR
+            successors.append(best_row)
+            feasible_distance[index] = best
+
+            # A neighbor is a feasible successor if its reported distance is
+            # less than the feasible distance.
+            for row in xrange(start, end):
+                if reported_metric[row] < best and row != best_row:
+                    feasible[row] = 1
+
+        self._feasible_distance = feasible_distance
+        self._feasible = feasible
+        return successors
+
+    @staticmethod
+    def _composite(dly, bw, rel, load, kvalues):
+        """ValueClassicMetric.compute_metric for one set of fields."""
+        if dly == _METRIC.METRIC_UNREACHABLE:
+            return INFINITY
+        k1, k2, k3, k4, k5 = kvalues
+        scale = _METRIC.METRIC_SCALE
+        metric = k1 * bw * scale + k3 * dly * scale
+        if k2 and load != 256:
+            metric += k2 * bw / (256 - load)
+        if k5 and (k4 or rel):
+            multiplier = k5 / (k4 + rel) or 1
+        else:
+            multiplier = 1
+        return metric * multiplier
@@ -1,17 +1,18 @@
 #!/usr/bin/env python
 
-"""The DUAL finite state machine."""
+"""The DUAL finite state machine.
 
-# Get fysom using "pip install fysom"
-try:
-    from fysom import Fysom
-except ImportError:
-    print("fysom module is not installed. Install with 'pip install fysom'")
+The FSM is table driven. A TopologyEntry only stores its current state as
+one of the small integers below (t_entry.state). The transition table and
+the state handlers are shared by every entry through a single DualFsm,
+DUAL_FSM, which is what TopologyEntry.fsm returns."""
 
 from topology import TopologyNeighborInfo
 
 import logging
 
+import rtptlv
+
 log = logging.getLogger("DUAL")
 
 # Actions that the FSM can request of EIGRP.
@@ -27,100 +28,136 @@ MODIFY_SUCCESSOR_ROUTE = 4
 SEND_QUERY             = 5
 SEND_REPLY             = 6
 
-class DualFsm(object):
+# DUAL states, as stored in TopologyEntry.state.
+PASSIVE = 0
+ACTIVE0 = 1
+ACTIVE1 = 2
+ACTIVE2 = 3
+ACTIVE3 = 4
+
+STATE_NAMES = ("Passive", "Active0", "Active1", "Active2", "Active3")
+
+# Input events. See section 3.5, Dual FSM, in the RFC.
+IE1  = 1
+IE2  = 2
+IE3  = 3
+IE4  = 4
+IE5  = 5
+IE6  = 6
+IE7  = 7
+IE8  = 8
+IE9  = 9
+IE10 = 10
+IE11 = 11
+IE12 = 12
+IE13 = 13
+IE14 = 14
+IE15 = 15
+IE16 = 16
+
+# (event, source state, destination state)
+DUAL_EVENTS = [ (IE1,  PASSIVE, PASSIVE),
+                (IE2,  PASSIVE, PASSIVE),
+                (IE3,  PASSIVE, ACTIVE3),
+                (IE4,  PASSIVE, ACTIVE1),
+                (IE5,  ACTIVE0, ACTIVE2),
+                (IE6,  ACTIVE0, ACTIVE0),
+                (IE7,  ACTIVE0, ACTIVE0),
+                (IE8,  ACTIVE0, ACTIVE0),
+                (IE6,  ACTIVE1, ACTIVE1),
+                (IE7,  ACTIVE1, ACTIVE1),
+                (IE8,  ACTIVE1, ACTIVE1),
+                (IE6,  ACTIVE2, ACTIVE2),
+                (IE7,  ACTIVE2, ACTIVE2),
+                (IE8,  ACTIVE2, ACTIVE2),
+                (IE6,  ACTIVE3, ACTIVE3),
+                (IE7,  ACTIVE3, ACTIVE3),
+                (IE8,  ACTIVE3, ACTIVE3),
+                (IE9,  ACTIVE1, ACTIVE0),
+                (IE10, ACTIVE3, ACTIVE2),
+                (IE11, ACTIVE0, ACTIVE1),
+                (IE12, ACTIVE2, ACTIVE3),
+                (IE13, ACTIVE3, PASSIVE),
+                (IE14, ACTIVE0, PASSIVE),
+                (IE15, ACTIVE1, PASSIVE),
+                (IE16, ACTIVE2, PASSIVE),
+              ]
+
+def compile_transitions(events):
+    """Return a transition table for a list of (event, src, dst) tuples.
+    table[state][event] is the state to move to, or None if the event is
+    not valid in that state."""
+    table = [ [None] * (IE16 + 1) for state in STATE_NAMES ]
+    for event, src, dst in events:
+        table[src][event] = dst
+    return tuple([ tuple(row) for row in table ])
+
+TRANSITIONS = compile_transitions(DUAL_EVENTS)
+
+
+class DualFsmError(Exception):
+    pass
 
-    # Input events. See section 3.5, Dual FSM, in the RFC.
-    DUAL_EVENTS = [ {'name': 'IE1',  'src': 'Passive', 'dst': 'Passive'},
-                    {'name': 'IE2',  'src': 'Passive', 'dst': 'Passive'},
-                    {'name': 'IE3',  'src': 'Passive', 'dst': 'Active3'},
-                    {'name': 'IE4',  'src': 'Passive', 'dst': 'Active1'},
-                    {'name': 'IE5',  'src': 'Active0', 'dst': 'Active2'},
-                    {'name': 'IE6',  'src': 'Active0', 'dst': 'Active0'},
-                    {'name': 'IE7',  'src': 'Active0', 'dst': 'Active0'},
-                    {'name': 'IE8',  'src': 'Active0', 'dst': 'Active0'},
-                    {'name': 'IE6',  'src': 'Active1', 'dst': 'Active1'},
-                    {'name': 'IE7',  'src': 'Active1', 'dst': 'Active1'},
-                    {'name': 'IE8',  'src': 'Active1', 'dst': 'Active1'},
-                    {'name': 'IE6',  'src': 'Active2', 'dst': 'Active2'},
-                    {'name': 'IE7',  'src': 'Active2', 'dst': 'Active2'},
-                    {'name': 'IE8',  'src': 'Active2', 'dst': 'Active2'},
-                    {'name': 'IE6',  'src': 'Active3', 'dst': 'Active3'},
-                    {'name': 'IE7',  'src': 'Active3', 'dst': 'Active3'},
-                    {'name': 'IE8',  'src': 'Active3', 'dst': 'Active3'},
-                    {'name': 'IE9',  'src': 'Active1', 'dst': 'Active0'},
-                    {'name': 'IE10', 'src': 'Active3', 'dst': 'Active2'},
-                    {'name': 'IE11', 'src': 'Active0', 'dst': 'Active1'},
-                    {'name': 'IE12', 'src': 'Active2', 'dst': 'Active3'},
-                    {'name': 'IE13', 'src': 'Active3', 'dst': 'Passive'},
-                    {'name': 'IE14', 'src': 'Active0', 'dst': 'Passive'},
-                    {'name': 'IE15', 'src': 'Active1', 'dst': 'Passive'},
-                    {'name': 'IE16', 'src': 'Active2', 'dst': 'Passive'},
-                  ]
-
-    def __init__(self, get_kvalues):
-        """get_kvalues - a function to retrieve the current K-values"""
-        callbacks = { 'onPassive': self._enter_passive,
-                      'onActive0': self._enter_active0,
-                      'onActive1': self._enter_active1,
-                      'onActive2': self._enter_active2,
-                      'onActive3': self._enter_active3,
-                    }
-        self._states = { 'passive': _state_passive,
-                         'active0': _state_active0,
-                         'active1': _state_active1,
-                         'active2': _state_active2,
-                         'active3': _state_active3,
-                       }
-        self._state = self._states['passive']
-        self.fsm = Fysom({'initial' : 'Passive',
-                          'events'  : self.DUAL_EVENTS
-                         })
-        self._get_kvalues = get_kvalues
-
-    def _enter_passive(self, e):
-        log.debug("Entering state Passive")
-        self._state = self._states['passive']
-
-    def _enter_active0(self, e):
-        log.debug("Entering state Active0")
-        self._state = self._states['active0']
-
-    def _enter_active1(self, e):
-        log.debug("Entering state Active1")
-        self._state = self._states['active1']
-
-    def _enter_active2(self, e):
-        log.debug("Entering state Active2")
-        self._state = self._states['active2']
-
-    def _enter_active3(self, e):
-        log.debug("Entering state Active3")
-        self._state = self._states['active3']
-
-    def handle_update(self, neighbor, nexthop, metric, t_entry, get_kvalues):
-        return self._state.handle_update(neighbor,
-                                         nexthop,
-                                         metric,
-                                         t_entry,
-                                         get_kvalues)
+
+class DualFsm(object):
+    """Dispatches DUAL input to the handler for a topology entry's current
+    state, and moves entries between states. Holds no per-entry data, so a
+    single instance (DUAL_FSM) is shared by all topology entries."""
+
+    def __init__(self, transitions=TRANSITIONS):
+        self._transitions = transitions
+        self._states = ( _state_passive,
+                         _state_active0,
+                         _state_active1,
+                         _state_active2,
+                         _state_active3,
+                       )
+
+    def transition(self, t_entry, event):
+        """Apply an input event to t_entry, changing its state. Raises
+        DualFsmError if the event isn't valid in the entry's state."""
+        state = t_entry.state
+        dst = self._transitions[state][event]
+        if dst is None:
+            raise(DualFsmError("IE{} is not valid in state "
+                               "{}".format(event, STATE_NAMES[state])))
+        if dst != state:
+            log.debug("Entering state {}".format(STATE_NAMES[dst]))
+            t_entry.state = dst
+
+    def handle_update(self, neighbor, nexthop, metric_fields, t_entry,
+                      get_kvalues):
+        """Handle a route from an UPDATE. metric_fields is the reported
+        distance as a sequence of rtptlv.ValueClassicMetric field values,
+        in the order of its FIELDS, so that no metric object needs to be
+        built for routes that don't change the successor."""
+        return self._states[t_entry.state].handle_update(neighbor,
+                                                         nexthop,
+                                                         metric_fields,
+                                                         t_entry,
+                                                         get_kvalues)
 
     def handle_reply(self, neighbor, nexthop, t_entry):
-        self._state.handle_reply(neighbor,
-                                 nexthop,
-                                 t_entry)
+        return self._states[t_entry.state].handle_reply(neighbor,
+                                                        nexthop,
+                                                        t_entry)
 
     def handle_query(self, neighbor, nexthop, metric, t_entry, get_kvalues):
-        self._state.handle_query(neighbor,
-                                 nexthop,
-                                 metric,
-                                 t_entry,
-                                 get_kvalues)
+        return self._states[t_entry.state].handle_query(neighbor,
+                                                        nexthop,
+                                                        metric,
+                                                        t_entry,
+                                                        get_kvalues)
 
-    def handle_link_down(self, linkmsg):
-        self._state.handle_link_down(linkmsg)
+    def handle_link_down(self, rtpiface, t_entry):
+        return self._states[t_entry.state].handle_link_down(rtpiface, t_entry)
 
-    def handle_link_metric_change(self, linkmsg):
-        self._state.handle_link_metric_change(linkmsg)
+    def handle_successor_change(self, successor, t_entry):
+        return self._states[t_entry.state].handle_successor_change(successor,
+                                                                   t_entry)
+
+    def handle_link_metric_change(self, linkmsg, t_entry):
+        return self._states[t_entry.state].handle_link_metric_change(linkmsg)
 
 
 class DualState(object):
@@ -128,9 +165,11 @@ class DualState(object):
 
 
 class StatePassive(DualState):
-    def handle_update(self, neighbor, nexthop, metric, t_entry, get_kvalues):
-        # XXX nexthop is unused here. Do we need to pass it in?
-        # (What about for other states that handle updates?)
+    def handle_update(self, neighbor, nexthop, metric_fields, t_entry,
+                      get_kvalues):
+        # The nexthop is recorded with the neighbor's information, so the
+        # route can be installed through it later if the neighbor becomes
+        # the successor without sending another update.
 
         # IE2 and IE4, for update pkts.
         #
@@ -167,11 +206,18 @@ class StatePassive(DualState):
             neighbor_entry = t_entry.get_neighbor(neighbor)
         except KeyError:
             log.debug("Creating new neighbor for fsm...")
-            t_entry.add_neighbor(TopologyNeighborInfo(neighbor,
-                                                      metric,
-                                                      get_kvalues))
-            neighbor_entry = t_entry.get_neighbor(neighbor)
-        t_entry.update_neighbor(neighbor_entry, metric)
+            neighbor_entry = TopologyNeighborInfo(neighbor, None, get_kvalues,
+                                                  nexthop)
+            neighbor_entry.set_reported_fields(rtptlv.ValueClassicMetric,
+                                               metric_fields)
+            t_entry.add_neighbor(neighbor_entry)
+            old_metric = None
+        else:
+            old_metric = neighbor_entry.reported_metric()
+            neighbor_entry.nexthop = nexthop
+            neighbor_entry.set_reported_fields(rtptlv.ValueClassicMetric,
+                                               metric_fields)
+            t_entry.update_neighbor(neighbor_entry)
         successor_entry = t_entry.successor
 
         log.debug("Current successor: {}".format(successor_entry))
@@ -179,14 +225,12 @@ class StatePassive(DualState):
         if successor_entry == neighbor_entry:
             log.debug("Update came from successor")
             # QRY came from current successor
-            kvalues = get_kvalues()
-            if successor_entry.reported_distance.compute_metric(*kvalues) == \
-                                metric.compute_metric(*kvalues):
+            if old_metric == neighbor_entry.reported_metric():
                 # If metric hasn't changed, do nothing
                 return [(NO_OP, None)]
             else:
                 # Came from successor and metric is different
-                if not metric.reachable():
+                if not neighbor_entry.reachable():
                     # Unreachable via successor. Use a feasible successor if
                     # available.
                     # XXX TODO implement this, and be aware if it returns
@@ -195,11 +239,12 @@ class StatePassive(DualState):
                     # neighbor info for set_successor
                     fs = t_entry.get_feasible_successor()
                     if fs:
-                        # Install FS and send update with new metric.
+                        # IE2. Install FS and send update with new metric.
+                        t_entry.fsm.transition(t_entry, IE2)
                         return [(INSTALL_SUCCESSOR, fs.neighbor)]
                     else:
                         # No known route to dest. IE4, go to Active.
-                        t_entry.fsm.fsm.IE4()
+                        t_entry.fsm.transition(t_entry, IE4)
 
                         # Send QRY to all neighbors for this prefix.
                         actions = list()
@@ -214,28 +259,16 @@ class StatePassive(DualState):
                         actions.append((UNINSTALL_SUCCESSOR, None))
 
                         # Set reply flag for all neighbors for this prefix
-                        for n_info in t_entry.neighbors:
+                        for n_info in t_entry.neighbors.itervalues():
                             n_info.waiting_for_reply = True
+                        return actions
                 else:
                     # Successor is still reachable but metric changed.
-                    # Update the metric for this neighbor in topology entry
-                    # and routing table.
-                    # Send an update packet with the new metric.
-                    # XXX Implement the SET_METRIC and SEND_UPDATE in caller.
-                    # Can probably make set_metric more generic to handle
-                    # updating routes in general, Then other return values
-                    # can use this as well.
-                    # SEND_UPDATE could be used above as well so sending
-                    # an update isn't implied when using INSTALL_SUCCESSOR.
-                    # Not sure if that is useful for now, depends if anything
-                    # else in the fsm installs a successor without sending
-                    # an update... which doesn't sound likely.
-                    successor_entry.reported_distance = metric
-                    successor_entry.update_full_distance()
-                    actions = list()
-                    actions.append((SET_METRIC, None))
-                    actions.append((SEND_UPDATE, None))
-                    return actions
+                    # update_neighbor has already recorded the new metric.
+                    # Installing the same successor again writes the route
+                    # with the new metric and sends an update packet with
+                    # it.
+                    return [(INSTALL_SUCCESSOR, neighbor)]
         else:
             log.debug("Update came from non-successor")
             # Update came from non-successor. Update its information in the
@@ -243,7 +276,7 @@ class StatePassive(DualState):
             # If there is no successor currently and the prefix is reachable
             # via this neighbor, use this neighbor as the successor.
             if successor_entry == t_entry.NO_SUCCESSOR:
-                if not metric.reachable():
+                if not neighbor_entry.reachable():
                     return [(NO_OP, None)]
                     log.debug("Received reachable metric for prefix lacking a successor - use this neighbor as successor")
                 return [(INSTALL_SUCCESSOR, neighbor)]
@@ -280,7 +313,7 @@ class StatePassive(DualState):
                 # think.
                 return [(SEND_REPLY, fs)]
             else:
-                t_entry.fsm.fsm.IE3()
+                t_entry.fsm.transition(t_entry, IE3)
                 actions = list()
                 actions.append((SEND_QUERY, tlv))
 
@@ -288,7 +321,7 @@ class StatePassive(DualState):
                 actions.append((UNINSTALL_SUCCESSOR, None))
 
                 # Set reply flag for all neighbors for this prefix
-                for n_info in t_entry.neighbors:
+                for n_info in t_entry.neighbors.itervalues():
                     n_info.waiting_for_reply = True
         else:
             # Query did not come from successor, reply with our route info
@@ -296,10 +329,10 @@ class StatePassive(DualState):
             # Just pass up the successor I think - we already know the tlv
             # in the caller, so we can fill out the reply correctly I
             # think.
-            t_entry.fsm.fsm.IE1()
+            t_entry.fsm.transition(t_entry, IE1)
             return [(SEND_REPLY, successor)]
 
-    def handle_link_down(self, linkmsg):
+    def handle_link_down(self, rtpiface, t_entry):
         # IE2 and IE4 for link down changes. Snipped from handle_update,
         # so this can be consolidated in a shared function.
         #
@@ -324,6 +357,29 @@ class StatePassive(DualState):
         #        Endif
         pass
 
+    def handle_successor_change(self, successor, t_entry):
+        # IE2 and IE4 for successor changes that don't come from a packet,
+        # e.g. the successor was lost with its neighbor. successor is the
+        # TopologyNeighborInfo to use instead, or t_entry.NO_SUCCESSOR if
+        # there is no feasible successor.
+        #
+        # If there is a new successor:
+        #    # IE2, stay in Passive
+        #    Install the new successor
+        #    Send an update packet with the new metric
+        # Else:
+        #    # No route to dest. IE4, go to Active.
+        #    Send QRY to all neighbors, set their REPLY status flag to 1
+        #    Stop using route for routing.
+        # Endif
+        if successor != t_entry.NO_SUCCESSOR:
+            t_entry.fsm.transition(t_entry, IE2)
+            return [(INSTALL_SUCCESSOR, successor.neighbor)]
+        t_entry.fsm.transition(t_entry, IE4)
+        for n_info in t_entry.neighbors.itervalues():
+            n_info.waiting_for_reply = True
+        return [(SEND_QUERY, None), (UNINSTALL_SUCCESSOR, None)]
+
     def handle_link_metric_change(self, linkmsg):
         # XXX Would be handled similarly to handle_link_down
         pass
@@ -345,14 +401,19 @@ class BaseActive(DualState):
         from a neighbor which is our current successor for that network."""
         assert False
 
-    def handle_update(self, neighbor, nexthop, metric, t_entry, get_kvalues):
-        # XXX Nexthop unused. Do we need to pass it in?
+    def handle_update(self, neighbor, nexthop, metric_fields, t_entry,
+                      get_kvalues):
         # If update indicates a metric change:
         #     IE7. Record the metric information.
         # Endif
-        if t_entry.get_neighbor(neighbor).reported_distance != metric:
-            t_entry.fsm.fsm.IE7()
-            t_entry.get_neighbor(neighbor).reported_distance = metric
+        n_info = t_entry.get_neighbor(neighbor)
+        n_info.nexthop = nexthop
+        metric_class = rtptlv.ValueClassicMetric
+        if n_info.reported_metric() != \
+           metric_class.fields_metric(metric_fields, *get_kvalues()):
+            t_entry.fsm.transition(t_entry, IE7)
+            n_info.set_reported_fields(metric_class, metric_fields)
+            t_entry.update_neighbor(n_info)
         return [(NO_OP, None)]
 
     def handle_reply(self, neighbor, nexthop, t_entry):
@@ -372,7 +433,7 @@ class BaseActive(DualState):
         # entry, while we wait for all replies.
         # Presumably we check if the tlv's metric is reachable or not and
         # either add a new successor here or don't.
-        t_entry.fsm.fsm.IE8()
+        t_entry.fsm.transition(t_entry, IE8)
         n_info = t_entry.get_neighbor(neighbor)
         n_info.waiting_for_reply = False
         if t_entry.all_replies_received():
@@ -396,9 +457,14 @@ class BaseActive(DualState):
             # XXX What args do I need?
             return self._handle_query_from_successor(neighbor, nexthop, metric, t_entry, get_kvalues)
         else:
-            t_entry.fsm.fsm.IE6()
+            t_entry.fsm.transition(t_entry, IE6)
             return [(SEND_REPLY, successor)]
 
+    def handle_successor_change(self, successor, t_entry):
+        # Already active. A new successor is chosen once all replies have
+        # been received.
+        return [(NO_OP, None)]
+
     def handle_link_metric_change(self, linkmsg):
         pass
 
@@ -412,7 +478,7 @@ class StateActive0(BaseActive):
     def _received_last_reply(self, neighbor, nexthop, t_entry):
         # "need not send a REPLY to the old successor"
         # IE14. Transition to passive.
-        t_entry.fsm.fsm.IE14()
+        t_entry.fsm.transition(t_entry, IE14)
         fs = t_entry.get_feasible_successor()
         if fs:
             return [(INSTALL_SUCCESSOR, fs.neighbor)]
@@ -423,9 +489,9 @@ class StateActive0(BaseActive):
     def _handle_query_from_successor(neighbor, nexthop, metric, t_entry, get_kvalues):
         # IE5. There is no special handling mentioned in Rev5 other than
         # to set the query origin flag to 3 (i.e. transition to Active3).
-        t_entry.fsm.fsm.IE5()
+        t_entry.fsm.transition(t_entry, IE5)
 
-    def handle_link_down(self, linkmsg):
+    def handle_link_down(self, rtpiface, t_entry):
         # The relevant link has already failed in Active3 or Passive in order
         # to get to Active2, so it can't fail again.
         # (What about if link is flapping, i.e. goes down and then back up and
@@ -488,7 +554,7 @@ class StateActive1(BaseActive):
                                      get_kvalues):
         # IE5. There is no special handling mentioned in Rev5 other than
         # to set the query origin flag to 3 (i.e. transition to Active3).
-        t_entry.fsm.fsm.IE5()
+        t_entry.fsm.transition(t_entry, IE5)
 
     def handle_link_down(self, rtpiface, t_entry):
         # XXX Need to look at this again, just trying to work out roughly what
@@ -521,7 +587,7 @@ class StateActive1(BaseActive):
             # successor. Since the link just failed, we might not
             # really need to bother going to IE9 here - but maybe we do.
             # 
-            t_entry.fsm.fsm.IE9()
+            t_entry.fsm.transition(t_entry, IE9)
 
 
 class StateActive2(BaseActive):
@@ -538,17 +604,17 @@ class StateActive2(BaseActive):
         # Endif
         fs = t_entry.get_feasible_successor()
         if fs:
-            t_entry.fsm.fsm.IE16()
+            t_entry.fsm.transition(t_entry, IE16)
             return [(INSTALL_SUCCESSOR, fs)]
         else:
-            t_entry.fsm.fsm.IE12()
+            t_entry.fsm.transition(t_entry, IE12)
             return [(SEND_QUERY, t_entry)]
 
     def _handle_query_from_successor(neighbor, nexthop, metric, t_entry, get_kvalues):
         # Shouldn't happen in Active2 or Active3. Could log or just ignore.
         log.debug("Received unexpected query from successor in Active2")
 
-    def handle_link_down(self, linkmsg):
+    def handle_link_down(self, rtpiface, t_entry):
         # The relevant link has already failed in Active3 or Passive in order
         # to get to Active2, so it can't fail again.
         # (What about if link is flapping, i.e. goes down and then back up and
@@ -568,7 +634,7 @@ class StateActive3(BaseActive):
         # I think we need to do that, if we have a valid route.
 
         # XXX Some of this is probably wrong.
-        t_entry.fsm.fsm.IE13()
+        t_entry.fsm.transition(t_entry, IE13)
         fs = t_entry.get_feasible_successor()
         actions = list()
         if fs:
@@ -588,7 +654,7 @@ class StateActive3(BaseActive):
         # Shouldn't happen in Active2 or Active3. Could log or just ignore.
         log.debug("Received unexpected query from successor in Active3")
 
-    def handle_link_down(self, linkmsg):
+    def handle_link_down(self, rtpiface, t_entry):
         # For all neighbors attached to this interface:
         #     IE8. Clear neighbor REPLY flag.
         #     If neighbor is successor:
@@ -610,3 +676,5 @@ _state_active0 = StateActive0()
 _state_active1 = StateActive1()
 _state_active2 = StateActive2()
 _state_active3 = StateActive3()
+
+DUAL_FSM = DualFsm()
@@ -30,6 +30,10 @@ import copy
 from twisted.python import log
 
 import dualfsm
+import bulkmetric
+import fibwriter
+import ifmetrics
+import ipv4
 import rtp
 import rtptlv
 import util
@@ -37,7 +41,7 @@ import sysiface
 import eigrpadmin
 import netlink_listener
 from tw_baseiptransport import reactor
-from topology import TopologyEntry, TopologyNeighborInfo
+from topology import TopologyTable, TopologyEntry, TopologyNeighborInfo
 
 class EIGRP(rtp.ReliableTransportProtocol):
     """An EIGRP implementation based on Cisco's draft informational RFC
@@ -48,6 +52,14 @@ class EIGRP(rtp.ReliableTransportProtocol):
     DEFAULT_KVALUES = [ 1, 0, 1, 0, 0 ]
     MC_IP = "224.0.0.10"
 
+    # Seconds after startup to remove routes left by an earlier run that
+    # haven't been learned again.
+    FIB_RECONCILE_TIME = 60
+
+    # Route metrics in the system table are 32 bit, but composite metrics
+    # can be larger. Larger ones are installed as this.
+    FIB_METRIC_MAX = 0xFFFFFFFF
+
     def __init__(self, requested_ifaces, routes=None, import_routes=False,
                  admin_port=None, *args, **kwargs):
         """
@@ -56,8 +68,22 @@ class EIGRP(rtp.ReliableTransportProtocol):
         import_routes - Import routes from the activated ifaces (True or False)
         log_config - Configuration filename
         admin_port - The TCP port to bind to the administrative interface"""
-        self._topology = dict()
+        self._topology = TopologyTable(self._get_kvalues)
         rtp.ReliableTransportProtocol.__init__(self, *args, **kwargs)
+        # Routes left in the table by an earlier run stay in place while
+        # they are relearned. The ones that aren't relearned within
+        # FIB_RECONCILE_TIME are removed.
+        try:
+            installed = self._sys.get_installed_routes()
+        except ValueError as e:
+            self.log.warning("Couldn't read installed routes: {}".format(e))
+            installed = dict()
+        # Routes are written from a thread, so a slow kernel doesn't hold
+        # up RTP.
+        worker = fibwriter.FibWorker(self._sys, reactor)
+        self._fib = fibwriter.FibWriter(self._sys, reactor, worker=worker)
+        self._fib.reconcile(installed)
+        reactor.callLater(self.FIB_RECONCILE_TIME, self._fib.end_reconcile)
         # XXX Should probably move all kvalue stuff out of RTP and into EIGRP
         # then allow a way to add arbitrary data to RTP's HELLO messages
         # (along with verification functions for neighbor formation). Not all
@@ -72,6 +98,7 @@ class EIGRP(rtp.ReliableTransportProtocol):
             self._k3 = self.DEFAULT_KVALUES[2]
             self._k4 = self.DEFAULT_KVALUES[3]
             self._k5 = self.DEFAULT_KVALUES[4]
+        self._new_kvalues()
 
         self._register_op_handlers()
         self._tlvfactory.register_tlvs([rtptlv.TLVInternal4,
@@ -81,46 +108,140 @@ class EIGRP(rtp.ReliableTransportProtocol):
             self.activate_iface(iface)
         self._init_routes(import_routes)
         if sys.platform == "linux2":
-            self._iface_event_listener = netlink_listener.LinuxIfaceEventListener(self._link_up, self._link_down)
+            # The system's interfaces are kept current from the same
+            # events.
+            listener = netlink_listener.LinuxIfaceEventListener
+            self._iface_event_listener = listener(self._link_up,
+                                    self._link_down,
+                                    link_cb=self._sys.handle_link_message,
+                                    addr_cb=self._sys.handle_addr_message)
         else:
             self.log.info("Currently no iface event listener for Windows.")
+        # Interface metrics are measured rather than fixed, where the
+        # system supports it.
+        self._iface_sampler = ifmetrics.InterfaceSampler(self._sys, reactor,
+                                                self._iface_metrics_changed)
+        self._iface_sampler.start()
         if admin_port:
             self.log.info("Admin interface starting on port {}".format(admin_port))
             eigrpadmin.start(self, port=admin_port)
         else:
             self.log.info("Admin port not set, disabling admin interface")
 
-    def _link_up(self, ifname):
+    def _link_up(self, ifnames):
         # XXX TODO
-        self.log.info("Link up: {}".format(ifname))
+        self.log.info("Link up: {}".format(", ".join(ifnames)))
 
-    def _link_down(self, ifname):
+    def _link_down(self, ifnames):
+        """Called with the names of the interfaces that went down. Links
+        that go down together, e.g. VLANs on the same trunk, arrive in one
+        call and are handled in a single pass."""
         # One physical interface can be associated with more than one
-        # logical/RTP interface. Tell all topology entries about
-        # all affected RTP interfaces.
-        self.log.info("Link down: {}".format(ifname))
+        # logical/RTP interface. The neighbors on any of the affected RTP
+        # interfaces can't be reached any more, so what they reported is
+        # dropped as if they had been lost. RTP drops the neighbors
+        # themselves once their hold time expires.
+        self.log.info("Link down: {}".format(", ".join(ifnames)))
+        ifnames = set(ifnames)
+        down = set()
+        entries = dict()
         for rtpiface in self._ifaces:
             if not rtpiface.activated:
                 # Since this is asynchronous, when the operator is allowed to
                 # toggle the activated interfaces at runtime, I still don't
                 # think this will cause a timing issue.
                 continue
-            for t_entry in self._topology.itervalues():
-                actions = t_entry.fsm.handle_link_down(iface, t_entry)
-                if not actions:
-                    continue
-                for action, data in actions:
-                    # XXX TODO
-                    pass
+            if rtpiface.logical_iface.phy_iface.name not in ifnames:
+                continue
+            down.add(rtpiface)
+            entries.update(self._topology.iface_entries(rtpiface))
+
+        update_tlvs = list()
+        query_tlvs = list()
+        for prefix, t_entry in entries.iteritems():
+            lost = [ neighbor for neighbor in t_entry.neighbors
+                     if neighbor.iface in down ]
+            self._drop_neighbors(prefix, t_entry, lost, update_tlvs,
+                                 query_tlvs)
+        self._send_route_changes(update_tlvs, query_tlvs)
+
+    def _iface_metrics_changed(self, phy_ifaces):
+        """Called by the interface sampler with the physical interfaces
+        whose bandwidth, delay, load, reliability or MTU changed. Only the
+        prefixes learned through those interfaces are recomputed."""
+        self.log.info("Metrics changed: {}".format(", ".join([
+                      phy_iface.name for phy_iface in phy_ifaces ])))
+        phy_ifaces = set(phy_ifaces)
+        entries = dict()
+        # The distance through each successor before the change.
+        old_metrics = dict()
+        for rtpiface in self._get_active_ifaces():
+            if rtpiface.logical_iface.phy_iface not in phy_ifaces:
+                continue
+            for prefix, t_entry in self._topology.iface_entries(rtpiface):
+                if prefix not in entries and \
+                   isinstance(t_entry.successor, TopologyNeighborInfo):
+                    old_metrics[prefix] = t_entry.successor.full_metric()
+                entries[prefix] = t_entry
+                for n_info in t_entry.neighbors.itervalues():
+                    if n_info.neighbor.iface is rtpiface:
+                        n_info.update_full_distance()
+                        t_entry.update_neighbor(n_info)
+        if not entries:
+            return
+
+        update_tlvs = list()
+        query_tlvs = list()
+        changed = self._recompute_entries(entries.iteritems(), update_tlvs,
+                                          query_tlvs)
+        # Successors that were kept may be at a new distance, which is
+        # written to the system and advertised.
+        for prefix, old_metric in old_metrics.iteritems():
+            t_entry = entries[prefix]
+            if prefix in changed or t_entry.state != dualfsm.PASSIVE:
+                continue
+            if t_entry.successor.full_metric() != old_metric:
+                self._install_route(prefix, t_entry.successor, update_tlvs)
+        self._send_route_changes(update_tlvs, query_tlvs)
 
     def _new_kvalues(self):
-        """Clear any precomputed metrics in the topology table to force
+        """Invalidate any precomputed metrics in the topology table to force
         the use of the new kvalues."""
         self.log.debug("KValues changed, clearing precomputed metrics.")
-        for prefix, t_entry in self._topology.iteritems():
-            for neighbor in t_entry.neighbors:
-                neighbor.reported_distance.clear_saved_metric()
-                neighbor.full_distance.clear_saved_metric()
+        # Cached metrics are tagged with the K-value generation they were
+        # computed in, so this doesn't need to touch the topology table.
+        rtptlv.ValueClassicMetric.new_kvalue_generation()
+        self._recompute_topology()
+
+    def _recompute_topology(self):
+        """Recompute the metrics and successors of the whole topology table
+        at once. Used when the K-values change."""
+        update_tlvs = list()
+        query_tlvs = list()
+        self._recompute_entries(self._topology.iteritems(), update_tlvs,
+                                query_tlvs)
+        self._send_route_changes(update_tlvs, query_tlvs)
+
+    def _recompute_entries(self, entries, update_tlvs, query_tlvs):
+        """Recompute the metrics and successors of (prefix, TopologyEntry)
+        pairs at once. Changed successors are passed to the FSM, and
+        installed and advertised or queried for. Returns the set of
+        prefixes whose successor changed.
+        update_tlvs - a list that this function will append TLVs to, to be
+                      included in an UPDATE packet
+        query_tlvs - a list that this function will append TLVs to, to be
+                     included in a QUERY packet"""
+        bulk = bulkmetric.BulkMetrics(self._get_kvalues)
+        bulk.load_entries(entries)
+        changed = set()
+        for prefix, t_entry, successor in bulk.recompute():
+            self.log.debug("Successor for {} changed after "
+                           "recompute".format(ipv4.prefix_str(prefix)))
+            changed.add(prefix)
+            actions = t_entry.fsm.handle_successor_change(successor, t_entry)
+            self._apply_successor_actions(prefix, t_entry, actions,
+                                          update_tlvs, query_tlvs)
+        return changed
 
     def _get_kvalues(self):
         return self._k1, self._k2, self._k3, self._k4, self._k5
@@ -144,10 +265,12 @@ class EIGRP(rtp.ReliableTransportProtocol):
             # drop itself (see RTPNeighbor._drop_event).
             local_node = EigrpLocalNode(iface=rtpiface)
 
-            prefix = rtpiface.logical_iface.ip
-            self.log.info("Adding route for {}".format(prefix))
+            network = rtpiface.logical_iface.ip
+            prefix = ipv4.make_prefix(network.network, network.prefixlen)
+            self.log.info("Adding route for "
+                          "{}".format(ipv4.prefix_str(prefix)))
             metric = rtptlv.ValueClassicMetric(0, 0, 0, 0, 255, 0, 0, 0)
-            if prefix in self._topology.values():
+            if prefix in self._topology:
                 self.log.info("Prefix was already in topology table. "
                               "Skipping.")
                 continue
@@ -185,20 +308,37 @@ class EIGRP(rtp.ReliableTransportProtocol):
         self.log.debug("Processing UPDATE")
         query_tlvs = list()
         update_tlvs = list()
+
+        # Collect the routes into columns first. RTP builds TLVs lazily, so
+        # this reads them straight from the packet without creating TLV
+        # objects for every route. Initial table sync with a large
+        # neighbor is mostly UPDATEs full of these.
+        routes = rtptlv.Internal4Columns()
         for tlv in tlvs:
             if tlv.type == rtptlv.TLVInternal4.TYPE:
-                self._op_update_handler_tlvinternal4(neighbor,
-                                                     hdr,
-                                                     tlv,
-                                                     query_tlvs,
-                                                     update_tlvs)
+                routes.append_tlv(tlv)
             else:
                 self.log.debug("Unexpected TLV type: {}".format(tlv))
                 return
+        for index in xrange(len(routes)):
+            self._op_update_handler_internal4(neighbor,
+                                              hdr,
+                                              routes,
+                                              index,
+                                              query_tlvs,
+                                              update_tlvs)
+
+        if update_tlvs:
+            # New successors were installed.
+            self._fib.when_written().addCallback(self._routes_written,
+                                                 neighbor)
+
+        self._send_route_changes(update_tlvs, query_tlvs)
 
-        # Send UPDATE and/or QUERY if necessary.
+    def _send_route_changes(self, update_tlvs, query_tlvs):
+        """Send UPDATE and/or QUERY if necessary."""
         self.log.debug("Update TLVs to send: {}".format(update_tlvs))
-        self.log.debug("Query TLVs to send: {}".format(update_tlvs))
+        self.log.debug("Query TLVs to send: {}".format(query_tlvs))
         if update_tlvs:
             self._send(dsts=self._get_active_ifaces(),
                        opcode=self._rtphdr.OPC_UPDATE,
@@ -210,91 +350,62 @@ class EIGRP(rtp.ReliableTransportProtocol):
                        tlvs=query_tlvs,
                        ack=True)
 
-    def _op_update_handler_tlvinternal4(self, neighbor, hdr, tlv, query_tlvs,
-                                        update_tlvs):
-        """Handle an IPv4 Internal TLV within an UPDATE packet.
+    def _routes_written(self, failed, neighbor):
+        """Called with the routes that failed to install once the routes
+        learned from an UPDATE have been written to the system."""
+        if failed:
+            self.log.warning("{} route changes failed after UPDATE from "
+                             "{}".format(len(failed), neighbor.ip.exploded))
+
+    def _op_update_handler_internal4(self, neighbor, hdr, routes, index,
+                                     query_tlvs, update_tlvs):
+        """Handle one IPv4 Internal route within an UPDATE packet.
         neighbor - RTP neighbor that sent the update
         hdr - the RTP header
-        tlv - the IPv4 Internal Route TLV
+        routes - the rtptlv.Internal4Columns holding the packet's routes
+        index - the index of the route in routes
         query_tlvs - a list that this function will append TLVs to, to be
                      included in a QUERY packet
         update_tlvs - a list that this function will append TLVs to, to be
                       included in an UPDATE packet"""
         # XXX hdr unused.
-        prefix = ipaddr.IPv4Network("{}/{}".format(tlv.dest.addr.exploded,
-                                                   tlv.dest.plen))
+        prefix = ipv4.make_prefix(routes.prefix[index], routes.plen[index])
 
-        # All zeroes means use the source address of the incoming packet.
-        if tlv.nexthop.ip.exploded == "0.0.0.0":
-            nexthop = neighbor.ip.exploded
-        else:
-            nexthop = tlv.nexthop.ip.exploded
+        t_entry = self._topology.update_prefix(prefix)
 
-        try:
-            t_entry = self._topology[prefix]
-        except KeyError:
-            # New prefix.
-            self._topology[prefix] = TopologyEntry(prefix,
-                                                   self._get_kvalues)
-            t_entry = self._topology[prefix]
-
-        # Prefix is already in topology table. Pass to FSM.
+        # Prefix is now in topology table. Pass to FSM.
         # XXX TODO for PDM architecture: assumes IPv4.
-        if tlv.nexthop.ip.exploded == "0.0.0.0":
+        nexthop = routes.nexthop[index]
+        if not nexthop:
             # All zeroes means use the source address of the incoming packet.
-            nexthop = neighbor.ip.exploded
-        else:
-            nexthop = tlv.nexthop.ip.exploded
+            nexthop = int(neighbor.ip)
 
+        # The FSM compares the metric's fields straight from the packet's
+        # columns. A metric object is only built for the TLVs of routes
+        # that are installed or advertised.
         actions = t_entry.fsm.handle_update(neighbor,
                                             nexthop,
-                                            tlv.metric,
+                                            routes.fields(index),
                                             t_entry,
                                             self._get_kvalues)
-        for action, data in actions:
-            if action == dualfsm.NO_OP:
-                continue
-            elif action == dualfsm.INSTALL_SUCCESSOR:
-                # Use this neighbor as the successor.
-                successor = data
-                self.log.debug("Installing new successor for prefix {}: "
-                               "{}".format(prefix.exploded, successor))
-                t_entry.successor = t_entry.get_neighbor(neighbor)
-                tlv.metric.update_for_iface(neighbor.iface)
-                total_metric = tlv.metric.compute_metric(self._k1,
-                                                         self._k2,
-                                                         self._k3,
-                                                         self._k4,
-                                                         self._k5)
-                tlv.nexthop.ip = ipaddr.IPv4Address("0.0.0.0")
-                try:
-                    # Uninstall route to old nexthop, if one existed.
-                    # XXX Should know in advance whether this is required or
-                    # not.
-                    self._sys.uninstall_route(net=prefix.network.exploded,
-                                              plen=prefix.prefixlen)
-                except ValueError:
-                    pass
-                self._sys.install_route(net=prefix.network.exploded,
-                                        plen=prefix.prefixlen,
-                                        metric=total_metric,
-                                        nexthop=nexthop)
-                update_tlvs.append(tlv)
-            elif action == dualfsm.UNINSTALL_SUCCESSOR:
-                # XXX Stop using route for routing.
-                pass
-            elif action == dualfsm.SEND_QUERY:
-                # Include this TLV in a QUERY packet.
-                # Reuse this TLV instead of creating another one. Change
-                # the metric's delay field to indicate an unreachable prefix.
-                self.log.debug("Including prefix {} in QUERY "
-                               "packet".format(prefix.exploded))
-                tlv.metric.dly = tlv.metric.METRIC_UNREACHABLE
-                query_tlvs.append(tlv)
-            else:
-                assert False, "Unknown action returned by fsm: " \
-                       "{}".format(action)
-        return
+        self._apply_successor_actions(prefix, t_entry, actions, update_tlvs,
+                                      query_tlvs)
+
+    @staticmethod
+    def _make_tlvinternal4(metric, prefix):
+        """Return a TLVInternal4 advertising prefix (an ipv4 prefix key)
+        with ourselves as the next hop."""
+        return rtptlv.TLVInternal4(0,
+                                   metric.dly,
+                                   metric.bw,
+                                   metric.mtu,
+                                   metric.hops,
+                                   metric.rel,
+                                   metric.load,
+                                   metric.tag,
+                                   metric.flags,
+                                   prefix[1],
+                                   prefix[0])
 
     def _eigrp_op_handler_query(self, neighbor, hdr, tlvs):
         self.log.debug("Processing QUERY")
@@ -329,8 +440,7 @@ class EIGRP(rtp.ReliableTransportProtocol):
         # packet, if the router believes it has an alternate feasible
         # successor. The REPLY packet will include a TLV for each destination
         # and the associated vectorized metric in its own topology table.
-        prefix = ipaddr.IPv4Network("{}/{}".format(tlv.dest.exploded,
-                                                   tlv.plen))
+        prefix = ipv4.make_prefix(tlv.dest.addr, tlv.dest.plen)
 
         try:
             t_entry = self._topology[prefix]
@@ -382,8 +492,7 @@ class EIGRP(rtp.ReliableTransportProtocol):
         hdr - the RTP header
         tlv - the IPv4 Internal Route TLV"""
         # XXX hdr unused.
-        prefix = ipaddr.IPv4Network("{}/{}".format(tlv.dest.exploded,
-                                                   tlv.plen))
+        prefix = ipv4.make_prefix(tlv.dest.addr, tlv.dest.plen)
         try:
             t_entry = self._topology[prefix]
         except KeyError:
@@ -391,7 +500,7 @@ class EIGRP(rtp.ReliableTransportProtocol):
             # New prefix, shouldn't normally happen... but what do
             # we do if it does?  Let's just ignore it.
             self.log.warn("Ignoring TLV in REPLY that contains unknown "
-                          "prefix: {},".format(prefix))
+                          "prefix: {},".format(ipv4.prefix_str(prefix)))
             return
 
         actions = t_entry.handle_reply(neighbor, nexthop, t_entry)
@@ -447,13 +556,21 @@ class EIGRP(rtp.ReliableTransportProtocol):
         # We don't join the multicast group on non-active
         # interfaces, so we shouldn't form adjacencies on non-active
         # interfaces. This is good.
-        reactor.listenIP(88, self)
+        # The input interface of each packet is read from the kernel where
+        # possible, rather than guessed from the source address. Packets
+        # that arrive together, e.g. UPDATEs from several neighbors during
+        # initial table exchange, are read with one recvmmsg call and
+        # handed to RTP's datagramsReceived as a batch. Reading IP_PKTINFO
+        # a packet at a time costs more than the batch read does.
+        reactor.listenIP(88, self, pktinfo=True, batchSize=32)
         self.log.info("EIGRP is starting up...")
         reactor.run()
 
     def _cleanup(self):
         # XXX Add cleanup for routes when we have any to remove
         self.log.info("Cleaning up.")
+        self._iface_sampler.stop()
+        self._fib.stop()
         self._sys.cleanup()
 
     def startProtocol(self):
@@ -469,23 +586,14 @@ class EIGRP(rtp.ReliableTransportProtocol):
         self.log.info("Init received from {}".format(neighbor.ip.exploded))
         tlvs = list()
         for t_entry in self._topology.itervalues():
-            self.log.debug("Processing t_entry for {}".format(t_entry.prefix))
+            self.log.debug("Processing t_entry for "
+                           "{}".format(ipv4.prefix_str(t_entry.prefix)))
             if t_entry.successor == t_entry.NO_SUCCESSOR:
                 self.log.debug("No successor, skipping")
                 continue
 
-            # XXX These TLV classes are awful and need to be redone.
-            tlvs.append(rtptlv.TLVInternal4("0.0.0.0",
-                                       t_entry.successor.full_distance.dly,
-                                       t_entry.successor.full_distance.bw,
-                                       t_entry.successor.full_distance.mtu,
-                                       t_entry.successor.full_distance.hops,
-                                       t_entry.successor.full_distance.rel,
-                                       t_entry.successor.full_distance.load,
-                                       t_entry.successor.full_distance.tag,
-                                       t_entry.successor.full_distance.flags,
-                                       t_entry.prefix.prefixlen,
-                                       t_entry.prefix.network.exploded))
+            tlvs.append(self._make_tlvinternal4(t_entry.successor.full_distance,
+                                                t_entry.prefix))
             self.log.info("Added TLV...")
         if not tlvs:
             self.log.info("No TLVs to advertise")
@@ -500,6 +608,110 @@ class EIGRP(rtp.ReliableTransportProtocol):
 
     def lostNeighbor(self, neighbor):
         self.log.info("Lost neighbor {}".format(neighbor.ip.exploded))
+        update_tlvs = list()
+        query_tlvs = list()
+        for prefix, t_entry in self._topology.neighbor_entries(neighbor):
+            self._drop_neighbors(prefix, t_entry, [ neighbor ], update_tlvs,
+                                 query_tlvs)
+        self._send_route_changes(update_tlvs, query_tlvs)
+
+    def _drop_neighbors(self, prefix, t_entry, neighbors, update_tlvs,
+                        query_tlvs):
+        """Forget what the given neighbors reported for prefix. If one of
+        them was the successor, it is replaced with a feasible successor or
+        queried for, and the entry is removed if no neighbors are left.
+        update_tlvs - a list that this function will append TLVs to, to be
+                      included in an UPDATE packet
+        query_tlvs - a list that this function will append TLVs to, to be
+                     included in a QUERY packet"""
+        lost_successor = False
+        # All of them are removed first, so none of them are chosen as a
+        # feasible successor.
+        for neighbor in neighbors:
+            n_info = t_entry.remove_neighbor(neighbor)
+            if t_entry.successor is n_info:
+                lost_successor = True
+        if lost_successor:
+            self._replace_lost_successor(prefix, t_entry, update_tlvs,
+                                         query_tlvs)
+        # An active entry is kept, so the replies to its query find it.
+        if not t_entry.neighbors and t_entry.state == dualfsm.PASSIVE:
+            del self._topology[prefix]
+
+    def _replace_lost_successor(self, prefix, t_entry, update_tlvs,
+                                query_tlvs):
+        """Switch prefix to its best feasible successor after losing its
+        successor. If it has none, the FSM makes the route active and it is
+        queried for.
+        update_tlvs - a list that this function will append TLVs to, to be
+                      included in an UPDATE packet
+        query_tlvs - a list that this function will append TLVs to, to be
+                     included in a QUERY packet"""
+        self.log.debug("Lost successor for prefix "
+                       "{}".format(ipv4.prefix_str(prefix)))
+        fs = t_entry.get_feasible_successor()
+        if not fs:
+            fs = t_entry.NO_SUCCESSOR
+        actions = t_entry.fsm.handle_successor_change(fs, t_entry)
+        self._apply_successor_actions(prefix, t_entry, actions, update_tlvs,
+                                      query_tlvs)
+
+    def _install_route(self, prefix, n_info, update_tlvs):
+        """Write the route to prefix through n_info to the system, replacing
+        the route to any old nexthop, and append a TLV advertising it to
+        update_tlvs."""
+        if n_info.nexthop is None:
+            # The local router, i.e. a connected network, which the system
+            # routes by itself.
+            self._fib.uninstall_route(net=prefix[0], plen=prefix[1])
+        else:
+            self._fib.modify_route(net=prefix[0],
+                                   plen=prefix[1],
+                                   metric=min(n_info.full_metric(),
+                                              self.FIB_METRIC_MAX),
+                                   nexthop=n_info.nexthop)
+        update_tlvs.append(self._make_tlvinternal4(n_info.full_distance,
+                                                   prefix))
+
+    def _apply_successor_actions(self, prefix, t_entry, actions, update_tlvs,
+                                 query_tlvs):
+        """Carry out the actions returned by the FSM for a new or changed
+        successor, whether it came from an UPDATE or from losing a neighbor
+        or recomputing metrics.
+        update_tlvs - a list that this function will append TLVs to, to be
+                      included in an UPDATE packet
+        query_tlvs - a list that this function will append TLVs to, to be
+                     included in a QUERY packet"""
+        for action, data in actions:
+            if action == dualfsm.NO_OP:
+                continue
+            elif action == dualfsm.INSTALL_SUCCESSOR:
+                n_info = t_entry.get_neighbor(data)
+                self.log.debug("Installing new successor for prefix {}: "
+                               "{}".format(ipv4.prefix_str(prefix),
+                                           data.ip.exploded))
+                t_entry.successor = n_info
+                self._install_route(prefix, n_info, update_tlvs)
+            elif action == dualfsm.UNINSTALL_SUCCESSOR:
+                self.log.debug("Removing route for prefix "
+                               "{}".format(ipv4.prefix_str(prefix)))
+                t_entry.successor = t_entry.NO_SUCCESSOR
+                self._fib.uninstall_route(net=prefix[0], plen=prefix[1])
+            elif action == dualfsm.SEND_QUERY:
+                # Include this prefix in a QUERY packet, with the distance
+                # through the old successor and the delay field changed to
+                # indicate an unreachable prefix.
+                self.log.debug("Including prefix {} in QUERY "
+                               "packet".format(ipv4.prefix_str(prefix)))
+                if isinstance(t_entry.successor, TopologyNeighborInfo):
+                    metric = t_entry.successor.full_distance
+                else:
+                    metric = rtptlv.ValueClassicMetric(0, 0, 0, 0, 0, 0, 0, 0)
+                metric.dly = metric.METRIC_UNREACHABLE
+                query_tlvs.append(self._make_tlvinternal4(metric, prefix))
+            else:
+                assert False, "Unknown action returned by fsm: " \
+                       "{}".format(action)
 
     def rtpReceived(self, neighbor, hdr, tlvs):
         try:
@@ -549,6 +761,10 @@ def parse_args(argv):
     op.add_option("-t", "--hello-interval", type="int", default=5,
                   help="Use non-default hello timer. Hold time is 3 times the"
                   " value given here. 5 sec by default.")
+    op.add_option("-w", "--window-size", type="int",
+                  default=rtp.ReliableTransportProtocol.DEFAULT_WINDOW_SIZE,
+                  help="Number of unacknowledged reliable packets allowed "
+                  "in flight to each neighbor. 1 by default.")
     options, arguments = op.parse_args(argv)
 
     if not options.interface:
@@ -599,6 +815,7 @@ def main(argv):
                       port=options.admin_port,
                       kvalues=options.kvalues,
                       hello_interval=options.hello_interval,
+                      window_size=options.window_size,
                       system=system,
                       logconfig=options.log_config,
                       rid=options.router_id,
@@ -24,6 +24,9 @@ import pprint
 import inspect
 import logging
 import traceback
+import ipaddr
+
+import ipv4
 
 class EIGRPAdminProtocol(LineReceiver):
     """Network accessible administrative interface for the EIGRPAdminCLI."""
@@ -67,8 +70,70 @@ class RootShowRtpCmd(EigrpCmd):
         for iface in self.eigrpinstance._ifaces:
             self.stdout.write("Neighbors on interface {} ({}):\n".format(iface.logical_iface.ip.exploded,
                                                                          iface.logical_iface.phy_iface.name))
+            self.stdout.write("    {:<16}{:>10}{:>10}{:>7}\n".format("Address",
+                                                                 "SRTT (ms)",
+                                                                 "RTO (ms)",
+                                                                 "Q Cnt"))
+            for neighbor in iface.get_all_neighbors():
+                if neighbor.srtt is None:
+                    srtt = "-"
+                else:
+                    srtt = int(neighbor.srtt * 1000)
+                self.stdout.write("    {:<16}{:>10}{:>10}{:>7}\n".format(neighbor.ip.exploded,
+                                                                     srtt,
+                                                                     int(neighbor.rto * 1000),
+                                                                     neighbor.queue_depth()))
+
+    def do_queues(self, line):
+        """Show transmit queue depth and counters for each neighbor"""
+        fmt = "    {:<16}{:>6}{:>9}{:>7}{:>9}{:>9}{:>8}{:>8}{:>6}\n"
+        for iface in self.eigrpinstance._ifaces:
+            self.stdout.write("Queues on interface {} ({}):\n".format(iface.logical_iface.ip.exploded,
+                                                                      iface.logical_iface.phy_iface.name))
+            self.stdout.write(fmt.format("Neighbor", "Q Cnt", "InFlight",
+                                         "Max Q", "Sent", "Retrans",
+                                         "Acks", "Dupes", "Held"))
             for neighbor in iface.get_all_neighbors():
-                self.stdout.write("    {}\n".format(neighbor.ip.exploded))
+                self.stdout.write(fmt.format(neighbor.ip.exploded,
+                                             neighbor.queue_depth(),
+                                             neighbor.inflight(),
+                                             neighbor.max_queue_depth,
+                                             neighbor.pkts_sent,
+                                             neighbor.pkts_retransmitted,
+                                             neighbor.acks_received,
+                                             neighbor.dupes_received,
+                                             neighbor.held()))
+
+
+class RootShowEigrpCmd(EigrpCmd):
+    def do_topology(self, line):
+        """Show the topology table
+        Usage: topology [PREFIX/LEN]
+        If a prefix is given, only show it and the prefixes within it."""
+        topology = self.eigrpinstance._topology
+        if line.strip():
+            try:
+                addr, plen = line.strip().split("/")
+                entries = topology.iter_subtree(ipv4.make_prefix(addr,
+                                                                 int(plen)))
+            except ValueError:
+                self.stdout.write("Invalid prefix: {}\n".format(line))
+                return
+        else:
+            entries = topology.iteritems()
+        fmt = "    {:<20}{:<16}{:>10}\n"
+        self.stdout.write(fmt.format("Prefix", "Successor", "Neighbors"))
+        for prefix, t_entry in entries:
+            # The topology table is keyed by integers. Only build ipaddr
+            # objects here, for display.
+            network = ipaddr.IPv4Network(ipv4.prefix_str(prefix))
+            if t_entry.successor == t_entry.NO_SUCCESSOR:
+                successor = "-"
+            else:
+                successor = t_entry.successor.neighbor.ip.exploded
+            self.stdout.write(fmt.format(network.with_prefixlen,
+                                         successor,
+                                         len(t_entry.neighbors)))
 
 
 class RootShowCmd(EigrpCmd):
@@ -80,7 +145,7 @@ class RootShowCmd(EigrpCmd):
 
     def do_eigrp(self, line):
         """Subcommands for EIGRP proper"""
-        pass
+        RootShowEigrpCmd(self.eigrpinstance, stdin=self.stdin, stdout=self.stdout).onecmd(line)
 
     def do_handlers(self, line):
         """Show debug handlers."""
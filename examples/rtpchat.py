@@ -6,6 +6,7 @@ that this implementation of RTP is decoupled from EIGRP."""
 import Tkinter
 import tkMessageBox
 import sys
+import struct
 from twisted.internet import tksupport
 
 sys.path.append("..")
@@ -232,11 +233,14 @@ class ValueText(rtptlv.ValueBase):
     def pack(self):
         return self.text
 
-    def unpack(self, raw):
-        return raw
+    def unpack(self, raw, offset=0, end=None):
+        if end is None:
+            end = len(raw)
+        return struct.unpack_from("%ds" % (end - offset), raw, offset)[0]
 
     def _parse_kwargs(self, kwargs):
-        self.text = self.unpack(kwargs["raw"])
+        self.text = self.unpack(kwargs["raw"], kwargs.get("offset", 0),
+                                kwargs.get("end"))
 
     def _parse_args(self, args):
         if len(args) != 1:
@@ -0,0 +1,448 @@
+#!/usr/bin/env python
+
+"""Batched writes to the system routing table.
+
+During convergence EIGRP can change the routes to thousands of prefixes in
+a burst, often changing the same prefix more than once. FibWriter sits
+between EIGRP and the sysiface system object: route changes are queued,
+a newer change to a prefix replaces any queued change to it, and the queue
+is written with a single _System.apply_routes call once it holds
+batch_size prefixes or interval seconds after the first change was
+queued. On Linux that is a few multi-message netlink datagrams (or one
+"ip -batch" run) instead of one write per change.
+
+Usage matches the route methods of _System:
+
+    fib = FibWriter(system, reactor, worker=FibWorker(system, reactor))
+    fib.modify_route(net, plen, metric, nexthop)
+    fib.uninstall_route(net, plen)
+    fib.when_written().addCallback(report_failures)
+
+Failed writes are logged rather than raised, since they happen after the
+caller has moved on. If writing a batch raises, its changes are queued
+again. when_written and flush return Deferreds that fire with
+the changes that failed once the changes queued so far are written.
+
+Without a worker, batches are written from the reactor thread. A slow
+kernel then holds up everything else the reactor does, including RTP's
+hellos and ACKs. A FibWorker writes batches from a thread of its own
+instead. It takes a bounded number of batches at a time; while it is full,
+changes stay in the FibWriter's queue, where newer changes to a prefix
+still replace older ones. stats() reports how often that happens.
+
+FibWriter also keeps a shadow of the system table, so changes that would
+leave a route as it is aren't written at all. At startup, reconcile loads
+it with the routes a previous run left behind."""
+
+# Python-EIGRP (http://python-eigrp.googlecode.com)
+# Copyright (C) 2013 Patrick F. Allen
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import os
+import time
+import errno
+import Queue
+import logging
+import threading
+
+from twisted.internet import defer
+from twisted.python import failure
+
+import ipv4
+
+log = logging.getLogger("System")
+
+class FibWriter(object):
+    """Queues route changes and writes them to the system in batches."""
+
+    DEFAULT_BATCH_SIZE = 1000
+    DEFAULT_INTERVAL   = .05
+
+    # Queued in place of (metric, nexthop) to uninstall a route.
+    UNINSTALL = None
+
+    def __init__(self, system, clock, batch_size=DEFAULT_BATCH_SIZE,
+                 interval=DEFAULT_INTERVAL, worker=None):
+        """system - the sysiface system object routes are written to
+        clock - An object providing seconds() and callLater(), usually the
+                reactor
+        batch_size - Write the queue as soon as it holds this many prefixes
+        interval - Write the queue at most this many seconds after the first
+                   change to it
+        worker - A FibWorker to write batches with. If None, batches are
+                 written by calling system.apply_routes directly."""
+        if batch_size < 1:
+            raise(ValueError("batch_size must be at least 1."))
+        self._sys = system
+        self._clock = clock
+        self._batch_size = batch_size
+        self._interval = interval
+        self._worker = worker
+
+        # Prefix -> (metric, nexthop) or UNINSTALL, for the next batch.
+        self._pending = dict()
+        self._first_queued = None
+        self._flush_event = None
+
+        # Deferreds to fire when the next batch is written, and when the
+        # last batch given to the worker is written.
+        self._waiters = list()
+        self._last_waiters = None
+
+        # Batches given to the worker and not yet written.
+        self._inflight = 0
+
+        # True if a flush found the worker full. The queue is then written
+        # as soon as the worker finishes a batch.
+        self._stalled = False
+
+        # Prefix -> (metric, nexthop) for every route in the system table
+        # or in a batch that is being written. This is the system table as
+        # far as we know it. A prefix maps to None if a write to it failed,
+        # since whether it has a route is then unknown.
+        self._installed = dict()
+
+        # Prefixes passed to reconcile that haven't been changed since.
+        self._stale = set()
+
+        # Totals since startup, plus figures for the last batch. See stats.
+        self._batches = 0
+        self._ops = 0
+        self._coalesced = 0
+        self._unchanged = 0
+        self._removed_stale = 0
+        self._failed = 0
+        self._requeued = 0
+        self._stalls = 0
+        self._max_pending = 0
+        self._write_time = 0.
+        self._last_ops = 0
+        self._last_latency = 0.
+        self._last_delay = 0.
+        self._last_queue_wait = 0.
+        self._max_latency = 0.
+
+    def __len__(self):
+        """Return the number of prefixes waiting to be written."""
+        return len(self._pending)
+
+    def install_route(self, net, plen, metric, nexthop):
+        """Queue a route, replacing any route to the prefix. Arguments are as
+        for sysiface._System.modify_route."""
+        prefix = net, plen
+        op = metric, nexthop
+        if self._installed.get(prefix) == op:
+            # Already installed, so drop anything queued that would change
+            # it.
+            self._stale.discard(prefix)
+            if prefix in self._pending:
+                del self._pending[prefix]
+                self._coalesced += 1
+            else:
+                self._unchanged += 1
+            return
+        self._queue(prefix, op)
+
+    modify_route = install_route
+
+    def uninstall_route(self, net, plen):
+        """Queue removal of the route to a prefix."""
+        prefix = net, plen
+        if prefix not in self._installed:
+            # There's no route to remove, though one may be queued.
+            if prefix in self._pending:
+                del self._pending[prefix]
+                self._coalesced += 2
+            return
+        self._queue(prefix, self.UNINSTALL)
+
+    def _queue(self, prefix, op):
+        self._stale.discard(prefix)
+        if prefix in self._pending:
+            self._coalesced += 1
+        elif not self._pending:
+            self._first_queued = self._clock.seconds()
+        self._pending[prefix] = op
+        self._max_pending = max(self._max_pending, len(self._pending))
+        if self._stalled:
+            # Written when the worker has room.
+            return
+        if len(self._pending) >= self._batch_size:
+            self.flush()
+        elif self._flush_event is None:
+            self._flush_event = self._clock.callLater(self._interval,
+                                                      self.flush)
+
+    def when_written(self):
+        """Return a Deferred that fires once every change queued so far has
+        been written. Its result is a list of (prefix, errno) for the
+        changes in the last batch that failed. This doesn't make the queue
+        get written any sooner."""
+        d = defer.Deferred()
+        if self._pending:
+            self._waiters.append(d)
+        elif self._last_waiters is not None:
+            self._last_waiters.append(d)
+        else:
+            d.callback(list())
+        return d
+
+    def flush(self):
+        """Write every queued change now, or as soon as the worker has room
+        if it is full. Returns a Deferred as for when_written."""
+        event, self._flush_event = self._flush_event, None
+        if event is not None and event.active():
+            event.cancel()
+        d = self.when_written()
+        if not self._pending:
+            return d
+        if self._worker and self._worker.full():
+            if not self._stalled:
+                self._stalls += 1
+                self._stalled = True
+            return d
+        self._stalled = False
+
+        pending, self._pending = self._pending, dict()
+        waiters, self._waiters = self._waiters, list()
+        first_queued = self._first_queued
+        ops = list()
+        for prefix, op in pending.iteritems():
+            if op is self.UNINSTALL:
+                ops.append(prefix + (None, None))
+                self._installed.pop(prefix, None)
+            else:
+                ops.append(prefix + op)
+                self._installed[prefix] = op
+
+        if not self._worker:
+            start = time.time()
+            try:
+                result = (self._sys.apply_routes(ops), 0.,
+                          time.time() - start)
+            except Exception:
+                result = self._write_failed(failure.Failure(), ops)
+            failed = self._written(result, ops, first_queued)
+            for waiter in waiters:
+                waiter.callback(failed)
+            return d
+
+        self._inflight += 1
+        self._last_waiters = waiters
+        batch = self._worker.submit(ops)
+        batch.addErrback(self._write_failed, ops)
+        batch.addCallback(self._written, ops, first_queued)
+        batch.addCallback(self._fire_waiters, waiters)
+        return d
+
+    def _write_failed(self, fail, ops):
+        """Called when writing a batch raised. Which of its changes were
+        made isn't known, so they are all reported as failed, and queued to
+        be written again unless a newer change to the prefix is queued
+        already."""
+        log.error("Failed to write {} route changes, queueing them "
+                  "again: {}".format(len(ops), fail.getErrorMessage()))
+        for net, plen, metric, nexthop in ops:
+            prefix = net, plen
+            if prefix in self._pending:
+                continue
+            if not self._pending:
+                self._first_queued = self._clock.seconds()
+            if metric is None:
+                self._pending[prefix] = self.UNINSTALL
+            else:
+                self._pending[prefix] = metric, nexthop
+            self._requeued += 1
+        self._max_pending = max(self._max_pending, len(self._pending))
+        # Written after the interval rather than straight away, so a system
+        # that keeps failing isn't retried in a loop. A stalled queue is
+        # written when the worker has room.
+        if self._pending and self._flush_event is None and not self._stalled:
+            self._flush_event = self._clock.callLater(self._interval,
+                                                      self.flush)
+        return [errno.EIO] * len(ops), 0., 0.
+
+    def _written(self, result, ops, first_queued):
+        """Update the installed prefixes and the stats after a batch has
+        been written. Returns the failed changes as (prefix, errno)."""
+        errors, queue_wait, latency = result
+        failed = list()
+        for (net, plen, metric, nexthop), err in zip(ops, errors):
+            if not err or (metric is None and err == errno.ESRCH):
+                continue
+            prefix = net, plen
+            self._installed[prefix] = None
+            failed.append((prefix, err))
+            log.warning("Failed to {} route to {}: {}".format(
+                "uninstall" if metric is None else "install",
+                ipv4.prefix_str(prefix),
+                os.strerror(err)))
+
+        self._batches += 1
+        self._ops += len(ops)
+        self._failed += len(failed)
+        self._write_time += latency
+        self._last_ops = len(ops)
+        self._last_latency = latency
+        self._last_delay = self._clock.seconds() - first_queued
+        self._last_queue_wait = queue_wait
+        self._max_latency = max(self._max_latency, latency)
+        log.debug("Wrote {} route changes in {:.1f} ms ({:.0f} changes/s), "
+                  "{} failed".format(len(ops), latency * 1000,
+                                     len(ops) / latency if latency else 0,
+                                     len(failed)))
+        return failed
+
+    def _fire_waiters(self, failed, waiters):
+        self._inflight -= 1
+        if self._last_waiters is waiters:
+            self._last_waiters = None
+        for waiter in waiters:
+            waiter.callback(failed)
+        if self._stalled:
+            self.flush()
+
+    def reconcile(self, routes):
+        """Start from the routes already in the system table, as returned
+        by _System.get_installed_routes. Changes that match them aren't
+        written, and any of them that haven't been changed or confirmed by
+        the time end_reconcile is called are removed. After a restart this
+        leaves the routes that are still valid in place, instead of
+        removing and adding them all again."""
+        self._installed.update(routes)
+        self._stale.update(routes)
+        log.info("{} routes already installed".format(len(routes)))
+
+    def end_reconcile(self):
+        """Remove the routes passed to reconcile that haven't been learned
+        again since. Returns the number of routes removed."""
+        stale, self._stale = self._stale, set()
+        for prefix in stale:
+            self.uninstall_route(*prefix)
+        self._removed_stale += len(stale)
+        log.info("Removing {} stale routes".format(len(stale)))
+        return len(stale)
+
+    def stop(self):
+        """Write everything that is queued and stop the worker. This blocks
+        until the writes are done, so it's only for use when exiting."""
+        if self._worker:
+            self._worker.stop()
+            self._worker = None
+            self._stalled = False
+        self.flush()
+
+    def stats(self):
+        """Return a dict of counters:
+        batches - batches written
+        ops - route changes written
+        coalesced - changes dropped because a newer change to the same
+                    prefix replaced them before they were written
+        unchanged - changes dropped because the route was already installed
+        stale - routes removed by end_reconcile
+        failed - changes the system refused
+        requeued - changes queued again because writing their batch raised
+        ops_per_sec - changes written per second spent writing
+        pending - prefixes waiting to be written
+        max_pending - the most prefixes that have been waiting at once
+        inflight - batches given to the worker and not yet written
+        stalls - times the queue was ready to be written but the worker
+                 was full
+        last_batch_ops - changes in the last batch
+        last_batch_latency - seconds spent writing the last batch
+        last_batch_delay - seconds from the first change in the last batch
+                           being queued to the batch being written
+        last_batch_queue_wait - seconds the last batch waited for the
+                                worker
+        max_batch_latency - the longest time spent writing one batch
+        """
+        return { "batches"               : self._batches,
+                 "ops"                   : self._ops,
+                 "coalesced"             : self._coalesced,
+                 "unchanged"             : self._unchanged,
+                 "stale"                 : self._removed_stale,
+                 "failed"                : self._failed,
+                 "requeued"              : self._requeued,
+                 "ops_per_sec"           : self._ops / self._write_time
+                                           if self._write_time else 0.,
+                 "pending"               : len(self._pending),
+                 "max_pending"           : self._max_pending,
+                 "inflight"              : self._inflight,
+                 "stalls"                : self._stalls,
+                 "last_batch_ops"        : self._last_ops,
+                 "last_batch_latency"    : self._last_latency,
+                 "last_batch_delay"      : self._last_delay,
+                 "last_batch_queue_wait" : self._last_queue_wait,
+                 "max_batch_latency"     : self._max_latency,
+               }
+
+
+class FibWorker(object):
+    """Writes batches of route changes to the system from a thread of its
+    own, so the reactor isn't blocked while the kernel absorbs them.
+
+    Once the worker is started, system.apply_routes must only be called
+    through it."""
+
+    DEFAULT_MAX_BATCHES = 4
+
+    def __init__(self, system, reactor, max_batches=DEFAULT_MAX_BATCHES):
+        """system - the sysiface system object routes are written to
+        reactor - the reactor to report results through
+        max_batches - the most batches that can be waiting to be written,
+                      including the one being written"""
+        self._sys = system
+        self._reactor = reactor
+        self._queue = Queue.Queue(max_batches)
+        self._thread = threading.Thread(target=self._run, name="FIB writer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def full(self):
+        """Return True if no more batches can be submitted right now."""
+        return self._queue.full()
+
+    def submit(self, ops):
+        """Queue a list of changes, as for _System.apply_routes. Returns a
+        Deferred that fires with (errors, queue_wait, latency) once they are
+        written: the result of apply_routes, the seconds the batch waited
+        for the worker, and the seconds spent writing it. Raises Queue.Full
+        if the worker is full."""
+        d = defer.Deferred()
+        self._queue.put_nowait((ops, d, time.time()))
+        return d
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            ops, d, queued = item
+            start = time.time()
+            try:
+                errors = self._sys.apply_routes(ops)
+            except Exception:
+                self._reactor.callFromThread(d.errback, failure.Failure())
+                continue
+            self._reactor.callFromThread(d.callback,
+                                         (errors, start - queued,
+                                          time.time() - start))
+
+    def stop(self):
+        """Wait for the queued batches to be written, then stop the
+        thread."""
+        self._queue.put(None)
+        self._thread.join()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+
+"""Interface metrics measured from the system.
+
+EIGRP's metric is built from each interface's bandwidth, delay, load,
+reliability and MTU. InterfaceSampler reads every interface's link speed,
+MTU and traffic counters from the system at a fixed interval, and sets the
+interfaces' metrics from them:
+
+    bandwidth   - 10^7 divided by the link speed in kbit/s
+    delay       - from the link speed, 10 (100 microseconds) at 100 Mbit/s
+    load        - the output rate as a fraction of the link speed, from 1 to
+                  255
+    reliability - the fraction of packets sent and received without error,
+                  from 1 to 255
+    mtu         - the link's MTU
+
+Load and reliability are exponentially weighted moving averages of the
+rate over each interval, so a short burst doesn't change the metric much.
+Any change in them means every metric learned through the interface has to
+be recomputed, so an interface's load or reliability is only changed once
+its average has moved by at least a threshold. The interfaces whose metrics
+changed in a sample are passed to a callback together:
+
+    sampler = InterfaceSampler(system, reactor, metrics_changed)
+    sampler.start()
+
+Interfaces whose speed or counters the system doesn't report keep their
+previous metrics, which are the PhysicalInterface defaults until
+sampled."""
+
+# Python-EIGRP (http://python-eigrp.googlecode.com)
+# Copyright (C) 2013 Patrick F. Allen
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import logging
+
+log = logging.getLogger("System")
+
+MIN_LOAD        = 1
+MAX_LOAD        = 255
+MIN_RELIABILITY = 1
+MAX_RELIABILITY = 255
+
+def bandwidth_for_speed(speed):
+    """Return the EIGRP bandwidth for a link speed in Mbit/s."""
+    return max(1, 10000 // speed)
+
+def delay_for_speed(speed):
+    """Return the EIGRP delay, in 10 microsecond units, for a link speed in
+    Mbit/s. This gives the usual delays of 1000 microseconds at 10 Mbit/s,
+    100 at 100 Mbit/s and 10 at 1 Gbit/s or faster."""
+    return max(1, 1000 // speed)
+
+
+class _LinkState(object):
+    """The last counters read for an interface and its averages."""
+
+    __slots__ = ("counters", "time", "load", "reliability")
+
+    def __init__(self):
+        self.counters    = None
+        self.time        = None
+        self.load        = float(MIN_LOAD)
+        self.reliability = float(MAX_RELIABILITY)
+
+
+class InterfaceSampler(object):
+    """Periodically measures the metrics of a system's physical interfaces.
+    See the module docstring."""
+
+    def __init__(self, system, clock, changed_cb, interval=5, weight=.2,
+                 load_threshold=16, reliability_threshold=16):
+        """system - the sysiface system, whose phy_ifaces are sampled with
+                 get_link_stats
+        clock - provides seconds() and callLater(), such as the reactor
+        changed_cb - called with a list of the PhysicalInterfaces whose
+                     metrics changed in a sample
+        interval - seconds between samples
+        weight - the weight of each new sample in the load and reliability
+                 averages, between 0 and 1
+        load_threshold, reliability_threshold - how far an interface's
+                 average has to move before its load or reliability is
+                 changed"""
+        if not 0 < weight <= 1:
+            raise(ValueError("Weight must be between 0 and 1."))
+        self._sys = system
+        self._clock = clock
+        self._changed_cb = changed_cb
+        self._interval = interval
+        self._weight = weight
+        self._load_threshold = load_threshold
+        self._reliability_threshold = reliability_threshold
+        self._links = dict()
+        self._sample_event = None
+
+    def start(self):
+        """Take the first sample now, then one every interval. Speeds and
+        MTUs are set by the first sample; load and reliability need two."""
+        self.sample()
+
+    def stop(self):
+        if self._sample_event and self._sample_event.active():
+            self._sample_event.cancel()
+        self._sample_event = None
+
+    def sample(self):
+        """Read the interfaces' stats, update their metrics and call
+        changed_cb if any changed, then schedule the next sample."""
+        self._sample_event = self._clock.callLater(self._interval,
+                                                   self.sample)
+        try:
+            stats = self._sys.get_link_stats()
+        except ValueError as e:
+            log.warning("Couldn't sample interfaces: {}".format(e))
+            return
+        now = self._clock.seconds()
+        links = dict()
+        changed = list()
+        for phy_iface in self._sys.phy_ifaces:
+            try:
+                speed, mtu, counters = stats[phy_iface.name]
+            except KeyError:
+                continue
+            state = self._links.get(phy_iface) or _LinkState()
+            links[phy_iface] = state
+            metrics = self._measure(state, speed, mtu, counters, now)
+            if self._apply(phy_iface, metrics):
+                changed.append(phy_iface)
+        # Interfaces that have gone are forgotten.
+        self._links = links
+        if changed:
+            self._changed_cb(changed)
+
+    def _measure(self, state, speed, mtu, counters, now):
+        """Update a link's averages from new stats. Returns the metrics the
+        stats give as a dict of set_metrics arguments."""
+        metrics = dict()
+        if speed:
+            metrics["bandwidth"] = bandwidth_for_speed(speed)
+            metrics["delay"] = delay_for_speed(speed)
+        if mtu:
+            metrics["mtu"] = mtu
+        if counters is None:
+            return metrics
+
+        if state.counters is not None and now > state.time:
+            deltas = [ new - old for new, old in zip(counters,
+                                                     state.counters) ]
+            # Counters go backwards when a link is recreated or its driver
+            # resets them. That interval is skipped.
+            if min(deltas) >= 0:
+                self._average(state, speed, deltas, now - state.time)
+        state.counters = counters
+        state.time = now
+        metrics["load"] = self._clamp(state.load, MIN_LOAD, MAX_LOAD)
+        metrics["reliability"] = self._clamp(state.reliability,
+                                             MIN_RELIABILITY,
+                                             MAX_RELIABILITY)
+        return metrics
+
+    def _average(self, state, speed, deltas, elapsed):
+        rx_packets, tx_packets, rx_bytes, tx_bytes, rx_errors, tx_errors = \
+                deltas
+        weight = self._weight
+        if speed:
+            # Load is based on output, as on Cisco routers.
+            load = MAX_LOAD * tx_bytes * 8 / (elapsed * speed * 1e6)
+            load = min(load, MAX_LOAD)
+            state.load += weight * (load - state.load)
+        errors = rx_errors + tx_errors
+        packets = rx_packets + tx_packets + errors
+        # An idle link says nothing about reliability, so the average is
+        # left as it was.
+        if packets:
+            reliability = MAX_RELIABILITY * (1 - float(errors) / packets)
+            state.reliability += weight * (reliability - state.reliability)
+
+    @staticmethod
+    def _clamp(value, low, high):
+        return max(low, min(high, int(round(value))))
+
+    def _apply(self, phy_iface, metrics):
+        """Set the metrics that changed enough on phy_iface. Returns True if
+        any were set."""
+        current = { "bandwidth"   : phy_iface.get_bandwidth(),
+                    "delay"       : phy_iface.get_delay(),
+                    "load"        : phy_iface.get_load(),
+                    "reliability" : phy_iface.get_reliability(),
+                    "mtu"         : phy_iface.get_mtu(),
+                  }
+        thresholds = { "load"        : self._load_threshold,
+                       "reliability" : self._reliability_threshold,
+                     }
+        changes = dict()
+        for name, value in metrics.iteritems():
+            difference = abs(value - current[name])
+            if difference and difference >= thresholds.get(name, 1):
+                changes[name] = value
+        if not changes:
+            return False
+        log.debug("Metrics of {} changed: {}".format(phy_iface.name,
+                  ", ".join([ "{} {}".format(name, value) for name, value
+                              in sorted(changes.iteritems()) ])))
+        phy_iface.set_metrics(**changes)
+        return True
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+"""Integer representations of IPv4 addresses and prefixes.
+
+Addresses are plain integers in host order, and a prefix is the tuple
+(network address, prefix length) with the host bits of the address
+cleared. These are what EIGRP uses from TLV decoding through the topology
+table to the routing table, since building and comparing ipaddr objects
+for every route is comparatively expensive. Convert to ipaddr objects or
+strings only for display."""
+
+# Python-EIGRP (http://python-eigrp.googlecode.com)
+# Copyright (C) 2013 Patrick F. Allen
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import socket
+import struct
+
+MAX_PLEN = 32
+
+# The netmask for each prefix length, as an integer.
+MASKS = [ (0xffffffff << (MAX_PLEN - plen)) & 0xffffffff
+          for plen in xrange(MAX_PLEN + 1) ]
+
+_ADDR = struct.Struct(">I")
+
+def aton(addr):
+    """Return addr as an integer. addr can be an integer, a dotted quad
+    string, or an ipaddr.IPv4Address."""
+    if isinstance(addr, (int, long)):
+        return addr
+    if isinstance(addr, basestring):
+        try:
+            return _ADDR.unpack(socket.inet_aton(addr))[0]
+        except socket.error:
+            raise ValueError("Invalid IPv4 address: {}".format(addr))
+    return int(addr)
+
+def ntoa(addr):
+    """Return the dotted quad string for an integer address."""
+    return socket.inet_ntoa(_ADDR.pack(addr))
+
+def make_prefix(addr, plen):
+    """Return the prefix key for addr/plen. Host bits in addr are cleared."""
+    if not 0 <= plen <= MAX_PLEN:
+        raise ValueError("Plen must be between 0 and 32.")
+    return aton(addr) & MASKS[plen], plen
+
+def prefix_str(prefix):
+    """Return a prefix key in a.b.c.d/len notation."""
+    return "{}/{}".format(ntoa(prefix[0]), prefix[1])
@@ -4,11 +4,15 @@
 Main purpose is to processing link up/down messages through Twisted."""
 
 import struct
+import logging
 from twisted.internet import protocol
 
+import rtnetlink
 import tw_baseiptransport
 from tw_baseiptransport import reactor
 
+log = logging.getLogger("System")
+
 RTMGRP_LINK     = 1
 RTMGRP_NOTIFY   = 2
 RTMGRP_NEIGH    = 4
@@ -155,108 +159,112 @@ class RtAttrFactory(object):
 
 
 class NetlinkRouteProtocol(protocol.DatagramProtocol):
+    """Parses NETLINK_ROUTE datagrams and passes each message to the
+    callbacks registered for its type.
 
-    NLMSGHDR_FMT    = "IHHII"
-    IFINFOMSG_FMT   = "BHiII"
-    RTATTR_HDR_FMT  = "HH"
+    A datagram can hold any number of messages. They are walked by offset
+    without copying, and each is decoded only if a callback wants it."""
 
-    NLMSGHDR_SIZE          = struct.calcsize(NLMSGHDR_FMT)
-    IFINFOMSG_SIZE         = struct.calcsize(IFINFOMSG_FMT)
-    RTATTR_HDR_SIZE        = struct.calcsize(RTATTR_HDR_FMT)
-    IFINFOMSG_START_OFFSET = NLMSGHDR_SIZE
-    RTATTR_START_OFFSET    = NLMSGHDR_SIZE + IFINFOMSG_SIZE
+    # Decoders for the message types callbacks can be registered for. Each
+    # returns a dict describing the message.
+    DECODERS = { rtnetlink.RTM_NEWLINK : rtnetlink.unpack_link,
+                 rtnetlink.RTM_DELLINK : rtnetlink.unpack_link,
+                 rtnetlink.RTM_NEWADDR : rtnetlink.unpack_addr,
+                 rtnetlink.RTM_DELADDR : rtnetlink.unpack_addr,
+               }
 
     def __init__(self):
-        self._rtattr_factory = RtAttrFactory()
+        self._callbacks = dict()
 
-    def datagramReceived(self, data, addr_and_port):
-        addr = addr_and_port[0]
-        port = addr_and_port[1]
+    def register_callback(self, msgtype, callback):
+        """Call callback(msgtype, fields) for every message of the given
+        type that is received. fields is the dict returned by the type's
+        decoder, e.g. rtnetlink.unpack_link for RTM_NEWLINK."""
+        if msgtype not in self.DECODERS:
+            raise(ValueError("No decoder for message type "
+                             "{}".format(msgtype)))
+        self._callbacks.setdefault(msgtype, list()).append(callback)
 
-        if port == RTMGRP_LINK:
-            self._handle_link_message(data)
-        else:
-            raise ValueError("Unknown RT management group/port: "
-                             "{}".format(port))
-
-    def _handle_link_message(self, data):
-        """Override in subclass to take action based on parsed rtattrs."""
-        self._parse_link_message(data)
-
-    def _parse_link_message(self, data):
-        """Parses a link message and returns any supported route attributes
-        from it."""
-        # See rtnetlink(7) for format details.
-        # This consists of an ifinfomsg followed by a series of route
-        # attributes (rtattrs). Each route attribute is 4-byte aligned.
-        nlmsghdr = struct.unpack_from(self.NLMSGHDR_FMT, data, offset=0)
-        ifinfomsg = struct.unpack_from(self.IFINFOMSG_FMT, data, offset=self.IFINFOMSG_START_OFFSET)
-        offset = self.RTATTR_START_OFFSET
-        rtattrs = list()
-        while True:
-            try:
-                attrlen = int(struct.unpack_from("H", data, offset=offset)[0])
-                offset += 2
-            except struct.error:
-                break
-
-            # Each attribute is 4-byte aligned. Determine pad length.
-            padlen = (4 - (attrlen % 4)) % 4
-
-            attrtype = int(struct.unpack_from("H", data, offset=offset)[0])
-            offset += 2
-
-            # Unpack the attribute's data, minus the 2-byte 'type' and 'length'
-            # fields which were already unpacked.
-            attrdata = data[offset:offset+attrlen-4]
-            offset += attrlen - 4
-
-            # Skip the pad.
-            offset += padlen
-
-            try:
-                rtattrs.append(self._rtattr_factory.create(attrtype, attrdata))
-            except RtAttrCreationError:
-                # Skip attrs that we don't care about.
-                continue
-        return rtattrs
+    def datagramReceived(self, data, addr_and_port):
+        try:
+            for msgtype, flags, seq, pid, offset, end in \
+                rtnetlink.iter_messages(data):
+                callbacks = self._callbacks.get(msgtype)
+                if not callbacks:
+                    continue
+                fields = self.DECODERS[msgtype](data, offset, end)
+                for callback in callbacks:
+                    callback(msgtype, fields)
+        except (ValueError, struct.error) as e:
+            # The messages before the bad one have been handled.
+            log.warning("Malformed netlink message: {}".format(e))
 
 
 class LinuxIfaceEventListener(NetlinkRouteProtocol):
 
-    """Handles interface events. Right now only handles if a link's
-    operational state changes to up or not up."""
-
-    def __init__(self, link_up_cb, link_down_cb, *args, **kwargs):
-        """When a message is received that a link is either up or down,
-        the interface name will be passed to the appropriate callback
-        function."""
+    """Handles interface events: links' operational states changing to up
+    or not up, and optionally every link and IPv4 address change.
+
+    Links that change state around the same time are reported together.
+    Changes are collected until the reactor has read everything that is
+    waiting, so when many links go down at once, e.g. a switch carrying
+    many VLANs reboots, the callbacks are called once with all of them."""
+
+    def __init__(self, link_up_cb, link_down_cb, link_cb=None, addr_cb=None,
+                 *args, **kwargs):
+        """When links go up or down, a list of their interface names will
+        be passed to the appropriate callback function. A link that is
+        removed counts as down.
+
+        link_cb and addr_cb, if given, are called with the message type and
+        the link or address (see rtnetlink.unpack_link and unpack_addr) for
+        every RTM_NEWLINK/RTM_DELLINK and RTM_NEWADDR/RTM_DELADDR message,
+        as soon as it is received. LinuxSystem.handle_link_message and
+        handle_addr_message can be used to keep a LinuxSystem's interfaces
+        current."""
         NetlinkRouteProtocol.__init__(self, *args, **kwargs)
-        reactor.listenNetlink(port=RTMGRP_LINK,
-                              protocol=self,
-                              netlinkType=tw_baseiptransport.NetlinkPort.NETLINK_ROUTE)
         self._link_up = link_up_cb
         self._link_down = link_down_cb
 
-    def _handle_link_message(self, data):
-        linkname = None
-        cb = None
-
-        # Iterate through the route attributes until we find the link name
-        # and we determine if the link went up or down. If we don't see both,
-        # do nothing. Ignore other route attributes.
-        for rtattr in self._parse_link_message(data):
-            if rtattr.TYPE == RtAttrIFLAOperState.TYPE:
-                if rtattr.fields['state'] == RtAttrIFLAOperState.OPER_UP:
-                    cb = self._link_up
-                else:
-                    cb = self._link_down
-                if linkname:
-                    cb(linkname)
-            elif rtattr.TYPE == RtAttrIFLAIfname.TYPE:
-                linkname = rtattr.fields['ifname']
-                if cb:
-                    cb(linkname)
+        # Interface name -> True if up, for changes not yet reported.
+        self._link_states = dict()
+        self._report_event = None
+
+        groups = RTMGRP_LINK
+        for msgtype in (rtnetlink.RTM_NEWLINK, rtnetlink.RTM_DELLINK):
+            if link_cb:
+                self.register_callback(msgtype, link_cb)
+            self.register_callback(msgtype, self._link_changed)
+        if addr_cb:
+            groups |= RTMGRP_IPV4_IFADDR
+            for msgtype in (rtnetlink.RTM_NEWADDR, rtnetlink.RTM_DELADDR):
+                self.register_callback(msgtype, addr_cb)
+        reactor.listenNetlink(port=groups,
+                              protocol=self,
+                              netlinkType=tw_baseiptransport.NetlinkPort.NETLINK_ROUTE)
+
+    def _link_changed(self, msgtype, link):
+        if link["name"] is None:
+            return
+        if msgtype == rtnetlink.RTM_DELLINK:
+            up = False
+        elif link["operstate"] is None:
+            return
+        else:
+            up = link["operstate"] == RtAttrIFLAOperState.OPER_UP
+        self._link_states[link["name"]] = up
+        if self._report_event is None:
+            self._report_event = reactor.callLater(0, self._report_links)
+
+    def _report_links(self):
+        self._report_event = None
+        states, self._link_states = self._link_states, dict()
+        down = [ name for name, up in states.iteritems() if not up ]
+        up = [ name for name, up in states.iteritems() if up ]
+        if down:
+            self._link_down(down)
+        if up:
+            self._link_up(up)
 
 
 # Example usage...
@@ -264,11 +272,11 @@ class SomeClass(object):
     def __init__(self):
         self._iface_event_listener = LinuxIfaceEventListener(self.link_up, self.link_down)
 
-    def link_up(self, name):
-        print "Link up: " + name
+    def link_up(self, names):
+        print "Link up: " + ", ".join(names)
 
-    def link_down(self, name):
-        print "Link down: " + name
+    def link_down(self, names):
+        print "Link down: " + ", ".join(names)
 
 
 def main():
@@ -0,0 +1,742 @@
+#!/usr/bin/env python
+
+"""Route programming over NETLINK_ROUTE sockets.
+
+RouteWriter adds, replaces and deletes routes by sending RTM_NEWROUTE and
+RTM_DELROUTE messages to the kernel, instead of running the ip command once
+per route. Several messages can be sent in one datagram and their
+acknowledgements are collected together.
+
+dump_links and dump_addrs read the interfaces and their IPv4 addresses
+with RTM_GETLINK and RTM_GETADDR dumps. unpack_link and unpack_addr decode
+those messages, including the ones the kernel sends when interfaces change.
+
+FakeKernel is a stand-in for the kernel end of the socket. It keeps routes,
+links and addresses in dicts and answers requests the way the kernel does,
+so RouteWriter and anything built on it can be run without root."""
+
+# Python-EIGRP (http://python-eigrp.googlecode.com)
+# Copyright (C) 2013 Patrick F. Allen
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import errno
+import socket
+import struct
+import itertools
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+NETLINK_ROUTE = 0
+
+# from linux/netlink.h
+NLMSG_NOOP      = 1
+NLMSG_ERROR     = 2
+NLMSG_DONE      = 3
+
+NLM_F_REQUEST   = 0x1
+NLM_F_MULTI     = 0x2
+NLM_F_ACK       = 0x4
+NLM_F_ECHO      = 0x8
+
+# Modifiers to NEW requests
+NLM_F_REPLACE   = 0x100
+NLM_F_EXCL      = 0x200
+NLM_F_CREATE    = 0x400
+NLM_F_APPEND    = 0x800
+
+# Modifiers to GET requests
+NLM_F_ROOT      = 0x100
+NLM_F_MATCH     = 0x200
+NLM_F_DUMP      = NLM_F_ROOT | NLM_F_MATCH
+
+# from linux/rtnetlink.h
+RTM_NEWLINK     = 16
+RTM_DELLINK     = 17
+RTM_GETLINK     = 18
+RTM_NEWADDR     = 20
+RTM_DELADDR     = 21
+RTM_GETADDR     = 22
+RTM_NEWROUTE    = 24
+RTM_DELROUTE    = 25
+RTM_GETROUTE    = 26
+
+RTA_UNSPEC      = 0
+RTA_DST         = 1
+RTA_SRC         = 2
+RTA_IIF         = 3
+RTA_OIF         = 4
+RTA_GATEWAY     = 5
+RTA_PRIORITY    = 6
+RTA_PREFSRC     = 7
+RTA_METRICS     = 8
+RTA_MULTIPATH   = 9
+RTA_FLOW        = 11
+RTA_CACHEINFO   = 12
+RTA_TABLE       = 15
+
+# from linux/if_link.h
+IFLA_ADDRESS    = 1
+IFLA_IFNAME     = 3
+IFLA_MTU        = 4
+IFLA_OPERSTATE  = 16
+IFLA_STATS64    = 23
+
+# from linux/if_addr.h
+IFA_ADDRESS     = 1
+IFA_LOCAL       = 2
+IFA_LABEL       = 3
+
+# from linux/if.h, with the names ip uses for them.
+IFF_UP          = 0x1
+IFF_BROADCAST   = 0x2
+IFF_LOOPBACK    = 0x8
+IFF_POINTOPOINT = 0x10
+IFF_RUNNING     = 0x40
+IFF_NOARP       = 0x80
+IFF_PROMISC     = 0x100
+IFF_MULTICAST   = 0x1000
+IFF_LOWER_UP    = 0x10000
+
+IFF_NAMES = [ (IFF_BROADCAST,   "BROADCAST"),
+              (IFF_LOOPBACK,    "LOOPBACK"),
+              (IFF_POINTOPOINT, "POINTOPOINT"),
+              (IFF_MULTICAST,   "MULTICAST"),
+              (IFF_NOARP,       "NOARP"),
+              (IFF_PROMISC,     "PROMISC"),
+              (IFF_UP,          "UP"),
+              (IFF_LOWER_UP,    "LOWER_UP"),
+            ]
+
+RTN_UNICAST     = 1
+
+RTPROT_BOOT     = 3
+RTPROT_STATIC   = 4
+RTPROT_EIGRP    = 192
+
+RT_SCOPE_UNIVERSE = 0
+
+RT_TABLE_UNSPEC = 0
+
+NLMSGHDR_FMT    = "IHHII"
+NLMSGERR_FMT    = "i"
+RTMSG_FMT       = "BBBBBBBBI"
+IFINFOMSG_FMT   = "BxHiII"
+IFADDRMSG_FMT   = "BBBBi"
+RTATTR_HDR_FMT  = "HH"
+
+NLMSGHDR_SIZE   = struct.calcsize(NLMSGHDR_FMT)
+RTMSG_SIZE      = struct.calcsize(RTMSG_FMT)
+IFINFOMSG_SIZE  = struct.calcsize(IFINFOMSG_FMT)
+IFADDRMSG_SIZE  = struct.calcsize(IFADDRMSG_FMT)
+RTATTR_HDR_SIZE = struct.calcsize(RTATTR_HDR_FMT)
+
+_ADDR = struct.Struct(">I")
+_U32  = struct.Struct("I")
+# The first counters of struct rtnl_link_stats64: rx_packets, tx_packets,
+# rx_bytes, tx_bytes, rx_errors and tx_errors.
+_STATS64 = struct.Struct("6Q")
+
+# Largest datagram read back from the socket.
+RECV_SIZE = 65536
+
+# Route metrics (priorities) and IPv4 addresses are 32 bit.
+U32_MAX = 0xFFFFFFFF
+
+
+class NetlinkError(Exception):
+    """The kernel refused a request. errno is the (positive) error number
+    from the kernel's reply."""
+    def __init__(self, errno_, msg=""):
+        self.errno = errno_
+        Exception.__init__(self, "{}: {}".format(errno.errorcode.get(errno_,
+                                                                    errno_),
+                                                 msg))
+
+
+def align(length):
+    """Round length up to the 4 byte netlink alignment."""
+    return (length + 3) & ~3
+
+def open_socket(protocol=NETLINK_ROUTE):
+    """Return a new, unbound netlink socket of the given protocol."""
+    s = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, protocol)
+    if fcntl:
+        flags = fcntl.fcntl(s.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(s.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+    return s
+
+def pack_message(msgtype, flags, seq, payload, pid=0):
+    """Return a netlink message: an nlmsghdr followed by payload, padded to
+    the netlink alignment."""
+    length = NLMSGHDR_SIZE + len(payload)
+    return struct.pack(NLMSGHDR_FMT, length, msgtype, flags, seq, pid) + \
+           payload + "\x00" * (align(length) - length)
+
+def pack_rtattr(attrtype, data):
+    """Return a route attribute, padded to the netlink alignment."""
+    length = RTATTR_HDR_SIZE + len(data)
+    return struct.pack(RTATTR_HDR_FMT, length, attrtype) + data + \
+           "\x00" * (align(length) - length)
+
+def pack_route(net, plen, table, protocol=RTPROT_EIGRP, metric=None,
+               nexthop=None):
+    """Return the rtmsg and route attributes for an IPv4 route.
+    net - the network address, as an integer
+    plen - the prefix length
+    table - the routing table the route belongs to
+    metric - the route priority, or None to leave it out
+    nexthop - the gateway address as an integer, or None to leave it out
+    """
+    # The table field in rtmsg is only a byte, so the table is also always
+    # sent as an attribute.
+    rtmsg = struct.pack(RTMSG_FMT, socket.AF_INET, plen, 0, 0,
+                        table if table < 256 else RT_TABLE_UNSPEC, protocol,
+                        RT_SCOPE_UNIVERSE, RTN_UNICAST, 0)
+    attrs = [pack_rtattr(RTA_TABLE, _U32.pack(table)),
+             pack_rtattr(RTA_DST, _ADDR.pack(net))]
+    if metric is not None:
+        attrs.append(pack_rtattr(RTA_PRIORITY, _U32.pack(metric)))
+    if nexthop is not None:
+        attrs.append(pack_rtattr(RTA_GATEWAY, _ADDR.pack(nexthop)))
+    return rtmsg + "".join(attrs)
+
+def valid_route(net, plen, metric=None, nexthop=None):
+    """Return True if a route change fits in a route request: net, metric
+    and nexthop must be 32 bit unsigned integers (metric and nexthop may be
+    None) and plen at most 32. pack_route raises struct.error for changes
+    that don't fit."""
+    return 0 <= net <= U32_MAX and 0 <= plen <= 32 and \
+           (metric is None or 0 <= metric <= U32_MAX) and \
+           (nexthop is None or 0 <= nexthop <= U32_MAX)
+
+def iter_messages(data):
+    """Yield (msgtype, flags, seq, pid, offset, end) for every netlink
+    message in data. The message payload is data[offset:end]."""
+    offset = 0
+    while offset + NLMSGHDR_SIZE <= len(data):
+        length, msgtype, flags, seq, pid = struct.unpack_from(NLMSGHDR_FMT,
+                                                              data, offset)
+        if length < NLMSGHDR_SIZE or offset + length > len(data):
+            raise(ValueError("Truncated netlink message at offset "
+                             "{}".format(offset)))
+        yield msgtype, flags, seq, pid, offset + NLMSGHDR_SIZE, offset + length
+        offset += align(length)
+
+def iter_rtattrs(data, offset, end):
+    """Yield (attrtype, data_offset, data_end) for every route attribute
+    in data[offset:end]."""
+    while offset + RTATTR_HDR_SIZE <= end:
+        length, attrtype = struct.unpack_from(RTATTR_HDR_FMT, data, offset)
+        if length < RTATTR_HDR_SIZE or offset + length > end:
+            raise(ValueError("Truncated route attribute at offset "
+                             "{}".format(offset)))
+        yield attrtype, offset + RTATTR_HDR_SIZE, offset + length
+        offset += align(length)
+
+def unpack_route(data, offset, end):
+    """Unpack an rtmsg and its attributes from data[offset:end]. Returns a
+    dict with the keys family, plen, table, protocol, type, net, metric and
+    nexthop. Addresses are integers; missing attributes are None."""
+    (family, plen, src_len, tos, table, protocol, scope, rttype,
+     flags) = struct.unpack_from(RTMSG_FMT, data, offset)
+    route = { "family"   : family,
+              "plen"     : plen,
+              "table"    : table,
+              "protocol" : protocol,
+              "type"     : rttype,
+              "net"      : 0,
+              "metric"   : None,
+              "nexthop"  : None,
+            }
+    for attrtype, start, stop in iter_rtattrs(data, offset + RTMSG_SIZE, end):
+        if attrtype == RTA_DST:
+            route["net"] = _ADDR.unpack_from(data, start)[0]
+        elif attrtype == RTA_GATEWAY:
+            route["nexthop"] = _ADDR.unpack_from(data, start)[0]
+        elif attrtype == RTA_PRIORITY:
+            route["metric"] = _U32.unpack_from(data, start)[0]
+        elif attrtype == RTA_TABLE:
+            route["table"] = _U32.unpack_from(data, start)[0]
+    return route
+
+
+def flag_names(flags):
+    """Return the names of the IFF_ flags set in flags, as ip shows
+    them."""
+    return [ name for flag, name in IFF_NAMES if flags & flag ]
+
+def _attr_string(data, start, stop):
+    return data[start:stop].rstrip("\x00")
+
+def pack_link(index, name, flags, mtu=None, operstate=None, stats=None):
+    """Return the ifinfomsg and attributes describing a link. stats is the
+    tuple of counters unpack_link returns, and the rest of the
+    rtnl_link_stats64 counters are sent as 0."""
+    attrs = [pack_rtattr(IFLA_IFNAME, name + "\x00")]
+    if mtu is not None:
+        attrs.append(pack_rtattr(IFLA_MTU, _U32.pack(mtu)))
+    if operstate is not None:
+        attrs.append(pack_rtattr(IFLA_OPERSTATE, chr(operstate)))
+    if stats is not None:
+        attrs.append(pack_rtattr(IFLA_STATS64, _STATS64.pack(*stats) +
+                                               "\x00" * 8 * 17))
+    return struct.pack(IFINFOMSG_FMT, socket.AF_UNSPEC, 0, index, flags,
+                       0xffffffff) + "".join(attrs)
+
+def unpack_link(data, offset, end):
+    """Unpack an ifinfomsg and its attributes from data[offset:end], as sent
+    with RTM_NEWLINK and RTM_DELLINK. Returns a dict with the keys index,
+    flags, name, mtu, operstate and stats. Missing attributes are None.
+    stats is the tuple (rx_packets, tx_packets, rx_bytes, tx_bytes,
+    rx_errors, tx_errors)."""
+    family, linktype, index, flags, change = struct.unpack_from(IFINFOMSG_FMT,
+                                                                data, offset)
+    link = { "index"     : index,
+             "flags"     : flags,
+             "name"      : None,
+             "mtu"       : None,
+             "operstate" : None,
+             "stats"     : None,
+           }
+    for attrtype, start, stop in iter_rtattrs(data, offset + IFINFOMSG_SIZE,
+                                              end):
+        if attrtype == IFLA_IFNAME:
+            link["name"] = _attr_string(data, start, stop)
+        elif attrtype == IFLA_MTU:
+            link["mtu"] = _U32.unpack_from(data, start)[0]
+        elif attrtype == IFLA_OPERSTATE:
+            link["operstate"] = ord(data[start])
+        elif attrtype == IFLA_STATS64 and stop - start >= _STATS64.size:
+            link["stats"] = _STATS64.unpack_from(data, start)
+    return link
+
+def pack_addr(index, address, plen, label=None):
+    """Return the ifaddrmsg and attributes for an IPv4 address, which is an
+    integer."""
+    attrs = [pack_rtattr(IFA_LOCAL, _ADDR.pack(address)),
+             pack_rtattr(IFA_ADDRESS, _ADDR.pack(address))]
+    if label is not None:
+        attrs.append(pack_rtattr(IFA_LABEL, label + "\x00"))
+    return struct.pack(IFADDRMSG_FMT, socket.AF_INET, plen, 0,
+                       RT_SCOPE_UNIVERSE, index) + "".join(attrs)
+
+def unpack_addr(data, offset, end):
+    """Unpack an ifaddrmsg and its attributes from data[offset:end], as sent
+    with RTM_NEWADDR and RTM_DELADDR. Returns a dict with the keys family,
+    plen, index, address and label. For IPv4 the address is an integer;
+    it is None for other families."""
+    family, plen, flags, scope, index = struct.unpack_from(IFADDRMSG_FMT,
+                                                           data, offset)
+    addr = { "family"  : family,
+             "plen"    : plen,
+             "index"   : index,
+             "address" : None,
+             "label"   : None,
+           }
+    if family != socket.AF_INET:
+        return addr
+    for attrtype, start, stop in iter_rtattrs(data, offset + IFADDRMSG_SIZE,
+                                              end):
+        # On point to point links IFA_ADDRESS is the peer's address, so
+        # IFA_LOCAL is preferred when both are present.
+        if attrtype == IFA_LOCAL or \
+           (attrtype == IFA_ADDRESS and addr["address"] is None):
+            addr["address"] = _ADDR.unpack_from(data, start)[0]
+        elif attrtype == IFA_LABEL:
+            addr["label"] = _attr_string(data, start, stop)
+    return addr
+
+def dump(sock, msgtype, payload, seq=0):
+    """Send a dump request and yield (msgtype, data, offset, end) for each
+    message in the reply, where data[offset:end] is the message payload.
+    sock must be bound. Raises NetlinkError if the kernel refuses the
+    request."""
+    sock.sendto(pack_message(msgtype, NLM_F_REQUEST | NLM_F_DUMP, seq,
+                             payload), (0, 0))
+    while True:
+        reply = sock.recv(RECV_SIZE)
+        for rtype, flags, rseq, pid, offset, end in iter_messages(reply):
+            if rseq != seq:
+                continue
+            if rtype == NLMSG_DONE:
+                return
+            if rtype == NLMSG_ERROR:
+                raise(NetlinkError(-struct.unpack_from(NLMSGERR_FMT, reply,
+                                                       offset)[0],
+                                   "dump type {}".format(msgtype)))
+            yield rtype, reply, offset, end
+
+def dump_links(sock, seq=0):
+    """Return a list of every link, as dicts from unpack_link."""
+    payload = struct.pack(IFINFOMSG_FMT, socket.AF_UNSPEC, 0, 0, 0, 0)
+    return [ unpack_link(data, offset, end)
+             for msgtype, data, offset, end in dump(sock, RTM_GETLINK,
+                                                    payload, seq)
+             if msgtype == RTM_NEWLINK ]
+
+def dump_addrs(sock, seq=0):
+    """Return a list of every IPv4 address, as dicts from unpack_addr."""
+    payload = struct.pack(IFADDRMSG_FMT, socket.AF_INET, 0, 0, 0, 0)
+    addrs = list()
+    for msgtype, data, offset, end in dump(sock, RTM_GETADDR, payload, seq):
+        if msgtype != RTM_NEWADDR:
+            continue
+        addr = unpack_addr(data, offset, end)
+        if addr["family"] == socket.AF_INET:
+            addrs.append(addr)
+    return addrs
+
+
+class RouteWriter(object):
+    """Installs and removes IPv4 routes in one routing table through a
+    netlink socket.
+
+    The kernel treats routes to the same prefix with different priorities
+    as different routes, and NLM_F_REPLACE only replaces a route with the
+    same priority. The metric last installed for each prefix is kept in
+    self.routes so a metric change can remove the old route in the same
+    datagram that adds the new one."""
+
+    # Requests sent per datagram. Only the last request in a datagram asks
+    # for an acknowledgement, but every failed request is answered with an
+    # error that includes the request, and answers that don't fit in the
+    # socket's receive buffer are dropped by the kernel.
+    BATCH_SIZE = 128
+    RCVBUF = 1 << 20
+
+    def __init__(self, table, sock=None, protocol=RTPROT_EIGRP):
+        """Args:
+        table - the routing table to write routes to
+        sock - the socket to use. Anything with sendto and recv methods
+            will do, such as a FakeKernel. If None, a NETLINK_ROUTE socket
+            is opened.
+        protocol - the routing protocol to mark routes with
+        """
+        if sock is None:
+            sock = open_socket()
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.RCVBUF)
+            sock.bind((0, 0))
+        self._sock = sock
+        self._table = table
+        self._protocol = protocol
+        self._seq = itertools.count(1)
+
+        # Prefix -> (metric, nexthop) for every route this writer has
+        # installed.
+        self.routes = dict()
+
+    def route_message(self, msgtype, net, plen, metric=None, nexthop=None):
+        """Return (msgtype, flags, payload) for a route request, ready to
+        pass to send. New routes replace any route to the prefix with the
+        same metric."""
+        flags = NLM_F_REQUEST
+        if msgtype == RTM_NEWROUTE:
+            flags |= NLM_F_CREATE | NLM_F_REPLACE
+        return msgtype, flags, pack_route(net, plen, self._table,
+                                          self._protocol, metric, nexthop)
+
+    def apply(self, ops):
+        """Apply a list of route changes, BATCH_SIZE requests to a
+        datagram. Each change is a tuple (net, plen, metric, nexthop), as
+        for sysiface._System.modify_route. A metric of None removes the
+        route to the prefix instead.
+
+        Returns a list with the errno for each change, 0 meaning success.
+        Changes that don't fit in a request (see valid_route) fail with
+        EINVAL without being sent, and without failing the rest. If sending
+        a datagram fails, only the changes in it fail. A route is
+        forgotten even if removing it fails, since the usual reason is that
+        it was already gone."""
+        msgs = list()
+        owners = list()
+        errors = [0] * len(ops)
+        # The metric each prefix will have once the earlier changes in ops
+        # are applied.
+        metrics = dict()
+        for index, (net, plen, metric, nexthop) in enumerate(ops):
+            if not valid_route(net, plen, metric, nexthop):
+                errors[index] = errno.EINVAL
+                continue
+            prefix = net, plen
+            if prefix in metrics:
+                old = metrics[prefix]
+            else:
+                old = self.routes.get(prefix, (None,))[0]
+            metrics[prefix] = metric
+            if metric is None:
+                msgs.append(self.route_message(RTM_DELROUTE, net, plen, old))
+                owners.append(index)
+                continue
+            msgs.append(self.route_message(RTM_NEWROUTE, net, plen, metric,
+                                           nexthop))
+            owners.append(index)
+            if old is not None and old != metric:
+                # Failing to remove the old route only means it was
+                # already gone, so this isn't reported.
+                msgs.append(self.route_message(RTM_DELROUTE, net, plen, old))
+                owners.append(None)
+
+        for start in xrange(0, len(msgs), self.BATCH_SIZE):
+            end = start + self.BATCH_SIZE
+            try:
+                results = self.send(msgs[start:end])
+            except socket.error as e:
+                # Only the changes in this datagram fail. Any replies to it
+                # that are still to come are skipped by later sends.
+                results = [ e.errno or errno.EIO ] * len(msgs[start:end])
+            for owner, err in zip(owners[start:end], results):
+                if owner is not None and err:
+                    errors[owner] = err
+
+        for (net, plen, metric, nexthop), err in zip(ops, errors):
+            if metric is None:
+                self.routes.pop((net, plen), None)
+            elif not err:
+                self.routes[net, plen] = metric, nexthop
+        return errors
+
+    def replace_route(self, net, plen, metric, nexthop):
+        """Install a route, replacing any route to the prefix that this
+        writer installed earlier. Arguments are as for
+        sysiface._System.modify_route. Raises NetlinkError on failure."""
+        err = self.apply([(net, plen, metric, nexthop)])[0]
+        if err:
+            raise(NetlinkError(err, "replace route to "
+                               "{}/{}".format(socket.inet_ntoa(_ADDR.pack(net)),
+                                              plen)))
+
+    def delete_route(self, net, plen):
+        """Remove the route to a prefix. Raises NetlinkError on failure."""
+        err = self.apply([(net, plen, None, None)])[0]
+        if err:
+            raise(NetlinkError(err, "delete route to "
+                               "{}/{}".format(socket.inet_ntoa(_ADDR.pack(net)),
+                                              plen)))
+
+    def dump_routes(self):
+        """Return {prefix: (metric, nexthop)} for the IPv4 unicast routes
+        currently in the writer's table, read from the kernel with an
+        RTM_GETROUTE dump. The routes are also added to self.routes, so
+        later changes to them replace them correctly.
+
+        If a prefix has several routes, the one with the lowest metric is
+        returned."""
+        payload = struct.pack(RTMSG_FMT, socket.AF_INET, 0, 0, 0,
+                              self._table if self._table < 256 else
+                              RT_TABLE_UNSPEC, 0, 0, 0, 0) + \
+                  pack_rtattr(RTA_TABLE, _U32.pack(self._table))
+        routes = dict()
+        for msgtype, data, offset, end in dump(self._sock, RTM_GETROUTE,
+                                               payload,
+                                               next(self._seq) & 0xffffffff):
+            if msgtype != RTM_NEWROUTE:
+                continue
+            # Older kernels ignore the table in the request and dump every
+            # table.
+            route = unpack_route(data, offset, end)
+            if route["table"] != self._table or \
+               route["family"] != socket.AF_INET or \
+               route["type"] != RTN_UNICAST:
+                continue
+            prefix = route["net"], route["plen"]
+            metric = route["metric"] or 0
+            if prefix not in routes or metric < routes[prefix][0]:
+                routes[prefix] = metric, route["nexthop"]
+        self.routes.update(routes)
+        return routes
+
+    def send(self, msgs):
+        """Send a list of (msgtype, flags, payload) requests in a single
+        datagram and wait until the kernel has handled them. Returns a list
+        with the errno for each request, 0 meaning success.
+
+        The kernel handles the requests in order and answers each failed
+        one, so acknowledging the last request is enough to know that all
+        the errors have been seen."""
+        if not msgs:
+            return list()
+        seqs = dict()
+        data = list()
+        last = len(msgs) - 1
+        for index, (msgtype, flags, payload) in enumerate(msgs):
+            seq = next(self._seq) & 0xffffffff
+            seqs[seq] = index
+            if index == last:
+                flags |= NLM_F_ACK
+            data.append(pack_message(msgtype, flags, seq, payload))
+        self._sock.sendto("".join(data), (0, 0))
+
+        errors = [0] * len(msgs)
+        done = False
+        while not done:
+            reply = self._sock.recv(RECV_SIZE)
+            for msgtype, flags, seq, pid, offset, end in iter_messages(reply):
+                if msgtype != NLMSG_ERROR:
+                    continue
+                index = seqs.pop(seq, None)
+                if index is None:
+                    # Reply to an earlier request we stopped waiting for.
+                    continue
+                errors[index] = -struct.unpack_from(NLMSGERR_FMT, reply,
+                                                    offset)[0]
+                if index == last:
+                    done = True
+        return errors
+
+    def close(self):
+        self._sock.close()
+
+
+class FakeKernel(object):
+    """Socket-like stand-in for the kernel's side of a NETLINK_ROUTE socket.
+
+    Route requests and link, address and route dumps are understood.
+    Routes are kept in self.tables, which maps a table number to a dict of
+    prefix -> {metric: (nexthop, protocol)}. Like the kernel, a route is
+    identified by its prefix and priority. Links and addresses are added
+    with add_link and add_addr.
+
+    Requests for prefixes in self.fail (a dict of prefix -> errno) are
+    refused with that errno."""
+
+    def __init__(self):
+        self.tables = dict()
+        self.links = dict()
+        self.addrs = list()
+        self.fail = dict()
+        self.requests = 0
+        self.datagrams = 0
+        self._replies = list()
+
+    def routes(self, table):
+        """Return {prefix: (metric, nexthop)} for a table. If a prefix has
+        several routes, the one with the lowest metric is returned."""
+        routes = dict()
+        for prefix, metrics in self.tables.get(table, dict()).iteritems():
+            metric = min(metrics)
+            routes[prefix] = metric, metrics[metric][0]
+        return routes
+
+    def add_link(self, index, name, flags=IFF_UP | IFF_LOWER_UP, mtu=1500,
+                 stats=(0, 0, 0, 0, 0, 0)):
+        """Add a link, or change the one with the same index. stats is as
+        for pack_link."""
+        self.links[index] = name, flags, mtu, stats
+
+    def add_addr(self, index, address, plen, label=None):
+        """Add an IPv4 address, as an integer, to the link with the given
+        index."""
+        self.addrs.append((index, address, plen, label))
+
+    def sendto(self, data, addr):
+        self.datagrams += 1
+        for msgtype, flags, seq, pid, offset, end in iter_messages(data):
+            self.requests += 1
+            if msgtype in self._DUMPS and flags & NLM_F_DUMP == NLM_F_DUMP:
+                self._queue_dump(seq, self._DUMPS[msgtype](self))
+                continue
+            try:
+                err = self._handle(msgtype, flags, data, offset, end)
+            except (ValueError, struct.error):
+                err = errno.EINVAL
+            if err or flags & NLM_F_ACK:
+                payload = struct.pack(NLMSGERR_FMT, -err) + \
+                          data[offset - NLMSGHDR_SIZE:offset]
+                self._replies.append(pack_message(NLMSG_ERROR, 0, seq,
+                                                  payload))
+        return len(data)
+
+    def send(self, data):
+        return self.sendto(data, (0, 0))
+
+    def recv(self, bufsize):
+        if not self._replies:
+            raise(socket.error(errno.EAGAIN, "No replies pending"))
+        return self._replies.pop(0)[:bufsize]
+
+    def close(self):
+        pass
+
+    def _dump_routes(self):
+        # Like an older kernel, routes from every table are returned.
+        msgs = list()
+        for table, prefixes in sorted(self.tables.items()):
+            for (net, plen), metrics in sorted(prefixes.items()):
+                for metric, (nexthop, protocol) in sorted(metrics.items()):
+                    msgs.append((RTM_NEWROUTE,
+                                 pack_route(net, plen, table, protocol, metric,
+                                            nexthop)))
+        return msgs
+
+    def _dump_links(self):
+        return [ (RTM_NEWLINK, pack_link(index, name, flags, mtu,
+                                         stats=stats))
+                 for index, (name, flags, mtu, stats)
+                 in sorted(self.links.items()) ]
+
+    def _dump_addrs(self):
+        return [ (RTM_NEWADDR, pack_addr(*addr)) for addr in self.addrs ]
+
+    _DUMPS = { RTM_GETROUTE : _dump_routes,
+               RTM_GETLINK  : _dump_links,
+               RTM_GETADDR  : _dump_addrs,
+             }
+
+    def _queue_dump(self, seq, msgs, per_datagram=64):
+        """Queue replies to a dump, several messages to a datagram."""
+        msgs = [ pack_message(msgtype, NLM_F_MULTI, seq, payload)
+                 for msgtype, payload in msgs ]
+        for start in xrange(0, len(msgs), per_datagram):
+            self._replies.append("".join(msgs[start:start + per_datagram]))
+        self._replies.append(pack_message(NLMSG_DONE, NLM_F_MULTI, seq,
+                                          struct.pack(NLMSGERR_FMT, 0)))
+
+    def _handle(self, msgtype, flags, data, offset, end):
+        """Apply one request. Returns an errno, or 0 on success."""
+        if msgtype not in (RTM_NEWROUTE, RTM_DELROUTE):
+            return errno.EOPNOTSUPP
+        route = unpack_route(data, offset, end)
+        if route["family"] != socket.AF_INET:
+            return errno.EAFNOSUPPORT
+        prefix = route["net"], route["plen"]
+        if prefix in self.fail:
+            return self.fail[prefix]
+        table = self.tables.setdefault(route["table"], dict())
+        metric = route["metric"] or 0
+        metrics = table.get(prefix)
+        if msgtype == RTM_NEWROUTE:
+            if metrics and metric in metrics:
+                if flags & NLM_F_EXCL or not flags & NLM_F_REPLACE:
+                    return errno.EEXIST
+            elif not flags & NLM_F_CREATE:
+                return errno.ENOENT
+            table.setdefault(prefix, dict())[metric] = (route["nexthop"],
+                                                        route["protocol"])
+            return 0
+        if not metrics:
+            return errno.ESRCH
+        # Deletes without a priority match any route to the prefix.
+        if route["metric"] is None:
+            metric = min(metrics)
+        elif metric not in metrics:
+            return errno.ESRCH
+        del metrics[metric]
+        if not metrics:
+            del table[prefix]
+        return 0
@@ -43,17 +43,21 @@ import logging.config
 import binascii
 
 from tw_baseiptransport import reactor
+import ipv4
 import rtptlv
 import util
+import timerwheel
 
 class ReliableTransportProtocol(protocol.DatagramProtocol):
     """An implementation of the Reliable Transport Protocol and Neighbor
     Discovery/Recovery used with EIGRP."""
 
     DEFAULT_HT_MULTIPLIER = 3
+    DEFAULT_WINDOW_SIZE   = 1
 
     def __init__(self, system, logconfig, multicast_ip="224.0.0.10", port=0,
-                 kvalues=None, rid=0, asn=0, hello_interval=5, hdrver=2):
+                 kvalues=None, rid=0, asn=0, hello_interval=5, hdrver=2,
+                 window_size=DEFAULT_WINDOW_SIZE):
         """system - The system interface to use
         logconfig - The logging config file to use
         multicast_ip - The multicast IP to use
@@ -65,6 +69,8 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
         asn - The autonomous system number
         hello_interval - Hello interval. Also influences neighbor timeout
         hdrver - The version of the RTP header to use
+        window_size - The number of unacknowledged sequenced packets that
+                      can be outstanding to each neighbor at once
         """
         # XXX Should probably figure out Twisted's log observers and use that.
 
@@ -104,6 +110,13 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
         self.__hello_interval = hello_interval
         self.__holdtime = self.__hello_interval * self.__ht_multiplier
 
+        if not isinstance(window_size, int):
+            raise TypeError("window_size must be an integer.")
+        if not 1 <= window_size <= RTPNeighbor.MAX_WINDOW_SIZE:
+            raise(ValueError("window_size must be between 1 and "
+                             "{}".format(RTPNeighbor.MAX_WINDOW_SIZE)))
+        self._window_size = window_size
+
         if not kvalues:
             # Allow kvalues to be effectively ignored if the upper layer
             # protocol doesn't need it.
@@ -130,12 +143,19 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
             self._k4 = kvalues[3]
             self._k5 = kvalues[4]
 
-        self._tlvfactory = rtptlv.TLVFactory()
+        # Holdtime, retransmit, and hello timers all run from this wheel
+        # instead of being scheduled in the reactor individually.
+        self._timers = timerwheel.TimerWheel(reactor)
+
+        # TLVs are decoded lazily so that packets dropped by RTP (duplicates,
+        # CR mismatches) don't pay for decoding values nobody looks at.
+        self._tlvfactory = rtptlv.TLVFactory(lazy=True)
         self._tlvfactory.register_tlvs([rtptlv.TLVParam,
                                         rtptlv.TLVAuth,
                                         rtptlv.TLVSeq,
                                         rtptlv.TLVVersion,
-                                        rtptlv.TLVMulticastSeq])
+                                        rtptlv.TLVMulticastSeq,
+                                        rtptlv.TLVPrevSeq])
         self.__update_hello_tlvs()
         reactor.callWhenRunning(self.__send_periodic_hello)
 
@@ -157,17 +177,27 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
 
     def _init_ifaces(self):
         self._ifaces = list()
+        # Interface index -> the RTP interfaces on that physical interface,
+        # for packets received with the index of their input interface.
+        # Empty if the system doesn't know interface indexes.
+        self._ifaces_by_index = dict()
         for iface in self._sys.logical_ifaces:
-            self._ifaces.append(RTPInterface(iface,
-                                             self.__send_rtp_multicast,
-                                             self._rtphdr))
+            rtpiface = RTPInterface(iface,
+                                    self.__send_rtp_multicast,
+                                    self._rtphdr)
+            self._ifaces.append(rtpiface)
+            index = iface.phy_iface.index
+            if index is not None:
+                self._ifaces_by_index.setdefault(index, list())
+                self._ifaces_by_index[index].append(rtpiface)
 
     def __send_periodic_hello(self):
         self.log.debug2("Sending periodic hello.")
         for iface in self._ifaces:
             if iface.activated:
                 self.__send_hello(iface)
-        reactor.callLater(self.__hello_interval, self.__send_periodic_hello)
+        self._timers.call_later(self.__hello_interval,
+                                self.__send_periodic_hello)
 
     def __send_hello(self, iface):
         iface.send(self._rtphdr.OPC_HELLO, self.__hello_tlvs, False)
@@ -223,32 +253,34 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
         msg = RTPPacket(hdr, []).pack()
         self.__send(msg, neighbor.ip.exploded, self._port)
 
-    def __get_input_iface(self, ip):
-        """Get the interface on which this IP address should reside
-        (according to reverse path lookup, not the kernel's ancillary data).
+    def __get_input_iface(self, ip, ifindex=None):
+        """Get the interface on which this IP address should reside. If
+        ifindex, the index of the interface the packet arrived on according
+        to the kernel, is given, only the RTP interfaces on that interface
+        are considered. Otherwise this is a reverse path lookup.
 
         Returns (iface, host_local) tuple. host_local is True if the IP
         address is assigned to this device, otherwise False."""
-        ip = ipaddr.IPv4Address(ip)
-        for iface in self._ifaces:
-            if ip in iface.logical_iface.ip:
-                return (iface, iface.logical_iface.ip.ip.exploded == \
-                        ip.exploded)
+        addr = ipv4.aton(ip)
+        if ifindex is None or not self._ifaces_by_index:
+            ifaces = self._ifaces
+        else:
+            ifaces = self._ifaces_by_index.get(ifindex, ())
+        for iface in ifaces:
+            net, plen = iface.prefix
+            if addr & ipv4.MASKS[plen] == net:
+                return (iface, iface.address == addr)
         return None, False
 
     def __add_neighbor(self, addr, iface):
         """Add a neighbor to the list of neighbors.
+        iface - the interface found by __get_input_iface
         Return the new neighbor object, or None on failure."""
-        addr = ipaddr.IPv4Address(addr)
-        found_iface = False
-        for iface in self._ifaces:
-            if addr in iface.logical_iface.ip:
-                found_iface = True
-                break
-        if not found_iface:
+        if not iface:
             self.log.debug("Preventing adjacency with non-link-local "
                            "neighbor.")
             return None
+        addr = ipaddr.IPv4Address(addr)
         neighbor = RTPNeighbor(ip=addr,
                                iface=iface,
                                rtphdr=self._rtphdr,
@@ -256,6 +288,8 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
                                dropfunc=self.__rtp_lost_neighbor,
                                make_pkt=self.__make_pkt,
                                sendfunc=self.__send_rtp_unicast,
+                               window_size=self._window_size,
+                               timers=self._timers,
                                kvalues=[self._k1,
                                         self._k2,
                                         self._k3,
@@ -299,9 +333,9 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
                 # If neighbor has a full queue, add it to a seq tlv
                 if neighbor.queue_full():
                     seq_ips.append(str(neighbor.ip.packed))
-                # We only really need to copy the hdr since the tlvs won't
-                # change, but copy the whole thing anyway.
-                neighbor.schedule_multicast_retransmission(copy.deepcopy(pkt))
+                # Each neighbor gets its own header, since the ack field is
+                # filled in per neighbor, but the packed TLVs are shared.
+                neighbor.schedule_multicast_retransmission(pkt.clone())
             if seq_ips:
                 self.__send_seq_tlv(iface, seq_ips, pkt.hdr.seq)
                 pkt.hdr.flags |= self._rtphdr.FLAG_CR
@@ -370,21 +404,40 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
         from its interface."""
         pass
 
+    def datagramsReceived(self, datagrams):
+        """Handle a list of (data, addr) packets that the transport read
+        together. Each is handled as by datagramReceived. A packet that
+        raises is logged and dropped, rather than losing the rest of the
+        batch with it."""
+        for data, addr_and_port in datagrams:
+            try:
+                self.datagramReceived(data, addr_and_port)
+            except Exception:
+                self.log.exception("Error handling datagram from "
+                                   "{}.".format(addr_and_port[0]))
+
     def datagramReceived(self, data, addr_and_port):
         # XXX Currently only expecting to ride directly over IP, so we
         # ignore the unused port argument. Should remove this restriction.
         addr = addr_and_port[0]
         port = addr_and_port[1]
+        # The transport adds the input interface's index if it can read it
+        # from the kernel.
+        if len(addr_and_port) > 2:
+            ifindex = addr_and_port[2]
+        else:
+            ifindex = None
         self.log.debug("Receiving datagram from {}:{}.".format(addr, port))
-        iface, host_local = self.__get_input_iface(addr)
+        iface, host_local = self.__get_input_iface(addr, ifindex)
         if host_local:
             self.log.debug("Ignoring host-local packet.")
             return
         if not iface:
             self.log.warn("Received datagram from non-link-local host: "
                           "{}".format(addr))
+            return
         try:
-            hdr = self._rtphdr(data[:self._rtphdr.LEN])
+            hdr = self._rtphdr(data)
         except struct.error:
             bytes_to_print = self._rtphdr.LEN
             self.log.warn("Received malformed datagram from {}. Hexdump of "
@@ -405,10 +458,8 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
                            "{} from addr {}.".format(hdr.VER, addr))
             return
 
-        payload = data[self._rtphdr.LEN:]
-
         # XXX Catch and log exceptions from factory
-        tlvs = self._tlvfactory.build_all(payload)
+        tlvs = self._tlvfactory.build_all(data, self._rtphdr.LEN)
 
         # Create neighbor if it doesn't exist.
         neighbor = iface.get_neighbor(addr)
@@ -435,8 +486,10 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
             self.__send_init(neighbor)
 
         self.log.debug5("Header: {}".format(hdr))
-        for tlv in tlvs:
-            self.log.debug5("TLV: {}".format(tlv))
+        # Formatting a TLV decodes it, so only do that if it will be logged.
+        if self.log.isEnabledFor(logging.getLevelName("DEBUG5")):
+            for tlv in tlvs:
+                self.log.debug5("TLV: {}".format(tlv))
 
         neighbor_receive_status = neighbor.receive(hdr, tlvs)
         if neighbor_receive_status == neighbor.PROCESS:
@@ -459,13 +512,30 @@ class ReliableTransportProtocol(protocol.DatagramProtocol):
             self.__send_explicit_ack(neighbor)
             neighbor.next_ack = 0
 
+        # Packets that arrived out of order may have been waiting for this
+        # one. Each is ACKed as it is passed up.
+        while neighbor.ready:
+            hdr, tlvs = neighbor.ready.popleft()
+            neighbor.next_ack = hdr.seq
+            self.rtpReceived(neighbor, hdr, tlvs)
+            if neighbor.next_ack:
+                self.__send_explicit_ack(neighbor)
+                neighbor.next_ack = 0
+
 
 class RTPPacket(object):
 
     """A packet used with RTP. Consists of a header plus zero or more
-    fields."""
+    fields.
 
-    def __init__(self, hdr, fields):
+    The fields are packed once, the first time the packet is packed or
+    cloned, and the packed bytes are reused from then on. Modifying the
+    field objects after that does not change the packet."""
+
+    def __init__(self, hdr, fields, payload=None):
+        """hdr - The RTP header
+        fields - The fields (TLVs) carried by the packet
+        payload - A PackedPayload of the fields, if one already exists"""
         self.hdr = hdr
         try:
             iter(fields)
@@ -473,20 +543,77 @@ class RTPPacket(object):
             self.fields = [fields]
         else:
             self.fields = fields
+        self._payload = payload
+
+        # The packed header (with a zero checksum) that was used the last
+        # time the checksum was computed, and the folded one's complement sum
+        # of that header plus the payload.
+        self._sum_hdr = None
+        self._sum = None
 
     def __str__(self):
         return "RTPPacket(hdr=" + str(self.hdr) + ", fields=" + \
                str(self.fields) + ")"
 
+    def get_payload(self):
+        """Return the PackedPayload for this packet's fields."""
+        if not self._payload:
+            self._payload = PackedPayload(self.fields)
+        return self._payload
+
+    def clone(self):
+        """Return a copy of this packet that has its own header but shares
+        this packet's packed payload. This is how a reliable multicast is
+        queued for retransmission to each neighbor, where only the header's
+        ack field differs between the copies."""
+        self._update_sum()
+        pkt = RTPPacket(copy.copy(self.hdr), self.fields, self._payload)
+        pkt._sum_hdr = self._sum_hdr
+        pkt._sum = self._sum
+        return pkt
+
     def pack(self):
+        self._update_sum()
+        self.hdr.chksum = self._finish_checksum(self._sum)
+        return self.hdr.pack() + self.get_payload().data
+
+    def _update_sum(self):
+        """Bring self._sum up to date with the current header. If a sum was
+        already computed for an earlier version of the header, only the
+        16-bit words that changed since then are folded in (see RFC 1624)
+        rather than summing the payload again."""
         self.hdr.chksum = 0
-        prehdr = self.hdr.pack()
-        fields = ""
-        for f in self.fields:
-            fields += f.pack()
-        self.hdr.chksum = self.checksum(prehdr + fields)
         hdr = self.hdr.pack()
-        return hdr + fields
+        if self._sum is None:
+            s = self._sum16(hdr) + self.get_payload().sum
+        elif hdr != self._sum_hdr:
+            s = self._sum
+            for old, new in zip(array.array("H", self._sum_hdr),
+                                array.array("H", hdr)):
+                if old != new:
+                    s += (~old & 0xffff) + new
+        else:
+            return
+        self._sum = self._fold(s)
+        self._sum_hdr = hdr
+
+    @staticmethod
+    def _sum16(data):
+        """Return the unfolded sum of data as 16-bit words in host byte
+        order."""
+        if len(data) % 2 == 1:
+            data += "\0"
+        return sum(array.array("H", data))
+
+    @staticmethod
+    def _fold(s):
+        s = (s >> 16) + (s & 0xffff)
+        s += s >> 16
+        return s & 0xffff
+
+    @classmethod
+    def checksum(cls, pkt):
+        return cls._finish_checksum(cls._sum16(pkt))
 
     # Checksum functions are from Python2.7's utils.py. Copyright notice from
     # Scapy:
@@ -498,26 +625,37 @@ class RTPPacket(object):
     # the above copyright notice was listed.)
     if struct.pack("H", 1) == "\x00\x01": # big endian
         @staticmethod
-        def checksum(pkt):
-            if len(pkt) % 2 == 1:
-                pkt += "\0"
-            s = sum(array.array("H", pkt))
+        def _finish_checksum(s):
             s = (s >> 16) + (s & 0xffff)
             s += s >> 16
             s = ~s
             return s & 0xffff or 0xffff
     else:
         @staticmethod
-        def checksum(pkt):
-            if len(pkt) % 2 == 1:
-                pkt += "\0"
-            s = sum(array.array("H", pkt))
+        def _finish_checksum(s):
             s = (s >> 16) + (s & 0xffff)
             s += s >> 16
             s = ~s
             return (((s>>8)&0xff)|s<<8) & 0xffff or 0xffff
 
 
+class PackedPayload(object):
+
+    """The packed fields of an RTP packet and their one's complement sum.
+    One PackedPayload is shared by every copy of a multicast packet (see
+    RTPPacket.clone), so it must not be modified after it is created."""
+
+    def __init__(self, fields):
+        self.data = "".join([f.pack() for f in fields])
+
+        # The header is an even number of bytes, so the payload's 16-bit
+        # words line up with the packet's and can be summed separately.
+        self.sum = RTPPacket._sum16(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+
 class RTPHeader2(object):
     """Reliable Transport Protocol Header (header version 2)."""
 
@@ -584,9 +722,12 @@ class RTPHeader2(object):
     def unpack(self, raw):
         """Note that self.ver could be different than self.VER if you use
         this on raw data. If there is ever a new header version, would
-        be nice to make a factory like there is for TLVs."""
+        be nice to make a factory like there is for TLVs.
+        Only the first LEN bytes of raw are used, so the whole packet can be
+        passed in."""
         self.ver, self.opcode, self.chksum, self.flags, self.seq, \
-             self.ack, self.rid, self.asn = struct.unpack(self.FORMAT, raw)
+             self.ack, self.rid, self.asn = struct.unpack_from(self.FORMAT,
+                                                               raw)
 
     def pack(self):
         return struct.pack(self.FORMAT, self.VER, self.opcode, self.chksum,
@@ -603,8 +744,32 @@ class RTPNeighbor(object):
     PROCESS       = 3
     NEW_ADJACENCY = 4
 
+    # Upper bound on the transmit window. Sequence numbers are shared by all
+    # neighbors, so a large window mostly just delays detection of a dead
+    # neighbor.
+    MAX_WINDOW_SIZE = 64
+
+    # Retransmission timeout parameters, in seconds. See RFC 6298. The
+    # initial timeout and the minimum are much lower than TCP's because RTP
+    # peers are always on a directly connected link, where a round trip
+    # takes well under a millisecond. RFC 6298's 1 second initial timeout
+    # would make recovering a packet lost before the first RTT sample, such
+    # as the INIT or the first UPDATE of a full-table exchange, five times
+    # slower than the fixed 0.2 second timer RTP used before.
+    RTO_INITIAL = .2
+    RTO_MIN     = .02
+    RTO_MAX     = 3.0
+    RTO_CLOCK_GRANULARITY = timerwheel.TimerWheel.DEFAULT_RESOLUTION
+    RTT_ALPHA   = 1 / 8.
+    RTT_BETA    = 1 / 4.
+    RTO_K       = 4
+
+    # Give up on a packet (and drop the neighbor) after retransmitting it for
+    # this many seconds, or for the neighbor's holdtime if that is longer.
+    MAX_RETRANSMIT_SECONDS = 5
+
     def __init__(self, ip, iface, rtphdr, log, dropfunc,
-                 make_pkt, sendfunc, kvalues):
+                 make_pkt, sendfunc, kvalues, window_size=1, timers=None):
         """
         ip - IP address of this neighbor
         iface - Logical interface this neighbor was heard on
@@ -615,10 +780,25 @@ class RTPNeighbor(object):
         make_pkt - A function that will generate an RTP packet
         sendfunc - A function to call every time a packet is (re)transmitted
         kvalues - The k-values needed in order to form an adjacency
+        window_size - The max number of unacknowledged sequenced packets to
+                      have in flight to this neighbor
+        timers - The TimerWheel used for the holdtime and retransmit timers.
+                 Neighbors should share one wheel; if None, a wheel is
+                 created for this neighbor
         """
         self.iface = iface
         self.ip = ipaddr.IPv4Address(ip)
         self._queue = deque()
+
+        # The first _inflight packets at the right side of _queue have been
+        # transmitted and are waiting for an ACK. Anything to the left of
+        # them has not been sent yet.
+        self._inflight = 0
+        self._window_size = window_size
+        self._retransmit_event = None
+        if timers is None:
+            timers = timerwheel.TimerWheel(reactor)
+        self._timers = timers
         self._state_receive = self._pending_receive
         self.last_heard = time.time()
         self._cr_mode = False
@@ -648,7 +828,7 @@ class RTPNeighbor(object):
         # This should be updated by the packet that causes us to be
         # initialized. So this event will be rescheduled to the neighbor's real
         # holdtime before control is passed back to Twisted.
-        self._drop_event = reactor.callLater(10, self._drop_self)
+        self._drop_event = self._timers.call_later(10, self._drop_self)
 
         # The next ack number we should send to this neighbor. Not the same
         # as seq_to because this will change to 0 after we send an ack.
@@ -657,21 +837,48 @@ class RTPNeighbor(object):
         # XXX Support non-zero port
         self.port = 0
 
-        # XXX Update to a variable retransmit timer
-        self._retransmit_timer = .2
-        self._max_retransmit_seconds = 5
+        # Smoothed round trip time and its variance, or None until the first
+        # measurement is taken. See _update_rtt.
+        self.srtt = None
+        self._rttvar = None
+        self.rto = self.RTO_INITIAL
+
+        # Time each in-flight packet was first sent, by sequence number. The
+        # time is set to None once a packet is retransmitted because an ACK
+        # can't be matched to a specific transmission after that (Karn's
+        # algorithm).
+        self._send_times = dict()
 
         # seq_to is the last non-zero sequence number we sent to this neighbor
         self._seq_to = -1
 
-        # seq_from is the last sequence number we received from this neighbor
+        # seq_from is the last sequence number from this neighbor that was
+        # passed to the upper layer
         self._seq_from = -1
 
+        # Packets from this neighbor that arrived before the packet the
+        # neighbor sent ahead of them, keyed by that packet's sequence
+        # number. See _up_receive.
+        self._held = dict()
+
+        # (hdr, tlvs) of held packets that can now be passed to the upper
+        # layer, in order. RTP delivers them after the packet that released
+        # them.
+        self.ready = deque()
+
+        # Counters that are displayed by the admin interface.
+        self.pkts_sent = 0
+        self.pkts_retransmitted = 0
+        self.acks_received = 0
+        self.dupes_received = 0
+        self.max_queue_depth = 0
+
         self._next_multicast_seq = 0
 
         self._init_ack = 0
 
     def _drop_self(self):
+        self._cancel_retransmit()
         # If we're still pending, then the upper layer doesn't know about us,
         # so don't tell them that we were lost.
         if self._state_receive == self._up_receive:
@@ -688,10 +895,34 @@ class RTPNeighbor(object):
         self._k5 = kvalues[4]
 
     def queue_full(self):
-        """Returns True if the transmit queue is full. There is a window of 1,
-        so if anything is in the queue it is considered full.
-        Otherwise returns False."""
-        return len(self._queue) != 0
+        """Returns True if a packet multicast now could not be accepted by
+        this neighbor in order, which is whenever anything is queued for it.
+        Otherwise returns False.
+
+        A multicast can't say which packet was sent to each neighbor before
+        it (see _enqueue), so with a window larger than 1 a neighbor with
+        packets in flight gets the multicast as a unicast instead."""
+        return len(self._queue) > 0
+
+    def queue_depth(self):
+        """Returns the number of sequenced packets waiting to be sent or
+        waiting to be acknowledged."""
+        return len(self._queue)
+
+    def inflight(self):
+        """Returns the number of sent packets waiting to be acknowledged."""
+        return self._inflight
+
+    def held(self):
+        """Returns the number of received packets waiting for an earlier
+        packet from this neighbor."""
+        return len(self._held)
+
+    def _get_window_size(self):
+        # Only the INIT packet can be outstanding until the adjacency is up.
+        if self._state_receive == self._pending_receive:
+            return 1
+        return self._window_size
 
     def receive(self, hdr, tlvs):
         """Deals with updating last heard time and processing ACKs.
@@ -801,6 +1032,11 @@ class RTPNeighbor(object):
 
     def _pending_receive(self, hdr, tlvs):
         """Receive function that is used when the adjacency is PENDING."""
+        # Sequenced packets are ACKed in this state, the neighbor's INIT in
+        # particular. Anything the neighbor sends after it follows on from
+        # it.
+        if hdr.seq > self._seq_from:
+            self._seq_from = hdr.seq
         # Look for an ACK to our INIT packet to transition to UP.
         if hdr.opcode == self._rtphdr.OPC_HELLO and \
            not hdr.ack:
@@ -810,7 +1046,7 @@ class RTPNeighbor(object):
         if not hdr.ack:
             return self.DROP
         curmsg = self._peekrtp()
-        if not curmsg:
+        if not curmsg or not self._inflight:
             # We got an ACK but we weren't waiting for an ACK.
             # Should we still let the upper layer process the packet?
             self.log.debug("Received spurious ACK from neighbor {}. "
@@ -819,11 +1055,9 @@ class RTPNeighbor(object):
         if hdr.ack == curmsg.hdr.seq:
             self.log.debug5("Received ACK {} for INIT pkt {}. Bringing "
                             "adjacency up".format(hdr.ack, self._peekrtp()))
-            self._poprtp()
-            self._retransmit_event.cancel()
+            self._retire(0)
             self._state_receive = self._up_receive
-            if self._peekrtp():
-                self._retransmit(time.time())
+            self._fill_window()
             return self.NEW_ADJACENCY
         self.log.debug5("Expected ACK for {}, but got "
                         "{}.".format(curmsg.hdr.seq, hdr.ack))
@@ -832,36 +1066,77 @@ class RTPNeighbor(object):
     def _handle_ack(self, hdr):
         if not hdr.ack:
             return self.PROCESS
-        curmsg = self._peekrtp()
-        if not curmsg:
+        if not self._inflight:
             # We got an ACK but we weren't waiting for an ACK.
             # We should still let the upper layer process the packet.
             self.log.debug("Received spurious ACK from neighbor {}. "
                            "Header: {}".format(self, hdr))
             return self.PROCESS
-        if hdr.ack == curmsg.hdr.seq:
-            self.log.debug5("Received ACK {} for pkt {}"
-                            "".format(hdr.ack, self._peekrtp()))
-            self._poprtp()
-            self._retransmit_event.cancel()
-            if self._peekrtp():
-                self._retransmit(time.time())
+
+        # Find the acknowledged packet within the window. Sequence numbers
+        # come from a counter that is shared by every neighbor and by
+        # multicasts, so the neighbor can't tell if it missed a packet that
+        # was sent to it before the one it is acknowledging. That means an
+        # ACK can only retire the packet it names, not everything older.
+        for index in xrange(self._inflight):
+            if self._queue[-1 - index].hdr.seq == hdr.ack:
+                break
         else:
             # We should still process the packet in this case.
-            self.log.debug5("Expected ACK for {}, but got "
-                            "{}.".format(curmsg.hdr.seq, hdr.ack))
+            self.log.debug5("Expected ACK for one of {}, but got "
+                            "{}.".format(self._inflight_seqs(), hdr.ack))
+            return self.PROCESS
+        self.log.debug5("Received ACK {} for pkt {}"
+                        "".format(hdr.ack, self._queue[-1 - index]))
+        self.acks_received += 1
+        self._retire(index)
+        self._fill_window()
         return self.PROCESS
 
+    def _inflight_seqs(self):
+        return [self._queue[-1 - i].hdr.seq for i in xrange(self._inflight)]
+
+    def _retire(self, index):
+        """Remove the in-flight packet at the given position in the window
+        (0 is the oldest) from the transmission queue. If it was the oldest
+        packet, restart the retransmit timer for the next one."""
+        pkt = self._queue[-1 - index]
+        del self._queue[-1 - index]
+        self._inflight -= 1
+        sent = self._send_times.pop(pkt.hdr.seq, None)
+        if sent is not None:
+            self._update_rtt(time.time() - sent)
+        if index == 0:
+            self._cancel_retransmit()
+            if self._inflight:
+                self._start_retransmit()
+
     def _up_receive(self, hdr, tlvs):
-        """Receive function that is used when the adjacency is UP."""
+        """Receive function that is used when the adjacency is UP.
+
+        Sequenced packets are passed to the upper layer in the order the
+        neighbor sent them. Sequence numbers are shared by all of the
+        neighbor's neighbors, so a gap in them doesn't mean a packet is
+        missing. Instead, a packet sent while the one before it was still
+        unacknowledged starts with a TLVPrevSeq naming that packet. If it
+        hasn't been delivered yet, the packet is held, without an ACK, until
+        it is."""
         # In the UP state, request that an ACK be sent for any sequenced
         # packet that we receive.
         # If self.next_ack is 0, then we won't send an ack (see how RTP.receive
         # handles it), so it's ok if hdr.seq is 0 here.
         self.next_ack = hdr.seq
-        if hdr.seq and \
-           hdr.seq == self._seq_from:
-            # We already received this packet, but our ack was dropped. Ack
+        if not hdr.seq:
+            return self._handle_ack(hdr)
+        if hdr.flags & self._rtphdr.FLAG_INIT:
+            # The neighbor has restarted the adjacency, and its sequence
+            # numbers with it.
+            self.log.debug("Received INIT from neighbor {} while "
+                           "UP".format(self))
+            self._held.clear()
+            self._seq_from = -1
+        if hdr.seq <= self._seq_from:
+            # We already passed this packet up, but our ack was dropped. Ack
             # but don't process. In some unexpected mode of operation,
             # it's possible that we could receive SEQ x from this neighbor,
             # then the neighbor rapidly increments its global SEQ number
@@ -871,23 +1146,61 @@ class RTPNeighbor(object):
             # Seems extremely unlikely for EIGRP, but could be more likely for
             # other protocols built on RTP.
             self.log.debug5("Received dupe packet, seq {}".format(hdr.seq))
+            self.dupes_received += 1
+            return self.DROP
+        prev = None
+        if tlvs and tlvs[0].type == rtptlv.TLVPrevSeq.TYPE:
+            prev = tlvs.pop(0).prevseq.seq
+        status = self._handle_ack(hdr)
+        if prev is not None and prev > self._seq_from:
+            self.log.debug5("Holding packet {} until {} is "
+                            "received".format(hdr.seq, prev))
+            self.next_ack = 0
+            # Retransmissions of a held packet replace it. Beyond the
+            # largest window, the neighbor can retransmit instead.
+            if prev in self._held or len(self._held) < self.MAX_WINDOW_SIZE:
+                self._held[prev] = (hdr, tlvs)
             return self.DROP
         self._seq_from = hdr.seq
-        return self._handle_ack(hdr)
+        while self._seq_from in self._held:
+            held = self._held.pop(self._seq_from)
+            self.ready.append(held)
+            self._seq_from = held[0].seq
+        return status
 
     def schedule_multicast_retransmission(self, pkt):
         """Schedule the retransmission of a multicast packet as a unicast."""
-        # Note: This is basically self._pushrtp except if the queue is empty
+        # Note: This is basically self._pushrtp except if the window is open
         # we don't send a unicast immediately. This is because we've already
-        # sent the packet as a multicast in the caller.
+        # sent the packet as a multicast in the caller. If anything was
+        # already queued (see queue_full), the caller listed us in a sequence
+        # TLV so we will ignore the multicast, and the packet is sent as a
+        # unicast once the window has room for it.
         # XXX For this reason, perhaps pushrtp can be refactored so that it
         # does not need to call write() either - then we could just call
         # pushrtp here. The caller would always call write.
-        if not self._peekrtp():
+        window_open = not self.queue_full()
+        self._enqueue(pkt)
+        if window_open:
             self._seq_to = pkt.hdr.seq
-            self._retransmit_event = reactor.callLater(self._retransmit_timer,
-                                                 self._retransmit, time.time())
+            self._send_times[pkt.hdr.seq] = time.time()
+            self._inflight += 1
+            if self._inflight == 1:
+                self._start_retransmit()
+        else:
+            self._fill_window()
+
+    def _enqueue(self, pkt):
+        """Add pkt to the transmission queue. Packets are sent in queue
+        order, so if the packet ahead of it may not be acknowledged by the
+        time pkt is sent, pkt is told which one that is."""
+        if self._queue and self._window_size > 1:
+            pkt = RTPPacket(pkt.hdr,
+                            [rtptlv.TLVPrevSeq(self._queue[0].hdr.seq)] +
+                            list(pkt.fields))
         self._queue.appendleft(pkt)
+        if len(self._queue) > self.max_queue_depth:
+            self.max_queue_depth = len(self._queue)
 
     def send(self, opcode, tlvs, ack, flags=0):
         """Wrapper for ReliableTransportProtocol.__send_rtp_unicast.
@@ -919,45 +1232,81 @@ class RTPNeighbor(object):
         else:
             self._pushrtp(pkt)
 
-    def _poprtp(self):
-        """Pop an RTP packet off of the transmission queue and return it,
-        or return None if there are no messages enqueued."""
-        try:
-            return self._queue.pop()
-        except IndexError:
-            return None
-
     def _pushrtp(self, pkt):
         """Push an RTP packet onto the transmission queue. This should only
         be used for packets that require an acknowledgement."""
-        if not self._peekrtp():
+        self._enqueue(pkt)
+        self._fill_window()
+
+    def _fill_window(self):
+        """Transmit queued packets until the window is full or there is
+        nothing left to send."""
+        window_size = self._get_window_size()
+        while self._inflight < window_size and \
+              self._inflight < len(self._queue):
+            pkt = self._queue[-1 - self._inflight]
             self._seq_to = pkt.hdr.seq
             # Note that we pass in "self" as the neighbor argument.
             self._write(neighbor=self,
                         pkt=pkt)
-            self._retransmit_event = reactor.callLater(self._retransmit_timer,
-                                                self._retransmit, time.time())
-        self._queue.appendleft(pkt)
+            self._send_times[pkt.hdr.seq] = time.time()
+            self.pkts_sent += 1
+            self._inflight += 1
+            if self._inflight == 1:
+                self._start_retransmit()
+
+    def _start_retransmit(self):
+        self._retransmit_event = self._timers.call_later(self.rto,
+                                                         self._retransmit,
+                                                         time.time())
+
+    def _update_rtt(self, rtt):
+        """Take a round trip time measurement and recompute the
+        retransmission timeout. See RFC 6298 section 2."""
+        if self.srtt is None:
+            self.srtt = rtt
+            self._rttvar = rtt / 2
+        else:
+            self._rttvar = (1 - self.RTT_BETA) * self._rttvar + \
+                           self.RTT_BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - self.RTT_ALPHA) * self.srtt + \
+                        self.RTT_ALPHA * rtt
+        rto = self.srtt + max(self.RTO_CLOCK_GRANULARITY,
+                              self.RTO_K * self._rttvar)
+        self.rto = min(max(rto, self.RTO_MIN), self.RTO_MAX)
+
+    def _backoff_rto(self):
+        """Double the retransmission timeout after a timer expires."""
+        self.rto = min(self.rto * 2, self.RTO_MAX)
+
+    def _get_max_retransmit_seconds(self):
+        return max(self.MAX_RETRANSMIT_SECONDS, self._holdtime)
+
+    def _cancel_retransmit(self):
+        if self._retransmit_event and self._retransmit_event.active():
+            self._retransmit_event.cancel()
+        self._retransmit_event = None
 
-    def _retransmit(self, init_time, first_call=True):
-        """Retransmit the current RTP packet.
-        init_time - The time this was first called
-        first_call - If this is the first time this function was called for
-                     the current packet. (Should always be True when called
-                     by anything other than this function.)
+    def _retransmit(self, init_time):
+        """Retransmit every packet in the window, oldest first.
+        init_time - The time the retransmit timer was started for the oldest
+                    packet in the window
         """
-        if not first_call:
-            self.log.debug("Retransmitting: {}".format(self._peekrtp()))
-        self._write(self, self._peekrtp())
+        for index in xrange(self._inflight):
+            pkt = self._queue[-1 - index]
+            self.log.debug("Retransmitting: {}".format(pkt))
+            self._write(self, pkt)
+            self._send_times[pkt.hdr.seq] = None
+            self.pkts_retransmitted += 1
+        self._backoff_rto()
 
         # If the next retransmit attempt will not exceed the max retrans time,
         # then schedule another retransmission.
-        if init_time + self._max_retransmit_seconds > \
-                       time.time() + self._retransmit_timer:
-            self._retransmit_event = reactor.callLater(self._retransmit_timer,
-                                                       self._retransmit,
-                                                       init_time,
-                                                       False)
+        if init_time + self._get_max_retransmit_seconds() > \
+                       time.time() + self.rto:
+            self._retransmit_event = self._timers.call_later(self.rto,
+                                                             self._retransmit,
+                                                             init_time)
         else:
             # I think we should drop the neighbor if we can't transmit to it.
             # DUAL won't operate correctly if RTP drops a sequenced
@@ -988,6 +1337,10 @@ class RTPInterface(object):
         """
         self._neighbors = dict()
         self.logical_iface = logical_iface
+        # The interface's address and prefix as integers, see ipv4.
+        ip = logical_iface.ip
+        self.address = int(ip.ip)
+        self.prefix = ipv4.make_prefix(self.address, ip.prefixlen)
         self._write = writefunc
         self._rtphdr = rtphdr
         self.activated = False
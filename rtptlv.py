@@ -3,20 +3,76 @@
 # XXX Is rtptlv the best name for this?
 
 import struct
-import ipaddr
+import array
+import operator
+
+import ipv4
+
+# NumPy is optional. It's only needed for Internal4Columns.to_numpy.
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class ValueMetaclass(type):
     """Convenience metaclass for values in the TLV.
-    Forces the format string to network byte ordering, calculates the
-    format length (LEN), and assigns a brief NAME attribute
-    based on the class name."""
+    Forces the format string to network byte ordering, compiles it into a
+    struct.Struct (STRUCT), calculates the format length (LEN), and assigns
+    a brief NAME attribute based on the class name.
+
+    Classes that define FIELDS get __slots__ for those fields, plus any
+    names the class lists in its own __slots__ for private state. Fields
+    that the class implements as properties are left out.
+
+    Classes that define FORMAT and don't define their own pack or unpack get
+    versions specialised to their STRUCT and fields, so packing doesn't
+    need to look up the format or fields on every call."""
+    def __new__(mcs, name, bases, dct):
+        if "FIELDS" in dct:
+            slots = [f for f in dct["FIELDS"] if f not in dct]
+            slots.extend(dct.get("__slots__", ()))
+            dct["__slots__"] = tuple(slots)
+        return super(type, mcs).__thisclass__.__new__(mcs, name, bases, dct)
+
     def __init__(cls, name, bases, dct):
         super(type, cls).__thisclass__.__init__(cls, name, bases, dct)
-        if hasattr(cls, "FORMAT"):
+        if "FORMAT" in dct:
             cls.FORMAT = ">" + cls.FORMAT
-            cls.LEN = struct.calcsize(cls.FORMAT)
+            cls.STRUCT = struct.Struct(cls.FORMAT)
+            cls.LEN = cls.STRUCT.size
+            if "MIN_LEN" not in dct:
+                cls.MIN_LEN = cls.LEN
+            if "pack" not in dct:
+                cls.pack = cls._make_pack(cls.STRUCT,
+                                          getattr(cls, "_PRIVFIELDS",
+                                                  cls.FIELDS))
+            if "unpack" not in dct:
+                cls.unpack = cls._make_unpack(cls.STRUCT)
         cls.NAME = name.lstrip("Value").lstrip("Classic").lower()
 
+    @staticmethod
+    def _make_pack(packer, fields):
+        pack = packer.pack
+        getfields = operator.attrgetter(*fields)
+        if len(fields) == 1:
+            def _pack(self):
+                """Return the binary representation of this object."""
+                return pack(getfields(self))
+        else:
+            def _pack(self):
+                """Return the binary representation of this object."""
+                return pack(*getfields(self))
+        return _pack
+
+    @staticmethod
+    def _make_unpack(packer):
+        unpack_from = packer.unpack_from
+        def _unpack(self, raw, offset=0, end=None):
+            """Return a tuple containing the unpacked representation of this
+            object. Return values corresponding to self.FIELDS."""
+            return unpack_from(raw, offset)
+        return _unpack
+
 
 class ValueBase(object):
     """Base class for the "value" section of a TLV. This is primarily for
@@ -27,17 +83,34 @@ class ValueBase(object):
     FIELDS should be a list of strings describing the fields within the value.
     FORMAT is the format to be used with struct.pack/unpack.
     LEN is the return value of struct.calcsize(FORMAT). Classes that inherit
-        from ValueBase will have this attribute set by the ValueMetaclass.
+        from ValueBase will have this attribute set by the ValueMetaclass,
+        along with STRUCT, the compiled FORMAT.
+    MIN_LEN is the fewest bytes the value can be packed into. It defaults to
+        LEN for classes with a FORMAT, and should be set by variable-length
+        values that have a fixed part.
+
+    Because of the __slots__ set up by ValueMetaclass, a derived class with
+    FIELDS can only have attributes named in FIELDS or in its own
+    __slots__.
 
     Derived classes may also have to override the (un)pack functions if they
     have non-scalar fields or fields that require extra processing after
     pack/unpack is called. For example, to do validation or convert a
-    binary IP into a dotted quad."""
+    binary IP into a dotted quad.
+
+    When unpacking, raw can be a str or a memoryview of the whole packet.
+    Values are read in place starting at offset, so the caller never needs
+    to slice the packet for each value."""
 
     __metaclass__ = ValueMetaclass
+    __slots__ = ()
+
+    MIN_LEN = 0
 
     def __init__(self, *args, **kwargs):
-        """The only expected keyword arg is 'raw'"""
+        """The expected keyword args are 'raw' and optionally 'offset', the
+        index in raw at which this value starts, and 'end', the index in raw
+        at which the enclosing TLV's data ends."""
         if kwargs and args:
             raise ValueError("Either args or kwargs are expected, not both.")
         if "raw" in kwargs:
@@ -46,12 +119,12 @@ class ValueBase(object):
             self._parse_args(args)
         else:
             raise ValueError("One of args or kwargs['raw'] is expected.")
-        self._packed = None
 
     def _parse_kwargs(self, kwargs):
         """Override in subclass if different parsing is needed."""
         for k, v in map(None, self._get_public_fields(),
-                        self.unpack(kwargs["raw"])):
+                        self.unpack(kwargs["raw"], kwargs.get("offset", 0),
+                                    kwargs.get("end"))):
             setattr(self, k, v)
 
     def _parse_args(self, args):
@@ -66,9 +139,10 @@ class ValueBase(object):
         return self.FIELDS
 
     def _get_private_fields(self):
-        """Get private class fields. Override in subclass if this should
-        return something other than the regular self.FIELDS."""
-        return self.FIELDS
+        """Get private class fields, in the order they are packed. Set
+        _PRIVFIELDS in the subclass if this should be something other than
+        the regular self.FIELDS."""
+        return getattr(self, "_PRIVFIELDS", self.FIELDS)
 
     def getlen(self):
         """Get the format length. Override in subclass if this should return
@@ -76,21 +150,17 @@ class ValueBase(object):
         return self.LEN
 
     def pack(self):
-        """Return the binary representation of this object."""
-        if not self._packed:
-            self._packed = struct.pack(self.FORMAT,
-                       *[getattr(self, f) for f in self._get_private_fields()])
-        return self._packed
+        """Return the binary representation of this object. Classes with a
+        FORMAT get a faster version of this from ValueMetaclass."""
+        fields = self._get_private_fields()
+        return struct.pack(self.FORMAT, *[getattr(self, f) for f in fields])
 
-    def unpack(self, raw):
+    def unpack(self, raw, offset=0, end=None):
         """Return a tuple containing the unpacked representation of this
-        object. Return values corresponding to self.FIELDS."""
-        return struct.unpack(self.FORMAT, raw[:self.getlen()])
-
-    def __setattr__(self, attr, val):
-        """Force a repack if an attribute was modified after the last pack."""
-        super(object, self).__thisclass__.__setattr__(self, "_packed", None)
-        super(object, self).__thisclass__.__setattr__(self, attr, val)
+        object. Return values corresponding to self.FIELDS.
+        end is only needed by variable-length values that extend to the
+        end of the TLV."""
+        return struct.unpack_from(self.FORMAT, raw, offset)
 
     def __str__(self):
         s = type(self).__name__ + "("
@@ -102,22 +172,28 @@ class ValueBase(object):
 
 
 class ValueNexthop(ValueBase):
+    # ip is stored as an integer. It can be given as a string or an
+    # ipaddr.IPv4Address as well.
     FIELDS = [ "ip" ]
     FORMAT = "I"
 
     def __init__(self, *args, **kwargs):
         super(ValueBase, self).__thisclass__.__init__(self, *args, **kwargs)
         if args:
-            self.ip = ipaddr.IPv4Address(self.ip)
+            self.ip = ipv4.aton(self.ip)
 
-    def unpack(self, raw):
-        return [ipaddr.IPv4Address(super(ValueBase,
-                                   self).__thisclass__.unpack(self, raw)[0])]
+    def __str__(self):
+        return type(self).__name__ + "(ip=" + ipv4.ntoa(self.ip) + ")"
 
-    def pack(self):
-        if not self._packed:
-            self._packed = self.ip.packed
-        return self._packed
+
+def _metric_field(name):
+    """Return a property for a metric field that the composite metric is
+    computed from. Setting it clears the cached composite metric."""
+    attr = "_" + name
+    def _set(self, val):
+        setattr(self, attr, val)
+        self._computed_metric = None
+    return property(operator.attrgetter(attr), _set)
 
 
 class ValueClassicMetric(ValueBase):
@@ -126,6 +202,8 @@ class ValueClassicMetric(ValueBase):
     _PRIVFIELDS = [ "dly", "bw", "mtuhigh", "mtulow", "hops", "rel", "load",
                     "tag", "flags" ]
     FORMAT = "IIHBBBBBB"
+    __slots__ = ("_mtu", "_mtuhigh", "_mtulow", "_dly", "_bw", "_rel",
+                 "_load", "_computed_metric", "_metric_generation")
 
     # Bandwidth and delay are scaled up by this number. See RFC section 5.5,
     # EIGRP Metric Coefficients.
@@ -133,14 +211,31 @@ class ValueClassicMetric(ValueBase):
 
     METRIC_UNREACHABLE = 0xFFFFFFFF
 
+    # compute_metric caches its result along with the K-value generation it
+    # was computed in. Call new_kvalue_generation whenever the K-values
+    # change so that every cached metric is recomputed.
+    kvalue_generation = 0
+
+    dly  = _metric_field("dly")
+    bw   = _metric_field("bw")
+    rel  = _metric_field("rel")
+    load = _metric_field("load")
+
     def __init__(self, *args, **kwargs):
         self._mtulow = 0
         self._mtuhigh = 0
         self._computed_metric = None
         super(ValueBase, self).__thisclass__.__init__(self, *args, **kwargs)
 
-    def _get_private_fields(self):
-        return self._PRIVFIELDS
+    @staticmethod
+    def new_kvalue_generation():
+        """Invalidate the cached composite metric of every metric object.
+        Call this when the K-values change."""
+        ValueClassicMetric.kvalue_generation += 1
+
+    def clear_saved_metric(self):
+        """Invalidate the cached composite metric of this object only."""
+        self._computed_metric = None
 
     @property
     def mtuhigh(self):
@@ -168,41 +263,59 @@ class ValueClassicMetric(ValueBase):
     def mtu(self, val):
         self._mtu = val
         if self._mtu:
-            self._mtuhigh, self._mtulow = divmod(self._mtu, 0x10000)
+            self._mtuhigh, self._mtulow = divmod(self._mtu, 0x100)
 
     @staticmethod
     def _calc_mtu(high, low):
         """Add the 2 high bytes and 1 low byte to get the actual mtu."""
         return low + (high << 8)
 
-    def unpack(self, raw):
+    def unpack(self, raw, offset=0, end=None):
         """Find the two-value mtu (split into high and low bytes) and
         replace them with a single value mtu."""
-        unpacked = super(ValueBase, self).__thisclass__.unpack(self, raw)
-        mtuhigh_index = self.FIELDS.index("mtu")
-        mtuhigh = unpacked[mtuhigh_index]
-        mtulow = unpacked[mtuhigh_index+1]
-        mtu = self._calc_mtu(mtuhigh, mtulow)
-        return unpacked[:mtuhigh_index] + tuple([mtu]) + \
-               unpacked[mtuhigh_index+2:]
+        dly, bw, mtuhigh, mtulow, hops, rel, load, tag, flags = \
+             self.STRUCT.unpack_from(raw, offset)
+        return (dly, bw, self._calc_mtu(mtuhigh, mtulow), hops, rel, load,
+                tag, flags)
 
     def compute_metric(self, k1, k2, k3, k4, k5):
-        """Return a metric integer based on the input k values."""
+        """Return a metric integer based on the input k values.
+        The result is cached until one of the fields it depends on is set or
+        new_kvalue_generation is called, so the k values passed in must be
+        the ones currently in use."""
+        if self._computed_metric is not None and \
+           self._metric_generation == self.kvalue_generation:
+            return self._computed_metric
+        self._computed_metric = self._composite(self.dly, self.bw, self.rel,
+                                                self.load, k1, k2, k3, k4, k5)
+        self._metric_generation = self.kvalue_generation
+        return self._computed_metric
+
+    @classmethod
+    def fields_metric(cls, fields, k1, k2, k3, k4, k5):
+        """As compute_metric, for a metric given as a sequence of field
+        values in the order of FIELDS, such as a row of Internal4Columns.
+        No metric object is built, and nothing is cached."""
+        return cls._composite(fields[0], fields[1], fields[4], fields[5],
+                              k1, k2, k3, k4, k5)
+
+    @classmethod
+    def _composite(cls, dly, bw, rel, load, k1, k2, k3, k4, k5):
         # See RFC section 5.5.1.1, Classic Composite Formulation.
-        metric = k1 * self.bw * self.METRIC_SCALE + \
-                 k2 * self.bw / (256 - self.load) + \
-                 k3 * self.dly * self.METRIC_SCALE
+        metric = k1 * bw * cls.METRIC_SCALE + \
+                 k2 * bw / (256 - load) + \
+                 k3 * dly * cls.METRIC_SCALE
 
-        # If k5 isn't set, or if k4 and self.rel are both 0, then
+        # If k5 isn't set, or if k4 and rel are both 0, then
         # we would either end up with a multiplier of 0 or a div by 0
-        # error. Note that self.rel would only be 0 if a malformed
+        # error. Note that rel would only be 0 if a malformed
         # packet was sent.
         # Instead, use a multiplier of 1.
         # A higher unreliability multiplier means a worse metric will be
         # computed.
         if k5 and \
-           (k4 or self.rel):
-            unreliability_multiplier = k5 / (k4 + self.rel)
+           (k4 or rel):
+            unreliability_multiplier = k5 / (k4 + rel)
         else:
             unreliability_multiplier = 1
 
@@ -215,22 +328,36 @@ class ValueClassicMetric(ValueBase):
     def update_for_iface(self, iface):
         """Update the TLV metrics so that it is correct if the TLV is
         advertised out of the provided iface."""
-        iface_bw = iface.logical_iface.phy_iface.get_bandwidth()
-        if iface_bw < self.bw:
-            self.bw = iface_bw
-
-        # XXX Need to lookup if these are additive or the lowest/highest along
-        # the path.
-        self.dly  += iface.logical_iface.phy_iface.get_delay()
-        self.load += iface.logical_iface.phy_iface.get_load()
-        unreliability = 255 - iface.logical_iface.phy_iface.get_reliability()
-        self.rel -= unreliability
-        if self.rel < 0:
-            self.rel = 0
-
-        self.hops += 1
-        if iface.logical_iface.phy_iface.get_mtu() < self.mtu:
-            self.mtu = iface.logical_iface.phy_iface.get_mtu()
+        self.dly, self.bw, self.mtu, self.hops, self.rel, self.load, \
+            self.tag, self.flags = self.fields_for_iface(
+                [ getattr(self, field) for field in self.FIELDS ], iface)
+
+    @classmethod
+    def fields_for_iface(cls, fields, iface):
+        """As update_for_iface, for a metric given as a sequence of field
+        values in the order of FIELDS. Returns the updated values as a
+        list."""
+        dly, bw, mtu, hops, rel, load, tag, flags = fields
+        phy_iface = iface.logical_iface.phy_iface
+
+        # bw is inverse bandwidth, so the slowest link along the path has
+        # the highest value.
+        bw = max(bw, phy_iface.get_bandwidth())
+
+        # Delay is additive. An unreachable delay has to stay unreachable,
+        # and has to fit in the 32 bit field.
+        dly  = min(dly + phy_iface.get_delay(), cls.METRIC_UNREACHABLE)
+
+        # Load and reliability are those of the worst link along the path.
+        load = max(load, phy_iface.get_load())
+        rel  = min(rel, phy_iface.get_reliability())
+
+        hops += 1
+        # An MTU of 0 hasn't been set yet, as for local routes.
+        iface_mtu = phy_iface.get_mtu()
+        if not mtu or iface_mtu < mtu:
+            mtu = iface_mtu
+        return [ dly, bw, mtu, hops, rel, load, tag, flags ]
 
     def reachable(self):
         """Determines if the route is reachable.
@@ -238,44 +365,50 @@ class ValueClassicMetric(ValueBase):
         considered unreachable."""
         return self.dly != self.METRIC_UNREACHABLE
 
+    @classmethod
+    def fields_reachable(cls, fields):
+        """As reachable, for a metric given as a sequence of field values
+        in the order of FIELDS."""
+        return fields[0] != cls.METRIC_UNREACHABLE
+
 
 class ValueClassicDest(ValueBase):
-    # FORMAT and LEN are only set after init or unpacking because addr is a
-    # variable length depending on what is being unpacked.
+    # There is no FORMAT because only as many bytes of addr as are needed
+    # for plen are sent, so the length depends on plen. See getlen.
+    # addr is stored as an integer.
     FIELDS = [ "plen", "addr" ]
+    MIN_LEN = 1
+
+    _PLEN = struct.Struct("B")
+    _ADDR = struct.Struct(">I")
 
     def __init__(self, *args, **kwargs):
         super(ValueBase, self).__thisclass__.__init__(self, *args, **kwargs)
 
     def _parse_args(self, args):
         self.plen = args[0]
-        self.addr = ipaddr.IPv4Address(args[1])
-        self._setformat(self.plen)
+        self.addr = ipv4.aton(args[1])
 
-    def _setformat(self, plen):
-        self.FORMAT = ">B%ds" % self._getaddrpacklen(plen)
-        self.LEN = struct.calcsize(self.FORMAT)
-
-    def unpack(self, raw):
-        plen = struct.unpack("B", raw[0])[0]
-        self._setformat(plen)
+    def unpack(self, raw, offset=0, end=None):
+        plen = self._PLEN.unpack_from(raw, offset)[0]
         addrlen = self._getaddrpacklen(plen)
-        padded_addr = raw[1:1+addrlen] + "\x00" * (4 - addrlen)
-        raw_addr = struct.unpack(">I", padded_addr)[0]
-        addr = ipaddr.IPv4Address(raw_addr)
+        padded_addr = struct.unpack_from("%ds" % addrlen, raw, offset+1)[0] + \
+                      "\x00" * (4 - addrlen)
+        addr = self._ADDR.unpack(padded_addr)[0]
 
         return plen, addr
 
-        #return struct.unpack(self.FORMAT, raw[:self.getlen()])
-        #plen, addr = super(ValueBase, self).__thisclass__.unpack(self, raw)
-        #self._setformat(plen)
-        #return plen, ipaddr.IPv4Address(ipaddr.Bytes(addr.ljust(4, "\x00")))
-
     def pack(self):
-        if not self._packed:
-            self._packed = struct.pack("B", self.plen) + \
-                           self.addr.packed[:self._getaddrpacklen(self.plen)]
-        return self._packed
+        return self._PLEN.pack(self.plen) + \
+               self._ADDR.pack(self.addr)[:self._getaddrpacklen(self.plen)]
+
+    def __str__(self):
+        return "{}(plen={}, addr={})".format(type(self).__name__, self.plen,
+                                             ipv4.ntoa(self.addr))
+
+    def getlen(self):
+        # +1 is for the prefix length
+        return self._getaddrpacklen(self.plen) + 1
 
     def _getpacklen(self, raw):
         if not raw:
@@ -315,7 +448,8 @@ class ValueSeq(ValueBase):
         super(ValueBase, self).__thisclass__.__init__(self, *args, **kwargs)
 
     def _parse_kwargs(self, kwargs):
-        self.addrs = self.unpack(kwargs["raw"])
+        self.addrs = self.unpack(kwargs["raw"], kwargs.get("offset", 0),
+                                 kwargs.get("end"))
 
     def _parse_args(self, args):
         # The addrlen field is derived from len(addr)
@@ -328,26 +462,22 @@ class ValueSeq(ValueBase):
         self.addrs.append(addr)
 
     def pack(self):
-        if not self._packed:
-            # Only assign to self._packed once because parent's
-            # __setattr__ will clear self._packed every time it is modified.
-            packed = ""
-            for addr in self.addrs:
-                packed += struct.pack(self.ADDRLEN_FMT, len(addr))
-                packed += addr
-            self._packed = packed
-        return self._packed
-
-    def unpack(self, raw):
-        offset = 0
-        rawlen = len(raw)
+        packed = ""
+        for addr in self.addrs:
+            packed += struct.pack(self.ADDRLEN_FMT, len(addr))
+            packed += addr
+        return packed
+
+    def unpack(self, raw, offset=0, end=None):
+        if end is None:
+            end = len(raw)
         seq_addrs = list()
 
         # Save off addresses until there is no more data.
         # Addresses are in binary and could be any length, though
         # typical lengths are 4 for IPv4 and 16 for IPv6. We'll support
         # addresses of any length here.
-        while offset < rawlen:
+        while offset < end:
             size = struct.unpack_from(self.ADDRLEN_FMT, raw, offset)[0]
             offset += self.ADDRLEN_FMT_SIZE
             seq_addrs.append(struct.unpack_from("%ss" % size, raw, offset)[0])
@@ -369,6 +499,11 @@ class ValueMulticastSeq(ValueBase):
     FORMAT = "I"
 
 
+class ValuePrevSeq(ValueBase):
+    FIELDS = [ "seq" ]
+    FORMAT = "I"
+
+
 class TLVBase(object):
     """Base class for EIGRP TLVs."""
 
@@ -379,15 +514,27 @@ class TLVBase(object):
     HDR_FORMAT = ">HH"
     HDR_LEN = struct.calcsize(HDR_FORMAT)
 
+    # (raw, offset) of a lazily built TLV whose values haven't been decoded
+    # yet.
+    _lazy = None
+
     def __init__(self, *args, **kwargs):
-        """There is only one used kwarg: "raw".
+        """The used kwargs are "raw" and optionally "offset", the index in
+        raw at which this TLV starts, and "lazy". raw can be a str or a
+        memoryview.
+        If lazy is True, only the TLV header is read from raw now. The values
+        are decoded from raw the first time one of them is accessed, so
+        errors in them are raised then instead of here.
         args should be all required arguments for the TLV's Value members.
         """
         self.type = self.TYPE
         if args and kwargs:
             raise ValueError("Either args or kwargs is expected, not both.")
         if "raw" in kwargs:
-            self._parse_kwargs(kwargs)
+            if kwargs.get("lazy"):
+                self._defer_unpack(kwargs["raw"], kwargs.get("offset", 0))
+            else:
+                self._parse_kwargs(kwargs)
         elif args:
             self._parse_args(args)
         else:
@@ -395,7 +542,7 @@ class TLVBase(object):
 
     def _parse_kwargs(self, kwargs):
         """Override in subclass to parse kwargs for a TLV differently."""
-        hdr, values = self.unpack(kwargs["raw"])
+        hdr, values = self.unpack(kwargs["raw"], kwargs.get("offset", 0))
         for valclass, instance in map(None, self.VALUES, values):
             setattr(self, valclass.NAME, instance)
 
@@ -407,7 +554,40 @@ class TLVBase(object):
             setattr(self, valclass.NAME, valclass(*args[index:index+nargs]))
             index += nargs
 
+    def _defer_unpack(self, raw, offset):
+        """Read only the header now and keep a reference to raw so the
+        values can be decoded later by __getattr__."""
+        self.len = self.unpackhdr(raw, offset)[1]
+        self._checklen(self.len, len(raw) - offset)
+        # The length isn't checked against the values until they are
+        # decoded, but it has to cover the fixed part of them, or at least
+        # the header, for build_all to make progress past this TLV.
+        minlen = self.HDR_LEN
+        for valclass in self.VALUES:
+            minlen += valclass.MIN_LEN
+        if self.len < minlen:
+            raise(ValueError("TLV values overrun the TLV by {} "
+                             "bytes.".format(minlen - self.len)))
+        self._lazy = raw, offset
+
+    def __getattr__(self, attr):
+        """Only called when attr isn't found normally. If this TLV was built
+        lazily and attr is one of its values, decode the values now."""
+        if self._lazy:
+            for valclass in self.VALUES:
+                if valclass.NAME == attr:
+                    raw, offset = self._lazy
+                    self._lazy = None
+                    self._parse_kwargs(dict(raw=raw, offset=offset))
+                    return getattr(self, attr)
+        raise AttributeError("'{}' object has no attribute "
+                             "'{}'".format(type(self).__name__, attr))
+
     def getlen(self):
+        if self._lazy:
+            # Not decoded yet. Trust the length in the header rather than
+            # decoding the values to find it.
+            return self.len
         totallen = 0
         for valclass in self.VALUES:
             totallen += getattr(self, valclass.NAME).getlen()
@@ -435,32 +615,42 @@ class TLVBase(object):
         return struct.pack(self.HDR_FORMAT, self.type, self.getlen())
 
     @staticmethod
-    def unpackhdr(raw):
-        return struct.unpack(TLVBase.HDR_FORMAT, raw[:TLVBase.HDR_LEN])
+    def unpackhdr(raw, offset=0):
+        return struct.unpack_from(TLVBase.HDR_FORMAT, raw, offset)
 
-    def unpackvalues(self, raw):
-        index = 0
+    def unpackvalues(self, raw, offset, end):
+        """Unpack this TLV's values from raw[offset:end] without copying
+        raw."""
+        index = offset
         objs = list()
         for valclass in self.VALUES:
-            obj = valclass(raw=raw[index:])
+            obj = valclass(raw=raw, offset=index, end=end)
             objs.append(obj)
             index += obj.getlen()
+        if index > end:
+            raise(ValueError("TLV values overrun the TLV by {} "
+                             "bytes.".format(index - end)))
         return objs
 
-    def unpack(self, raw):
-        hdr = self.unpackhdr(raw)
+    def unpack(self, raw, offset=0):
+        hdr = self.unpackhdr(raw, offset)
+
+        # Don't unpack the pad bytes, if any, as values.
+        self._checklen(hdr[1], len(raw) - offset)
+        values = self.unpackvalues(raw, offset + self.HDR_LEN,
+                                   offset + hdr[1])
+        return hdr, values
 
-        # Don't pass in the pad bytes, if any, when unpacking values.
-        padlen = len(raw) - hdr[1]
+    @staticmethod
+    def _checklen(hdrlen, rawlen):
+        """Raise ValueError if the length in a TLV header runs past the
+        end of the data."""
+        padlen = rawlen - hdrlen
         if padlen < 0:
             raise(ValueError("Invalid pad length: {}. Length in header: {}, "
                              "actual raw length: {}".format(padlen,
-                                                            hdr[1],
-                                                            len(raw))))
-        actual_data_len = len(raw) - padlen - self.HDR_LEN
-        values = self.unpackvalues(raw[self.HDR_LEN:self.HDR_LEN+\
-                                                    actual_data_len])
-        return hdr, values
+                                                            hdrlen,
+                                                            rawlen)))
 
     @staticmethod
     def getpad(datalen, alignment=4):
@@ -516,30 +706,165 @@ class TLVPeerTIDList(TLVBase):
     VALUES = [ ]
 
 
+class TLVPrevSeq(TLVBase):
+    # Not an EIGRP TLV. RTP puts this first in a sequenced packet when the
+    # packet before it to the same neighbor hasn't been acknowledged yet,
+    # so the neighbor can deliver the packets in order (see
+    # RTPNeighbor._up_receive). It is only sent with a window size above 1,
+    # so neighbors that don't understand it only see it if we are
+    # configured that way.
+    TYPE   = TLVBase.PROTO_GENERIC | 0xf0
+    VALUES = [ ValuePrevSeq ]
+
+
 class TLVInternal4(TLVBase):
     TYPE   = TLVBase.PROTO_IP4 | 2
     VALUES = [ ValueNexthop, ValueClassicMetric, ValueClassicDest ]
 
 
+class Internal4Columns(object):
+
+    """The routes from a batch of TLVInternal4s, stored column-wise in one
+    array per field instead of as three Value objects per route. Addresses
+    are stored as integers, like they are in the Value objects.
+
+    Routes can be appended straight from raw packet data (see
+    TLVFactory.build_columns), from lazily built TLVs that haven't been
+    decoded yet, or from decoded TLVs."""
+
+    # (name, array typecode, NumPy type) for each column.
+    COLUMNS = [ ("prefix",  "I", "u4"),
+                ("plen",    "B", "u1"),
+                ("nexthop", "I", "u4"),
+                ("dly",     "I", "u4"),
+                ("bw",      "I", "u4"),
+                ("mtu",     "I", "u4"),
+                ("hops",    "B", "u1"),
+                ("rel",     "B", "u1"),
+                ("load",    "B", "u1"),
+                ("tag",     "B", "u1"),
+                ("flags",   "B", "u1"),
+              ]
+
+    # Everything in a TLVInternal4 up to the destination's address bytes:
+    # the TLV header, next hop, classic metric, and prefix length.
+    _FIXED = struct.Struct(TLVBase.HDR_FORMAT + "IIIHBBBBBBB")
+    _ADDR  = struct.Struct(">I")
+    _ADDR_BYTES = [ struct.Struct(">%dB" % n) for n in xrange(4) ]
+
+    def __init__(self):
+        for name, typecode, dtype in self.COLUMNS:
+            setattr(self, name, array.array(typecode))
+
+    def __len__(self):
+        return len(self.prefix)
+
+    def append(self, prefix, plen, nexthop, dly, bw, mtu, hops, rel, load,
+               tag, flags):
+        self.prefix.append(prefix)
+        self.plen.append(plen)
+        self.nexthop.append(nexthop)
+        self.dly.append(dly)
+        self.bw.append(bw)
+        self.mtu.append(mtu)
+        self.hops.append(hops)
+        self.rel.append(rel)
+        self.load.append(load)
+        self.tag.append(tag)
+        self.flags.append(flags)
+
+    def append_raw(self, raw, offset=0):
+        """Decode the TLVInternal4 at offset in raw and append its route.
+        Returns the length of the TLV including padding."""
+        _type, tlvlen, nexthop, dly, bw, mtuhigh, mtulow, hops, rel, load, \
+            tag, flags, plen = self._FIXED.unpack_from(raw, offset)
+        if not 0 <= plen <= 32:
+            raise ValueError("Plen must be between 0 and 32.")
+        TLVBase._checklen(tlvlen, len(raw) - offset)
+        addr_offset = offset + self._FIXED.size
+        addrlen = ValueClassicDest._getaddrpacklen(plen)
+        if addrlen == 4:
+            prefix = self._ADDR.unpack_from(raw, addr_offset)[0]
+        else:
+            prefix = 0
+            for byte in self._ADDR_BYTES[addrlen].unpack_from(raw,
+                                                              addr_offset):
+                prefix = prefix << 8 | byte
+            prefix <<= 8 * (4 - addrlen)
+        if addr_offset + addrlen - offset > tlvlen:
+            raise(ValueError("TLV values overrun the TLV by {} "
+                             "bytes.".format(addr_offset + addrlen - offset -
+                                             tlvlen)))
+        self.append(prefix, plen, nexthop, dly, bw,
+                    ValueClassicMetric._calc_mtu(mtuhigh, mtulow), hops, rel,
+                    load, tag, flags)
+        return tlvlen + TLVBase.getpad(tlvlen)
+
+    def append_tlv(self, tlv):
+        """Append the route from a TLVInternal4. If the TLV was built lazily
+        and hasn't been decoded yet, it is read from the packet without
+        decoding it."""
+        if tlv._lazy:
+            self.append_raw(*tlv._lazy)
+            return
+        metric = tlv.metric
+        self.append(tlv.dest.addr, tlv.dest.plen, tlv.nexthop.ip,
+                    metric.dly, metric.bw, metric.mtu, metric.hops,
+                    metric.rel, metric.load, metric.tag, metric.flags)
+
+    def fields(self, index):
+        """Return the metric of the route at index as a tuple of field
+        values, in the order of ValueClassicMetric.FIELDS. Cheaper than
+        building the metric object itself."""
+        return (self.dly[index], self.bw[index], self.mtu[index],
+                self.hops[index], self.rel[index], self.load[index],
+                self.tag[index], self.flags[index])
+
+    def metric(self, index):
+        """Return a ValueClassicMetric for the route at index."""
+        return ValueClassicMetric(self.dly[index], self.bw[index],
+                                  self.mtu[index], self.hops[index],
+                                  self.rel[index], self.load[index],
+                                  self.tag[index], self.flags[index])
+
+    def to_numpy(self):
+        """Return the routes as a NumPy structured array with one field per
+        column. Requires NumPy."""
+        if not numpy:
+            raise NotImplementedError("NumPy is not installed.")
+        routes = numpy.empty(len(self), dtype=[(name, dtype) for name, _, dtype
+                                               in self.COLUMNS])
+        for name, typecode, dtype in self.COLUMNS:
+            routes[name] = getattr(self, name)
+        return routes
+
+
 class TLVFactory(object):
 
     """Factory for arbitrary Type Length Value fields."""
 
     def __init__(self, tlvclasses=None, hdr_unpacker=TLVBase.unpackhdr,
-                 typeindex=0):
+                 typeindex=0, lazy=False):
         """tlvclasses is an iterable of classes to register during init.
         hdr_unpacker is a function that can be used to unpack TLV headers for
-                     the format your TLVs will use. This should return
-                     an indexable object containing at least a "type" field.
+                     the format your TLVs will use. It is called with the
+                     raw data and the offset of the TLV within it, and
+                     should return an indexable object containing at least
+                     a "type" field.
         typeindex is the index of the "type" field that is returned from
                   hdr_unpacker. It does seem silly for this to be something
                   other than 0 given the order of words in the name "TLV",
-                  but it's an option."""
+                  but it's an option.
+        lazy - If True, TLVs are built with only their headers read. Their
+               values are decoded when first accessed (see TLVBase). This
+               makes building TLVs for packets that end up being dropped
+               almost free."""
         self._tlvs = dict()
         if tlvclasses:
             self.register_tlvs(tlvclasses)
         self._unpack_hdr = hdr_unpacker
         self._typeindex = typeindex
+        self._lazy = lazy
 
     def register_tlvs(self, tlvclasses):
         try:
@@ -551,21 +876,44 @@ class TLVFactory(object):
                 raise ValueError("TLV type %d already registered." % tlv.TYPE)
             self._tlvs[tlv.TYPE] = tlv
 
-    def build_all(self, raw):
-        """Build and return a list of all TLVs parsed from raw data."""
-        index = 0
+    def build_all(self, raw, offset=0):
+        """Build and return a list of all TLVs parsed from raw data, starting
+        at offset. raw can be a str or a memoryview, and is never copied."""
+        index = offset
         rawlen = len(raw)
         tlvs = list()
         while index < rawlen:
-            tlv = self.build(raw[index:])
+            tlv = self.build(raw, index)
             index += tlv.getlen() + tlv.getpad(tlv.getlen())
             tlvs.append(tlv)
         return tlvs
 
-    def build(self, raw):
-        """Returns one TLV parsed from raw data."""
-        _type = self._unpack_hdr(raw)[self._typeindex]
+    def build_columns(self, raw, offset=0):
+        """Like build_all, but put the routes from all TLVInternal4s into an
+        Internal4Columns instead of building a TLV object for each one.
+        Returns a tuple of the Internal4Columns and a list of any other TLVs
+        that were found."""
+        columns = Internal4Columns()
+        tlvs = list()
+        index = offset
+        rawlen = len(raw)
+        while index < rawlen:
+            _type = self._unpack_hdr(raw, index)[self._typeindex]
+            if _type == TLVInternal4.TYPE:
+                index += columns.append_raw(raw, index)
+                continue
+            tlv = self.build(raw, index)
+            index += tlv.getlen() + tlv.getpad(tlv.getlen())
+            tlvs.append(tlv)
+        return columns, tlvs
+
+    def build(self, raw, offset=0):
+        """Returns one TLV parsed from raw data at the given offset."""
+        _type = self._unpack_hdr(raw, offset)[self._typeindex]
         try:
-            return self._tlvs[_type](raw=raw)
+            tlvclass = self._tlvs[_type]
         except KeyError:
             raise ValueError("Unknown type in TLV: %d" % _type)
+        if self._lazy:
+            return tlvclass(raw=raw, offset=offset, lazy=True)
+        return tlvclass(raw=raw, offset=offset)
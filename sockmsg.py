@@ -0,0 +1,289 @@
+#!/usr/bin/env python
+
+"""recvmsg and recvmmsg for raw IP sockets, with the interface each packet
+arrived on.
+
+Python 2's socket module has no recvmsg, so the IP_PKTINFO ancillary data
+that tells which interface a packet was received on can't be read with it.
+PacketReceiver calls libc's recvmsg through ctypes instead, into buffers
+that are allocated once and reused for every packet:
+
+    enable_pktinfo(sock)
+    receiver = PacketReceiver(sock, 8192)
+    data, addr, ifindex = receiver.recv()
+
+BatchReceiver reads all the packets waiting on the socket, up to a limit,
+with one recvmmsg call. They are left in its buffer pool, so the caller
+can check their headers in place and copy out only what it keeps:
+
+    receiver = BatchReceiver(sock, 8192, 32)
+    for offset, length, addr, ifindex in receiver.recv():
+        packet = receiver.buffer[offset:offset + length]
+
+Errors are raised as socket.error, the same as recvfrom raises them.
+
+available is False where these can't be used, which is anywhere but Linux,
+and callers should use recvfrom instead. batch_available is False if libc
+has no recvmmsg (before glibc 2.12)."""
+
+# Python-EIGRP (http://python-eigrp.googlecode.com)
+# Copyright (C) 2013 Patrick F. Allen
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import os
+import sys
+import socket
+import struct
+import ctypes
+import ctypes.util
+
+# from linux/in.h
+IP_PKTINFO = getattr(socket, "IP_PKTINFO", 8)
+
+# Room for an IP_PKTINFO control message, and a little more in case the
+# socket has other ancillary data enabled. Anything that doesn't fit is
+# dropped by the kernel.
+CONTROL_SIZE = 128
+
+# Source addresses are cached, see _sockaddr. The cache is cleared if it
+# grows past this, e.g. with packets from many spoofed sources.
+MAX_ADDRESSES = 1024
+
+_libc = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        _libc.recvmsg
+    except (OSError, AttributeError):
+        _libc = None
+
+available = _libc is not None
+batch_available = available and hasattr(_libc, "recvmmsg")
+
+
+class _iovec(ctypes.Structure):
+    _fields_ = [ ("iov_base", ctypes.c_void_p),
+                 ("iov_len",  ctypes.c_size_t),
+               ]
+
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [ ("msg_name",       ctypes.c_void_p),
+                 ("msg_namelen",    ctypes.c_uint),
+                 ("msg_iov",        ctypes.POINTER(_iovec)),
+                 ("msg_iovlen",     ctypes.c_size_t),
+                 ("msg_control",    ctypes.c_void_p),
+                 ("msg_controllen", ctypes.c_size_t),
+                 ("msg_flags",      ctypes.c_int),
+               ]
+
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [ ("msg_hdr", _msghdr),
+                 ("msg_len", ctypes.c_uint),
+               ]
+
+
+if _libc:
+    _libc.recvmsg.argtypes = [ ctypes.c_int, ctypes.POINTER(_msghdr),
+                               ctypes.c_int ]
+    _libc.recvmsg.restype = ctypes.c_ssize_t
+if batch_available:
+    _libc.recvmmsg.argtypes = [ ctypes.c_int, ctypes.POINTER(_mmsghdr),
+                                ctypes.c_uint, ctypes.c_int,
+                                ctypes.c_void_p ]
+    _libc.recvmmsg.restype = ctypes.c_int
+
+# Reading the results through the ctypes structures creates an object for
+# every field, which costs more per packet than the system calls recvmmsg
+# saves. They are unpacked from the raw memory with struct instead.
+_SIZE_T = { 4 : "I", 8 : "Q" }[ctypes.sizeof(ctypes.c_size_t)]
+_CONTROLLEN_OFFSET = _msghdr.msg_controllen.offset
+_MSG_LEN_OFFSET = _mmsghdr.msg_len.offset
+
+# msg_controllen and msg_len of an mmsghdr.
+_MMSG_RESULT = struct.Struct("={}x{}{}xI".format(_CONTROLLEN_OFFSET, _SIZE_T,
+                             _MSG_LEN_OFFSET - _CONTROLLEN_OFFSET -
+                             ctypes.sizeof(ctypes.c_size_t)))
+
+# struct cmsghdr, and the ipi_ifindex at the start of struct in_pktinfo.
+_CMSGHDR = struct.Struct("=" + _SIZE_T + "ii")
+_IFINDEX = struct.Struct("=i")
+
+_SOCKADDR_IN_SIZE = 16
+_PORT = struct.Struct(">H")
+
+def _cmsg_align(length):
+    size = ctypes.sizeof(ctypes.c_size_t)
+    return (length + size - 1) & ~(size - 1)
+
+_CMSG_HDR_LEN = _cmsg_align(_CMSGHDR.size)
+
+def enable_pktinfo(sock):
+    """Ask the kernel to send IP_PKTINFO with each packet received on an
+    AF_INET socket."""
+    sock.setsockopt(socket.IPPROTO_IP, IP_PKTINFO, 1)
+
+def _socket_error():
+    err = ctypes.get_errno()
+    return socket.error(err, os.strerror(err))
+
+_addresses = dict()
+
+def _sockaddr(buf, offset):
+    """Return the (host, port) tuple for the struct sockaddr_in at offset
+    in buf, as recvfrom would. Packets come from a few neighbors, so the
+    tuples are cached."""
+    key = buf[offset + 2:offset + 8]
+    try:
+        return _addresses[key]
+    except KeyError:
+        pass
+    if len(_addresses) >= MAX_ADDRESSES:
+        _addresses.clear()
+    addr = _addresses[key] = (socket.inet_ntoa(key[2:]),
+                              _PORT.unpack_from(key)[0])
+    return addr
+
+def _pktinfo_ifindex(buf, start, length):
+    """Return the interface index from the IP_PKTINFO message in the
+    control messages in buf[start:start + length], or None if there isn't
+    one."""
+    offset = start
+    end = start + length
+    while offset + _CMSG_HDR_LEN <= end:
+        cmsg_len, level, cmsg_type = _CMSGHDR.unpack_from(buf, offset)
+        if cmsg_len < _CMSG_HDR_LEN:
+            break
+        if level == socket.IPPROTO_IP and cmsg_type == IP_PKTINFO:
+            return _IFINDEX.unpack_from(buf, offset + _CMSG_HDR_LEN)[0]
+        offset += _cmsg_align(cmsg_len)
+    return None
+
+
+class PacketReceiver(object):
+    """Receives packets from an AF_INET socket with recvmsg, reusing the
+    same buffers for every call. Not thread safe."""
+
+    def __init__(self, sock, bufsize):
+        """sock - the socket to read, which should have had enable_pktinfo
+               called on it
+        bufsize - the largest packet to read. Longer packets are
+                  truncated."""
+        if not available:
+            raise(ValueError("recvmsg isn't available on this platform."))
+        self._fd = sock.fileno()
+        self._buf = ctypes.create_string_buffer(bufsize)
+        self._name = ctypes.create_string_buffer(_SOCKADDR_IN_SIZE)
+        self._control = ctypes.create_string_buffer(CONTROL_SIZE)
+        self._iov = _iovec(ctypes.addressof(self._buf), bufsize)
+        self._msg = _msghdr()
+        self._msg.msg_name = ctypes.addressof(self._name)
+        self._msg.msg_iov = ctypes.pointer(self._iov)
+        self._msg.msg_iovlen = 1
+        self._msg.msg_control = ctypes.addressof(self._control)
+
+    def recv(self):
+        """Receive a packet. Returns (data, (host, port), ifindex), where
+        ifindex is None if the packet came without IP_PKTINFO."""
+        msg = self._msg
+        # The kernel shortens these to what it filled in.
+        msg.msg_namelen = _SOCKADDR_IN_SIZE
+        msg.msg_controllen = CONTROL_SIZE
+        length = _libc.recvmsg(self._fd, ctypes.byref(msg), 0)
+        if length < 0:
+            raise _socket_error()
+        return (self._buf[:length], _sockaddr(self._name, 0),
+                _pktinfo_ifindex(self._control, 0, msg.msg_controllen))
+
+
+class BatchReceiver(object):
+    """Receives packets from an AF_INET socket with recvmmsg, up to count
+    at a time. The packets are read into one buffer pool allocated up
+    front, with room for count packets of bufsize bytes. The pool is
+    overwritten by the next recv. Not thread safe."""
+
+    def __init__(self, sock, bufsize, count):
+        """sock - the socket to read. Packets are returned with their
+               input interface if enable_pktinfo was called on it.
+        bufsize - the largest packet to read. Longer packets are
+                  truncated.
+        count - the most packets to read in one call"""
+        if not batch_available:
+            raise(ValueError("recvmmsg isn't available on this platform."))
+        self._fd = sock.fileno()
+        self.bufsize = bufsize
+        self.count = count
+        self.buffer = ctypes.create_string_buffer(bufsize * count)
+        self._names = ctypes.create_string_buffer(_SOCKADDR_IN_SIZE * count)
+        self._controls = ctypes.create_string_buffer(CONTROL_SIZE * count)
+        self._iovs = (_iovec * count)()
+        self._msgs = (_mmsghdr * count)()
+
+        for index in xrange(count):
+            iov = self._iovs[index]
+            iov.iov_base = ctypes.addressof(self.buffer) + index * bufsize
+            iov.iov_len = bufsize
+            hdr = self._msgs[index].msg_hdr
+            hdr.msg_name = (ctypes.addressof(self._names) +
+                            index * _SOCKADDR_IN_SIZE)
+            hdr.msg_namelen = _SOCKADDR_IN_SIZE
+            hdr.msg_iov = ctypes.pointer(iov)
+            hdr.msg_iovlen = 1
+            hdr.msg_control = (ctypes.addressof(self._controls) +
+                               index * CONTROL_SIZE)
+            hdr.msg_controllen = CONTROL_SIZE
+        # The kernel shortens msg_namelen and msg_controllen of the
+        # messages it fills in, so they are copied back from here before
+        # each call.
+        self._template = ctypes.string_at(self._msgs,
+                                          ctypes.sizeof(self._msgs))
+        # The number of messages the kernel filled in with the last recv.
+        self._used = 0
+
+    def recv(self):
+        """Receive the packets waiting on the socket, up to count. Returns
+        a list of (offset, length, (host, port), ifindex) for each, where
+        the packet is buffer[offset:offset + length] and ifindex is None if
+        the packet came without IP_PKTINFO. Raises socket.error, e.g.
+        EAGAIN, if no packets are waiting."""
+        msgs = self._msgs
+        if self._used:
+            ctypes.memmove(msgs, self._template,
+                           self._used * ctypes.sizeof(_mmsghdr))
+        received = _libc.recvmmsg(self._fd, msgs, self.count, 0, None)
+        if received < 0:
+            self._used = 0
+            raise _socket_error()
+        self._used = received
+
+        packets = list()
+        bufsize = self.bufsize
+        msg_size = ctypes.sizeof(_mmsghdr)
+        names = self._names
+        controls = self._controls
+        for index in xrange(received):
+            controllen, length = _MMSG_RESULT.unpack_from(msgs,
+                                                          index * msg_size)
+            if controllen:
+                ifindex = _pktinfo_ifindex(controls, index * CONTROL_SIZE,
+                                           controllen)
+            else:
+                ifindex = None
+            packets.append((index * bufsize, length,
+                            _sockaddr(names, index * _SOCKADDR_IN_SIZE),
+                            ifindex))
+        return packets
@@ -19,11 +19,16 @@
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
 import sys
+import errno
+import socket
 import subprocess
 import re
 
 import ipaddr
 
+import ipv4
+import rtnetlink
+
 # subprocess.check_output doesn't exist in 2.6, haven't looked at 3.x.
 # Have done all testing on 2.7, so it's safer to just require 2.7 for now.
 if not 0x2070000 <= sys.hexversion < 0x2080000:
@@ -45,12 +50,16 @@ class _System(object):
 
     def modify_route(self, net, plen, metric, nexthop):
         """Update the metric and nexthop address to a prefix.
-        net - the IP network address (not including netmask)
+        net - the IP network address (not including netmask), as an integer
         plen - the prefix length
         metric - the metric to use, as an integer
-        nexthop - the nexthop IP address
+        nexthop - the nexthop IP address, as an integer
         """
-        self.uninstall_route(net, plen)
+        try:
+            self.uninstall_route(net, plen)
+        except ValueError:
+            # There was no route to replace.
+            pass
         self.install_route(net, plen, metric, nexthop)
 
     def cleanup(self):
@@ -71,17 +80,58 @@ class _System(object):
         assert False
 
     def uninstall_route(self, net, plen):
-        """Uninstall a route from the system routing table.
+        """Uninstall a route from the system routing table. Arguments are as
+        for modify_route.
 
         Override in subclass."""
         assert False
 
     def install_route(self, net, plen, metric, nexthop):
-        """Install a route in the system routing table.
+        """Install a route in the system routing table. Arguments are as for
+        modify_route.
 
         Override in subclass."""
         assert False
 
+    def apply_routes(self, ops):
+        """Apply a batch of route changes. Each change is a tuple
+        (net, plen, metric, nexthop), as for modify_route. A metric of None
+        uninstalls the route to the prefix instead.
+
+        Returns a list with an errno for each change, 0 meaning success.
+
+        Subclasses that can write several routes at once should override
+        this."""
+        errors = list()
+        for net, plen, metric, nexthop in ops:
+            try:
+                if metric is None:
+                    self.uninstall_route(net, plen)
+                else:
+                    self.modify_route(net, plen, metric, nexthop)
+            except ValueError:
+                errors.append(errno.EIO)
+            else:
+                errors.append(0)
+        return errors
+
+    def get_installed_routes(self):
+        """Return {prefix: (metric, nexthop)} for the routes already in the
+        routing table this process installs routes to, such as those left by
+        an earlier run. Prefixes are (net, plen) integer tuples. Returns an
+        empty dict if the platform can't tell which routes are ours."""
+        return dict()
+
+    def get_link_stats(self):
+        """Return {name: (speed, mtu, counters)} for the physical
+        interfaces, as sampled by ifmetrics.InterfaceSampler. speed is in
+        Mbit/s and counters is the tuple (rx_packets, tx_packets, rx_bytes,
+        tx_bytes, rx_errors, tx_errors). Any of them can be None if the
+        platform doesn't report it. Returns an empty dict if the platform
+        doesn't support sampling, leaving the interfaces' default
+        metrics."""
+        return dict()
+
     def get_local_routes(self):
         """Retrieves routes from the system routing table.
 
@@ -140,16 +190,16 @@ class WindowsSystem(_System):
     def uninstall_route(self, net, plen):
         # Convert the prefix length into a dotted decimal mask
         mask = self.plen_to_snmask(plen)
-        cmd = self.ROUTE_DEL.format(net, mask)
+        cmd = self.ROUTE_DEL.format(ipv4.ntoa(net), mask)
         output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
         if not "OK!" in output:
             raise ValueError #ModifyRouteError("uninstall", output)
 
     def install_route(self, net, plen, metric, nexthop):
         mask = self.plen_to_snmask(plen)
-        cmd = self.ROUTE_ADD.format(net,
+        cmd = self.ROUTE_ADD.format(ipv4.ntoa(net),
                                     mask,
-                                    nexthop,
+                                    ipv4.ntoa(nexthop),
                                     metric)
         output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
         if not "OK!" in output:
@@ -157,7 +207,7 @@ class WindowsSystem(_System):
 
     @staticmethod
     def plen_to_snmask(plen):
-        return ipaddr.IPv4Network("0.0.0.0/%d" % plen).netmask
+        return ipv4.ntoa(ipv4.MASKS[plen])
 
     def get_local_routes(self):
         output = subprocess.check_output("route print",
@@ -184,16 +234,26 @@ class LinuxSystem(_System):
     RT_DEL_ARGS = "route del {}/{}"
     RT_ADD_ARGS = "route add {}/{} via {} metric {} " \
                   "table {}"
+    SYSFS_NET = "/sys/class/net"
+    SYSFS_COUNTERS = [ "rx_packets", "tx_packets", "rx_bytes", "tx_bytes",
+                       "rx_errors", "tx_errors" ]
 
-    def __init__(self, table=52, priority=1000, *args, **kwargs):
+    def __init__(self, table=52, priority=1000, route_socket=None,
+                 iface_socket=None, use_netlink=True, *args, **kwargs):
         """Args:
         table - the routing table to install routes to (if applicable on
             the current platform).
         priority - the desirability of routes learned by the process
             relative to other routing daemons (if applicable on the current
-            platform)"""
-        super(_System, self).__thisclass__.__init__(self, *args, **kwargs)
-
+            platform)
+        route_socket - the socket routes are written to. Defaults to a new
+            NETLINK_ROUTE socket. Pass an rtnetlink.FakeKernel to run
+            without root.
+        iface_socket - the socket interfaces and addresses are read from,
+            as for route_socket.
+        use_netlink - if False, or if a netlink socket can't be opened,
+            routes are written by running "ip -batch" and interfaces are
+            read from "ip addr show" instead."""
         if not 0 < table < 255:
             raise ValueError
         if not 0 < priority < 32767:
@@ -202,6 +262,32 @@ class LinuxSystem(_System):
         self._table = table
         self._priority = priority
 
+        # Interface index -> PhysicalInterface, and
+        # (index, address, plen) -> LogicalInterface, for the interfaces
+        # read from netlink.
+        self._phy_by_index = dict()
+        self._logical_by_key = dict()
+        # Interface name -> link speed read from sysfs. A link's speed only
+        # changes when it renegotiates, which also sends an RTM_NEWLINK.
+        self._link_speeds = dict()
+        self._iface_socket = iface_socket
+        if use_netlink and not iface_socket:
+            try:
+                self._iface_socket = rtnetlink.open_socket()
+                self._iface_socket.bind((0, 0))
+            except socket.error:
+                self._iface_socket = None
+        super(_System, self).__thisclass__.__init__(self, *args, **kwargs)
+
+        self._routes = None
+        if use_netlink or route_socket:
+            try:
+                self._routes = rtnetlink.RouteWriter(table, route_socket)
+            except socket.error:
+                pass
+        if not self._routes:
+            self._routes = IpBatchRouteWriter(self.IP_CMD, table)
+
     def init_routing(self):
         # XXX This should also handle:
         # Check if ip routing is already enabled
@@ -228,7 +314,106 @@ class LinuxSystem(_System):
 
     def update_interface_info(self):
         """Updates self according to the current state of physical and logical
-        IP interfaces on the device."""
+        IP interfaces on the device.
+
+        Interfaces are read with netlink dumps. Interface objects that
+        still exist are updated in place rather than replaced. Between
+        calls, handle_link_message and handle_addr_message keep them
+        current."""
+        if not self._iface_socket:
+            self._update_interface_info_ip()
+            return
+        if not hasattr(self, "phy_ifaces"):
+            self.phy_ifaces = []
+            self.logical_ifaces = []
+        try:
+            links = rtnetlink.dump_links(self._iface_socket)
+            addrs = rtnetlink.dump_addrs(self._iface_socket)
+        except rtnetlink.NetlinkError as e:
+            raise(ValueError("Interface dump failed: {}".format(e)))
+
+        for link in links:
+            self.handle_link_message(rtnetlink.RTM_NEWLINK, link)
+        indexes = set([ link["index"] for link in links ])
+        for index in self._phy_by_index.keys():
+            if index not in indexes:
+                self.handle_link_message(rtnetlink.RTM_DELLINK,
+                                         { "index" : index })
+
+        for addr in addrs:
+            self.handle_addr_message(rtnetlink.RTM_NEWADDR, addr)
+        keys = set([ (addr["index"], addr["address"], addr["plen"])
+                     for addr in addrs ])
+        for index, address, plen in self._logical_by_key.keys():
+            if (index, address, plen) not in keys:
+                self.handle_addr_message(rtnetlink.RTM_DELADDR,
+                                         { "family"  : socket.AF_INET,
+                                           "index"   : index,
+                                           "address" : address,
+                                           "plen"    : plen })
+
+    def handle_link_message(self, msgtype, link):
+        """Update the physical interfaces for an RTM_NEWLINK or RTM_DELLINK
+        message. link is a dict from rtnetlink.unpack_link. Returns the
+        PhysicalInterface that was added, changed or removed, or None."""
+        if link.get("name"):
+            self._link_speeds.pop(link["name"], None)
+        if not self._iface_socket:
+            # The interfaces came from "ip addr show", which doesn't give
+            # their indexes.
+            return None
+        index = link["index"]
+        phy_iface = self._phy_by_index.get(index)
+        if msgtype == rtnetlink.RTM_DELLINK:
+            if not phy_iface:
+                return None
+            del self._phy_by_index[index]
+            self.phy_ifaces.remove(phy_iface)
+            for key, logical_iface in self._logical_by_key.items():
+                if logical_iface.phy_iface is phy_iface:
+                    del self._logical_by_key[key]
+                    self.logical_ifaces.remove(logical_iface)
+            return phy_iface
+        flags = rtnetlink.flag_names(link["flags"])
+        if phy_iface:
+            phy_iface.update(link["name"] or phy_iface.name, flags)
+        else:
+            phy_iface = PhysicalInterface(link["name"], flags, index)
+            self._phy_by_index[index] = phy_iface
+            self.phy_ifaces.append(phy_iface)
+        return phy_iface
+
+    def handle_addr_message(self, msgtype, addr):
+        """Update the logical interfaces for an RTM_NEWADDR or RTM_DELADDR
+        message. addr is a dict from rtnetlink.unpack_addr. Returns the
+        LogicalInterface that was added or removed, or None."""
+        if not self._iface_socket:
+            # The interfaces came from "ip addr show", which doesn't give
+            # their indexes.
+            return None
+        if addr["family"] != socket.AF_INET:
+            return None
+        key = addr["index"], addr["address"], addr["plen"]
+        logical_iface = self._logical_by_key.get(key)
+        if msgtype == rtnetlink.RTM_DELADDR:
+            if not logical_iface:
+                return None
+            del self._logical_by_key[key]
+            self.logical_ifaces.remove(logical_iface)
+            return logical_iface
+        phy_iface = self._phy_by_index.get(addr["index"])
+        if logical_iface or not phy_iface:
+            return None
+        logical_iface = LogicalInterface(phy_iface, "{}/{}".format(
+                                                 ipv4.ntoa(addr["address"]),
+                                                 addr["plen"]))
+        self._logical_by_key[key] = logical_iface
+        self.logical_ifaces.append(logical_iface)
+        return logical_iface
+
+    def _update_interface_info_ip(self):
+        """Read the interfaces from "ip addr show", for when netlink isn't
+        available."""
         ip_output = subprocess.check_output("ip addr show".split())
         raw_ifaces = re.split("\n\d*: ", ip_output)
 
@@ -247,19 +432,81 @@ class LinuxSystem(_System):
                 logical_iface = LogicalInterface(phy_iface, addr)
                 self.logical_ifaces.append(logical_iface)
 
+    def modify_route(self, net, plen, metric, nexthop):
+        # A single RTM_NEWROUTE with NLM_F_REPLACE, so the prefix is never
+        # left without a route.
+        self.install_route(net, plen, metric, nexthop)
+
+    def apply_routes(self, ops):
+        return self._routes.apply(ops)
+
+    def get_installed_routes(self):
+        try:
+            return self._routes.dump_routes()
+        except rtnetlink.NetlinkError as e:
+            raise(ValueError("Route dump failed: {}".format(e)))
+
+    def get_link_stats(self):
+        """Counters and MTUs are read with one netlink dump (IFLA_STATS64),
+        or from sysfs if netlink isn't available. Speeds are read from
+        sysfs and cached until the link changes."""
+        stats = dict()
+        if not self._iface_socket:
+            for phy_iface in self.phy_ifaces:
+                name = phy_iface.name
+                counters = [ self._read_sysfs(name, "statistics/" + counter)
+                             for counter in self.SYSFS_COUNTERS ]
+                if None in counters:
+                    counters = None
+                else:
+                    counters = tuple(counters)
+                stats[name] = (self._link_speed(name),
+                               self._read_sysfs(name, "mtu"),
+                               counters)
+            return stats
+        try:
+            links = rtnetlink.dump_links(self._iface_socket)
+        except rtnetlink.NetlinkError as e:
+            raise(ValueError("Interface dump failed: {}".format(e)))
+        for link in links:
+            name = link["name"]
+            stats[name] = self._link_speed(name), link["mtu"], link["stats"]
+        return stats
+
+    def _link_speed(self, name):
+        """Return the speed of a link in Mbit/s, or None if it isn't known,
+        as for virtual links and links that are down."""
+        try:
+            return self._link_speeds[name]
+        except KeyError:
+            pass
+        speed = self._read_sysfs(name, "speed")
+        if speed is not None and speed <= 0:
+            speed = None
+        self._link_speeds[name] = speed
+        return speed
+
+    def _read_sysfs(self, name, attr):
+        """Return the integer in an interface's sysfs attribute, or None if
+        it can't be read."""
+        path = "{}/{}/{}".format(self.SYSFS_NET, name, attr)
+        try:
+            with open(path) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return None
+
     def uninstall_route(self, net, plen):
-        cmd = [self.IP_CMD] + ("route del {}/{} table {}".format(net, plen, self._table).split())
         try:
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            raise ValueError #ModifyRouteError("route_uninstall", output)
+            self._routes.delete_route(net, plen)
+        except rtnetlink.NetlinkError as e:
+            raise(ValueError("Route uninstall failed: {}".format(e)))
 
     def install_route(self, net, plen, metric, nexthop):
-        cmd = [self.IP_CMD] + ("route add {}/{} via {} metric {} table {}".format(net, plen, nexthop, metric, self._table).split())
         try:
-            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
-        except subprocess.CalledProcessError:
-            raise ValueError #ModifyRouteError("route_install", output)
+            self._routes.replace_route(net, plen, metric, nexthop)
+        except rtnetlink.NetlinkError as e:
+            raise(ValueError("Route install failed: {}".format(e)))
 
     def get_local_routes(self):
         cmd = [self.IP_CMD] + "route show".split()
@@ -280,35 +527,193 @@ class LinuxSystem(_System):
         """Perform any necessary system cleanup."""
         if self._rule_installed:
             self._uninstall_rule()
+        self._routes.close()
+        if self._iface_socket:
+            self._iface_socket.close()
+
+
+class IpBatchRouteWriter(object):
+    """Writes routes by running "ip -batch", for when a netlink socket can't
+    be used. Has the same interface as rtnetlink.RouteWriter, though
+    changes that ip refuses are all reported as EIO since ip only prints the
+    error message."""
+
+    # ip prints this for each failed line of a batch.
+    FAILED_RE = re.compile("Command failed -:(\d+)")
+
+    # Route types ip prints before the destination. Unicast routes have no
+    # type.
+    NON_UNICAST = ("local", "broadcast", "anycast", "multicast", "blackhole",
+                   "unreachable", "prohibit", "throw", "nat")
+
+    def __init__(self, ip_cmd, table):
+        self._ip_cmd = ip_cmd
+        self._table = table
+        self.routes = dict()
+
+    def apply(self, ops):
+        # See rtnetlink.RouteWriter.apply, including for why changing the
+        # metric needs the old route removed.
+        lines = list()
+        owners = list()
+        errors = [0] * len(ops)
+        metrics = dict()
+        for index, (net, plen, metric, nexthop) in enumerate(ops):
+            if not rtnetlink.valid_route(net, plen, metric, nexthop):
+                errors[index] = errno.EINVAL
+                continue
+            prefix = net, plen
+            if prefix in metrics:
+                old = metrics[prefix]
+            else:
+                old = self.routes.get(prefix, (None,))[0]
+            metrics[prefix] = metric
+            dest = "{}/{}".format(ipv4.ntoa(net), plen)
+            if metric is None:
+                lines.append(self._del_line(dest, old))
+                owners.append(index)
+                continue
+            lines.append("route replace {} via {} metric {} table {} proto "
+                         "{}".format(dest, ipv4.ntoa(nexthop), metric,
+                                     self._table, rtnetlink.RTPROT_EIGRP))
+            owners.append(index)
+            if old is not None and old != metric:
+                lines.append(self._del_line(dest, old))
+                owners.append(None)
+
+        if lines:
+            proc = subprocess.Popen([self._ip_cmd, "-force", "-batch", "-"],
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+            output, err_output = proc.communicate("\n".join(lines) + "\n")
+            for lineno in self.FAILED_RE.findall(err_output):
+                owner = owners[int(lineno) - 1]
+                if owner is not None:
+                    errors[owner] = errno.EIO
+
+        for (net, plen, metric, nexthop), err in zip(ops, errors):
+            if metric is None:
+                self.routes.pop((net, plen), None)
+            elif not err:
+                self.routes[net, plen] = metric, nexthop
+        return errors
+
+    def dump_routes(self):
+        # See rtnetlink.RouteWriter.dump_routes.
+        cmd = [self._ip_cmd] + "-4 route show table {}".format(
+                                                         self._table).split()
+        try:
+            output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            raise(rtnetlink.NetlinkError(errno.EIO, e.output.strip()))
+        routes = dict()
+        for line in output.splitlines():
+            words = line.split()
+            if not words or words[0] in self.NON_UNICAST:
+                continue
+            dest = words[0]
+            if dest == "default":
+                dest = "0.0.0.0/0"
+            elif "/" not in dest:
+                dest += "/32"
+            net, plen = dest.split("/")
+            prefix = ipv4.make_prefix(net, int(plen))
+            metric = 0
+            nexthop = None
+            # Most options are a keyword and a value, but some flags like
+            # "onlink" stand alone.
+            for index in xrange(1, len(words) - 1):
+                if words[index] == "via":
+                    nexthop = ipv4.aton(words[index + 1])
+                elif words[index] == "metric":
+                    metric = int(words[index + 1])
+            if prefix not in routes or metric < routes[prefix][0]:
+                routes[prefix] = metric, nexthop
+        self.routes.update(routes)
+        return routes
+
+    def _del_line(self, dest, metric):
+        if metric is None:
+            return "route del {} table {}".format(dest, self._table)
+        return "route del {} metric {} table {}".format(dest, metric,
+                                                        self._table)
+
+    def replace_route(self, net, plen, metric, nexthop):
+        if self.apply([(net, plen, metric, nexthop)])[0]:
+            raise(rtnetlink.NetlinkError(errno.EIO, "replace route to "
+                                         "{}/{}".format(ipv4.ntoa(net),
+                                                        plen)))
+
+    def delete_route(self, net, plen):
+        if self.apply([(net, plen, None, None)])[0]:
+            raise(rtnetlink.NetlinkError(errno.EIO, "delete route to "
+                                         "{}/{}".format(ipv4.ntoa(net),
+                                                        plen)))
+
+    def close(self):
+        pass
 
 
 class PhysicalInterface(object):
-    def __init__(self, name, flags):
+    # Metrics used until the interface is sampled, see set_metrics. These
+    # are those of a 100 Mbit/s link.
+    DEFAULT_BANDWIDTH   = 100
+    DEFAULT_DELAY       = 10
+    DEFAULT_LOAD        = 1
+    DEFAULT_RELIABILITY = 255
+    DEFAULT_MTU         = 1500
+
+    def __init__(self, name, flags, index=None):
         self.name = name
         self._flags = flags
+        self.index = index
+        self._bandwidth   = self.DEFAULT_BANDWIDTH
+        self._delay       = self.DEFAULT_DELAY
+        self._load        = self.DEFAULT_LOAD
+        self._reliability = self.DEFAULT_RELIABILITY
+        self._mtu         = self.DEFAULT_MTU
+
+    def update(self, name, flags):
+        """Called when the interface's name or flags change."""
+        self.name = name
+        self._flags = flags
+
+    def set_metrics(self, bandwidth=None, delay=None, load=None,
+                    reliability=None, mtu=None):
+        """Called by ifmetrics.InterfaceSampler with the metrics it measured.
+        Metrics that are None are left unchanged."""
+        if bandwidth is not None:
+            self._bandwidth = bandwidth
+        if delay is not None:
+            self._delay = delay
+        if load is not None:
+            self._load = load
+        if reliability is not None:
+            self._reliability = reliability
+        if mtu is not None:
+            self._mtu = mtu
 
-    # TODO Retrieve actual interface info for stubs below.
-    # Method will be different for Windows/Linux.
     def get_bandwidth(self):
-        """Throughput expressed as picoseconds per kilobyte of data sent."""
-        return 100
+        """Inverse bandwidth: 10^7 divided by the link speed in kbit/s."""
+        return self._bandwidth
 
     def get_delay(self):
         """Delay expressed in 10 microsecond units."""
-        return 10
+        return self._delay
 
     def get_load(self):
         """Load of the link based on output packets. 1 means a low load.
         255 means a high load."""
-        return 1
+        return self._load
 
     def get_reliability(self):
         """Link reliability expressed as a number between 1 and 255. 1 means
         completely unreliable, 255 means completely reliable. 0 is invalid."""
-        return 255
+        return self._reliability
 
     def get_mtu(self):
-        return 1500
+        return self._mtu
  
     def is_up(self):
         """Is the interface "up?"""
@@ -0,0 +1,452 @@
+#!/usr/bin/env python
+
+"""Tests for how EIGRP changes routes on an UPDATE, when it loses a neighbor
+or a link, or when metrics are recomputed after the K-values or an
+interface change."""
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+from twisted.internet import defer
+import ipaddr
+
+# dualfsm and topology import each other. eigrp imports dualfsm first, and
+# the cycle only resolves in that order.
+import dualfsm
+import eigrp
+import ipv4
+import rtp
+import rtptlv
+import sysiface
+import util
+from topology import TopologyTable
+
+KVALUES = ( 1, 0, 1, 0, 0 )
+UNREACHABLE = rtptlv.ValueClassicMetric.METRIC_UNREACHABLE
+
+if not hasattr(logging.Logger, "debug5"):
+    util.create_extended_debug_log_levels()
+
+
+class FakeFib(object):
+    """Records the routes EIGRP would write to the system."""
+
+    def __init__(self):
+        self.routes = dict()
+
+    def modify_route(self, net, plen, metric, nexthop):
+        self.routes[net, plen] = metric, nexthop
+
+    def uninstall_route(self, net, plen):
+        self.routes.pop((net, plen), None)
+
+    def when_written(self):
+        return defer.succeed(list())
+
+
+class FakeIface(object):
+    def __init__(self, name, ip):
+        phy_iface = sysiface.PhysicalInterface(name, 0)
+        self.logical_iface = sysiface.LogicalInterface(phy_iface, ip)
+        self.activated = True
+
+
+class FakeNeighbor(object):
+    def __init__(self, ip, iface):
+        self.ip = ipaddr.IPv4Address(ip)
+        self.iface = iface
+
+
+class EigrpHarness(eigrp.EIGRP):
+    """An EIGRP instance with only what the route handling needs, that
+    records the packets it sends instead of sending them."""
+
+    def __init__(self):
+        self.log = logging.getLogger("EIGRP")
+        self._k1, self._k2, self._k3, self._k4, self._k5 = KVALUES
+        self._rtphdr = rtp.RTPHeader2
+        self._topology = TopologyTable(self._get_kvalues)
+        self._fib = FakeFib()
+        self._ifaces = list()
+        self._register_op_handlers()
+        self.sent = list()
+
+    def _send(self, dsts, opcode, tlvs, ack, flags=0):
+        self.sent.append((opcode, list(tlvs)))
+
+
+def prefix(addr, plen):
+    return ipv4.make_prefix(int(ipaddr.IPv4Address(addr)), plen)
+
+
+class RouteTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.eigrp = EigrpHarness()
+        self.iface = FakeIface("eth0", "10.0.0.1/24")
+
+    def _update(self, neighbor, routes, bw=256):
+        """Receive an UPDATE from neighbor with routes, a list of
+        (prefix string, plen, delay, nexthop string). Returns the packets
+        sent in response, as (opcode, tlvs)."""
+        tlvs = [ rtptlv.TLVInternal4(nexthop, dly, bw, 1500, 1, 255, 1, 0,
+                                     0, plen, addr)
+                 for addr, plen, dly, nexthop in routes ]
+        hdr = rtp.RTPHeader2(opcode=rtp.RTPHeader2.OPC_UPDATE, flags=0,
+                             seq=1, ack=0, rid=1, asn=1)
+        self.eigrp.rtpReceived(neighbor, hdr, tlvs)
+        sent = list(self.eigrp.sent)
+        del self.eigrp.sent[:]
+        return sent
+
+    def _neighbor(self, ip, iface=None):
+        return FakeNeighbor(ip, iface or self.iface)
+
+
+class TestUpdate(RouteTestCase):
+
+    def setUp(self):
+        RouteTestCase.setUp(self)
+        self.a = self._neighbor("10.0.0.2")
+        self.b = self._neighbor("10.0.0.3")
+        self.net = prefix("192.168.0.0", 24)
+        self._update(self.a, [ ("192.168.0.0", 24, 100, "0.0.0.0") ])
+        self.t_entry = self.eigrp._topology[self.net]
+
+    def test_successor_metric_change(self):
+        sent = self._update(self.a, [ ("192.168.0.0", 24, 300, "0.0.0.0") ])
+        self.assertIs(self.t_entry.successor.neighbor, self.a)
+        self.assertEqual(self.t_entry.state, dualfsm.PASSIVE)
+        metric, nexthop = self.eigrp._fib.routes[self.net]
+        self.assertEqual(metric, self.t_entry.successor.full_metric())
+        self.assertEqual(len(sent), 1)
+        opcode, tlvs = sent[0]
+        self.assertEqual(opcode, rtp.RTPHeader2.OPC_UPDATE)
+        self.assertEqual(tlvs[0].metric.dly, 300 + 10)
+
+    def test_metric_capped(self):
+        # Reachable, but too far for a 32 bit route metric.
+        self._update(self.a, [ ("192.168.0.0", 24, UNREACHABLE - 20,
+                                "0.0.0.0") ])
+        self.assertTrue(self.t_entry.successor.full_metric() >
+                        eigrp.EIGRP.FIB_METRIC_MAX)
+        metric, nexthop = self.eigrp._fib.routes[self.net]
+        self.assertEqual(metric, eigrp.EIGRP.FIB_METRIC_MAX)
+
+    def test_successor_unchanged(self):
+        routes = dict(self.eigrp._fib.routes)
+        sent = self._update(self.a, [ ("192.168.0.0", 24, 100, "0.0.0.0") ])
+        self.assertEqual(self.eigrp._fib.routes, routes)
+        self.assertEqual(sent, [ ])
+
+    def test_feasible_successor_takes_over(self):
+        self._update(self.b, [ ("192.168.0.0", 24, 105, "10.0.0.9") ])
+        self.assertIs(self.t_entry.successor.neighbor, self.a)
+        sent = self._update(self.a, [ ("192.168.0.0", 24, UNREACHABLE,
+                                       "0.0.0.0") ])
+        self.assertIs(self.t_entry.successor.neighbor, self.b)
+        self.assertEqual(self.t_entry.state, dualfsm.PASSIVE)
+        metric, nexthop = self.eigrp._fib.routes[self.net]
+        self.assertEqual(nexthop, int(ipaddr.IPv4Address("10.0.0.9")))
+        self.assertEqual(metric, self.t_entry.successor.full_metric())
+        self.assertEqual(len(sent), 1)
+        opcode, tlvs = sent[0]
+        self.assertEqual(opcode, rtp.RTPHeader2.OPC_UPDATE)
+        self.assertEqual(tlvs[0].metric.dly, 105 + 10)
+
+    def test_successor_unreachable(self):
+        # b's reported distance is more than the feasible distance.
+        self._update(self.b, [ ("192.168.0.0", 24, 500, "0.0.0.0") ])
+        sent = self._update(self.a, [ ("192.168.0.0", 24, UNREACHABLE,
+                                       "0.0.0.0") ])
+        self.assertEqual(self.t_entry.state, dualfsm.ACTIVE1)
+        self.assertTrue(self.t_entry.get_neighbor(self.a).waiting_for_reply)
+        self.assertTrue(self.t_entry.get_neighbor(self.b).waiting_for_reply)
+        self.assertEqual(self.t_entry.successor, self.t_entry.NO_SUCCESSOR)
+        self.assertFalse(self.net in self.eigrp._fib.routes)
+        self.assertEqual([ opcode for opcode, tlvs in sent ],
+                         [ rtp.RTPHeader2.OPC_QUERY ])
+
+
+class TestLostNeighbor(RouteTestCase):
+
+    def test_feasible_successor(self):
+        a = self._neighbor("10.0.0.2")
+        b = self._neighbor("10.0.0.3")
+        net = prefix("192.168.0.0", 24)
+        self._update(a, [ ("192.168.0.0", 24, 100, "0.0.0.0") ])
+        # b is farther away, but feasible, and advertises a third router on
+        # the link as the nexthop.
+        self._update(b, [ ("192.168.0.0", 24, 105, "10.0.0.9") ])
+        t_entry = self.eigrp._topology[net]
+        self.assertIs(t_entry.successor.neighbor, a)
+        self.assertEqual(self.eigrp._fib.routes[net][1],
+                         int(ipaddr.IPv4Address("10.0.0.2")))
+
+        self.eigrp.lostNeighbor(a)
+        self.assertIs(t_entry.successor.neighbor, b)
+        self.assertEqual(t_entry.state, dualfsm.PASSIVE)
+        metric, nexthop = self.eigrp._fib.routes[net]
+        self.assertEqual(nexthop, int(ipaddr.IPv4Address("10.0.0.9")))
+        self.assertEqual(metric, t_entry.successor.full_metric())
+        self.assertEqual(len(self.eigrp.sent), 1)
+        opcode, tlvs = self.eigrp.sent[0]
+        self.assertEqual(opcode, rtp.RTPHeader2.OPC_UPDATE)
+        self.assertEqual([ ipv4.make_prefix(tlv.dest.addr, tlv.dest.plen)
+                           for tlv in tlvs ], [ net ])
+        self.assertEqual(tlvs[0].metric.dly,
+                         t_entry.successor.full_distance.dly)
+
+    def test_no_feasible_successor(self):
+        a = self._neighbor("10.0.0.2")
+        b = self._neighbor("10.0.0.3")
+        net = prefix("192.168.0.0", 24)
+        self._update(a, [ ("192.168.0.0", 24, 100, "0.0.0.0") ])
+        # b's reported distance is more than the feasible distance.
+        self._update(b, [ ("192.168.0.0", 24, 500, "0.0.0.0") ])
+        t_entry = self.eigrp._topology[net]
+        self.assertFalse(t_entry.feasible_successors)
+
+        self.eigrp.lostNeighbor(a)
+        self.assertEqual(t_entry.state, dualfsm.ACTIVE1)
+        self.assertEqual(t_entry.successor, t_entry.NO_SUCCESSOR)
+        self.assertTrue(t_entry.get_neighbor(b).waiting_for_reply)
+        self.assertFalse(net in self.eigrp._fib.routes)
+        self.assertEqual(len(self.eigrp.sent), 1)
+        opcode, tlvs = self.eigrp.sent[0]
+        self.assertEqual(opcode, rtp.RTPHeader2.OPC_QUERY)
+        self.assertEqual(tlvs[0].metric.dly,
+                         rtptlv.ValueClassicMetric.METRIC_UNREACHABLE)
+
+    def test_last_neighbor(self):
+        a = self._neighbor("10.0.0.2")
+        net = prefix("192.168.0.0", 24)
+        self._update(a, [ ("192.168.0.0", 24, 100, "0.0.0.0") ])
+        self.eigrp.lostNeighbor(a)
+        # Kept while the query for it is out.
+        t_entry = self.eigrp._topology[net]
+        self.assertEqual(t_entry.state, dualfsm.ACTIVE1)
+        self.assertFalse(net in self.eigrp._fib.routes)
+        opcode, tlvs = self.eigrp.sent[0]
+        self.assertEqual(opcode, rtp.RTPHeader2.OPC_QUERY)
+
+    def test_last_neighbor_passive(self):
+        # a never offered a usable route, so there is nothing to query for.
+        a = self._neighbor("10.0.0.2")
+        net = prefix("192.168.0.0", 24)
+        self._update(a, [ ("192.168.0.0", 24, UNREACHABLE, "0.0.0.0") ])
+        self.assertEqual(self.eigrp._topology[net].state, dualfsm.PASSIVE)
+        self.eigrp.lostNeighbor(a)
+        self.assertFalse(net in self.eigrp._topology)
+        self.assertEqual(self.eigrp.sent, [ ])
+
+    def test_not_successor(self):
+        a = self._neighbor("10.0.0.2")
+        b = self._neighbor("10.0.0.3")
+        net = prefix("192.168.0.0", 24)
+        self._update(a, [ ("192.168.0.0", 24, 100, "0.0.0.0") ])
+        self._update(b, [ ("192.168.0.0", 24, 105, "0.0.0.0") ])
+        routes = dict(self.eigrp._fib.routes)
+        self.eigrp.lostNeighbor(b)
+        self.assertIs(self.eigrp._topology[net].successor.neighbor, a)
+        self.assertEqual(self.eigrp._fib.routes, routes)
+        self.assertEqual(self.eigrp.sent, [ ])
+
+    def test_one_packet_per_opcode(self):
+        a = self._neighbor("10.0.0.2")
+        b = self._neighbor("10.0.0.3")
+        routes = [ ("192.168.{}.0".format(n), 24, 100, "0.0.0.0")
+                   for n in xrange(10) ]
+        self._update(a, routes)
+        # b is a feasible successor for half of them.
+        self._update(b, [ (addr, plen, 105 if n % 2 else 500, nexthop)
+                          for n, (addr, plen, dly, nexthop)
+                          in enumerate(routes) ])
+        self.eigrp.lostNeighbor(a)
+        self.assertEqual(sorted([ (opcode, len(tlvs)) for opcode, tlvs
+                                  in self.eigrp.sent ]),
+                         [ (rtp.RTPHeader2.OPC_UPDATE, 5),
+                           (rtp.RTPHeader2.OPC_QUERY, 5) ])
+        self.assertEqual(len(self.eigrp._fib.routes), 5)
+
+
+class TestLinkDown(RouteTestCase):
+
+    def setUp(self):
+        RouteTestCase.setUp(self)
+        self.eth1 = FakeIface("eth1", "10.1.0.1/24")
+        self.eth2 = FakeIface("eth2", "10.2.0.1/24")
+        self.eigrp._ifaces = [ self.iface, self.eth1, self.eth2 ]
+        self.a = self._neighbor("10.0.0.2")
+        self.b = self._neighbor("10.1.0.2", self.eth1)
+        self.c = self._neighbor("10.2.0.2", self.eth2)
+        self.nets = [ prefix("192.168.{}.0".format(n), 24) for n in xrange(4) ]
+        routes = [ ("192.168.{}.0".format(n), 24, 100, "0.0.0.0")
+                   for n in xrange(4) ]
+        self._update(self.a, routes)
+        # b is a feasible successor for the first two prefixes, c only for
+        # the first.
+        self._update(self.b, [ (addr, plen, 105 if n < 2 else 500, nexthop)
+                               for n, (addr, plen, dly, nexthop)
+                               in enumerate(routes) ])
+        self._update(self.c, [ routes[0][:2] + (106, "0.0.0.0") ])
+
+    def test_feasible_successor(self):
+        self.eigrp._link_down([ "eth0" ])
+        for net in self.nets[:2]:
+            self.assertIs(self.eigrp._topology[net].successor.neighbor,
+                          self.b)
+            self.assertEqual(self.eigrp._fib.routes[net][1],
+                             int(ipaddr.IPv4Address("10.1.0.2")))
+        for net in self.nets[2:]:
+            self.assertEqual(self.eigrp._topology[net].state,
+                             dualfsm.ACTIVE1)
+            self.assertFalse(net in self.eigrp._fib.routes)
+        self.assertEqual(sorted([ (opcode, len(tlvs)) for opcode, tlvs
+                                  in self.eigrp.sent ]),
+                         [ (rtp.RTPHeader2.OPC_UPDATE, 2),
+                           (rtp.RTPHeader2.OPC_QUERY, 2) ])
+        # Nothing that a reported is left.
+        self.assertEqual(self.eigrp._topology.neighbor_entries(self.a), [ ])
+
+    def test_links_together(self):
+        # b's link goes down too, so only c is left for the first prefix.
+        self.eigrp._link_down([ "eth0", "eth1" ])
+        t_entry = self.eigrp._topology[self.nets[0]]
+        self.assertIs(t_entry.successor.neighbor, self.c)
+        self.assertEqual(sorted([ (opcode, len(tlvs)) for opcode, tlvs
+                                  in self.eigrp.sent ]),
+                         [ (rtp.RTPHeader2.OPC_UPDATE, 1),
+                           (rtp.RTPHeader2.OPC_QUERY, 3) ])
+
+    def test_not_successor(self):
+        routes = dict(self.eigrp._fib.routes)
+        self.eigrp._link_down([ "eth2" ])
+        self.assertEqual(self.eigrp._fib.routes, routes)
+        self.assertEqual(self.eigrp.sent, [ ])
+        t_entry = self.eigrp._topology[self.nets[0]]
+        self.assertFalse(self.c in t_entry.neighbors)
+
+    def test_other_link(self):
+        routes = dict(self.eigrp._fib.routes)
+        self.eigrp._link_down([ "eth9" ])
+        self.assertEqual(self.eigrp._fib.routes, routes)
+        self.assertEqual(self.eigrp.sent, [ ])
+
+
+class TestRecompute(RouteTestCase):
+
+    def setUp(self):
+        RouteTestCase.setUp(self)
+        # Delay only, so a is the successor until bandwidth is counted.
+        self.eigrp._k1, self.eigrp._k3 = 0, 1
+        self.eigrp._new_kvalues()
+        self.a = self._neighbor("10.0.0.2")
+        self.b = self._neighbor("10.0.0.3")
+        self.net = prefix("192.168.0.0", 24)
+        self._update(self.a, [ ("192.168.0.0", 24, 100, "0.0.0.0") ], bw=1000)
+        self._update(self.b, [ ("192.168.0.0", 24, 400, "10.0.0.9") ])
+        self.t_entry = self.eigrp._topology[self.net]
+        self.assertIs(self.t_entry.successor.neighbor, self.a)
+
+    def test_new_kvalues(self):
+        self.eigrp._k1, self.eigrp._k3 = 1, 0
+        self.eigrp._new_kvalues()
+        self.assertIs(self.t_entry.successor.neighbor, self.b)
+        self.assertEqual(self.t_entry.state, dualfsm.PASSIVE)
+        metric, nexthop = self.eigrp._fib.routes[self.net]
+        self.assertEqual(nexthop, int(ipaddr.IPv4Address("10.0.0.9")))
+        self.assertEqual(metric, self.t_entry.successor.full_metric())
+        opcode, tlvs = self.eigrp.sent[0]
+        self.assertEqual(opcode, rtp.RTPHeader2.OPC_UPDATE)
+        self.assertEqual(tlvs[0].metric.bw,
+                         self.t_entry.successor.full_distance.bw)
+
+    def test_unchanged(self):
+        routes = dict(self.eigrp._fib.routes)
+        self.eigrp._new_kvalues()
+        self.assertIs(self.t_entry.successor.neighbor, self.a)
+        self.assertEqual(self.eigrp._fib.routes, routes)
+        self.assertEqual(self.eigrp.sent, [ ])
+
+
+class TestIfaceMetrics(RouteTestCase):
+
+    def setUp(self):
+        RouteTestCase.setUp(self)
+        self.other = FakeIface("eth1", "10.1.0.1/24")
+        self.eigrp._ifaces = [ self.iface, self.other ]
+        self.a = self._neighbor("10.0.0.2")
+        self.b = self._neighbor("10.1.0.2", self.other)
+        self.net = prefix("192.168.0.0", 24)
+        self.other_net = prefix("192.168.1.0", 24)
+        self._update(self.a, [ ("192.168.0.0", 24, 100, "0.0.0.0") ])
+        self._update(self.b, [ ("192.168.0.0", 24, 105, "0.0.0.0"),
+                               ("192.168.1.0", 24, 100, "0.0.0.0") ])
+        self.t_entry = self.eigrp._topology[self.net]
+        self.assertIs(self.t_entry.successor.neighbor, self.a)
+
+        # Record the prefixes that are recomputed.
+        self.recomputed = list()
+        recompute_entries = self.eigrp._recompute_entries
+        def record(entries, update_tlvs, query_tlvs):
+            entries = list(entries)
+            self.recomputed.append(sorted([ p for p, t_entry in entries ]))
+            return recompute_entries(entries, update_tlvs, query_tlvs)
+        self.eigrp._recompute_entries = record
+
+    def _set_delay(self, iface, delay):
+        phy_iface = iface.logical_iface.phy_iface
+        phy_iface.set_metrics(delay=delay)
+        self.eigrp._iface_metrics_changed([ phy_iface ])
+
+    def test_new_successor(self):
+        self._set_delay(self.iface, 50)
+        self.assertEqual(self.recomputed, [ [ self.net ] ])
+        self.assertIs(self.t_entry.successor.neighbor, self.b)
+        metric, nexthop = self.eigrp._fib.routes[self.net]
+        self.assertEqual(nexthop, int(ipaddr.IPv4Address("10.1.0.2")))
+        self.assertEqual(metric, self.t_entry.successor.full_metric())
+        opcode, tlvs = self.eigrp.sent[0]
+        self.assertEqual(opcode, rtp.RTPHeader2.OPC_UPDATE)
+        self.assertEqual(len(tlvs), 1)
+        self.assertEqual(tlvs[0].metric.dly, 105 + 10)
+
+    def test_successor_distance(self):
+        self._set_delay(self.iface, 12)
+        self.assertIs(self.t_entry.successor.neighbor, self.a)
+        metric, nexthop = self.eigrp._fib.routes[self.net]
+        self.assertEqual(nexthop, int(ipaddr.IPv4Address("10.0.0.2")))
+        self.assertEqual(metric, self.t_entry.successor.full_metric())
+        opcode, tlvs = self.eigrp.sent[0]
+        self.assertEqual(opcode, rtp.RTPHeader2.OPC_UPDATE)
+        self.assertEqual(tlvs[0].metric.dly, 100 + 12)
+
+    def test_only_affected_prefixes(self):
+        # Both prefixes were learned through eth1. Only other_net's
+        # successor is there, so only its new distance is advertised.
+        other_routes = self.eigrp._fib.routes[self.other_net]
+        self._set_delay(self.other, 20)
+        self.assertEqual(self.recomputed, [ [ self.net, self.other_net ] ])
+        self.assertEqual(self.eigrp._fib.routes[self.other_net][1],
+                         other_routes[1])
+        self.assertEqual([ [ ipv4.make_prefix(tlv.dest.addr, tlv.dest.plen)
+                             for tlv in tlvs ]
+                           for opcode, tlvs in self.eigrp.sent ],
+                         [ [ self.other_net ] ])
+
+    def test_no_prefixes(self):
+        # As for the first sample at startup, before any routes are learned.
+        self.eigrp._topology = TopologyTable(self.eigrp._get_kvalues)
+        self._set_delay(self.iface, 50)
+        self.assertEqual(self.recomputed, [ ])
+        self.assertEqual(self.eigrp.sent, [ ])
+
+
+if __name__ == "__main__":
+    unittest.main()
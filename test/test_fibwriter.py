@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+"""Tests for FibWriter, with the system and the worker faked and time driven
+by a task.Clock."""
+
+import os
+import sys
+import errno
+import unittest
+
+from twisted.internet import defer, task
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import ipv4
+import fibwriter
+
+NET1 = ipv4.make_prefix("10.1.0.0", 16)
+NET2 = ipv4.make_prefix("10.2.0.0", 16)
+NET3 = ipv4.make_prefix("10.3.0.0", 24)
+NH1 = ipv4.aton("192.0.2.1")
+NH2 = ipv4.aton("192.0.2.2")
+
+INTERVAL = .05
+
+
+class FakeSystem(object):
+    """Records the batches passed to apply_routes, and fails the changes to
+    the prefixes in self.fail with the errno given there. If self.error is
+    set, apply_routes raises it instead."""
+
+    def __init__(self):
+        self.batches = list()
+        self.fail = dict()
+        self.error = None
+
+    def apply_routes(self, ops):
+        if self.error:
+            raise(self.error)
+        self.batches.append(sorted(ops))
+        return [ self.fail.get((net, plen), 0)
+                 for net, plen, metric, nexthop in ops ]
+
+
+class FakeWorker(object):
+    """Holds submitted batches until finish is called, so tests decide when
+    each one is written."""
+
+    def __init__(self, system, max_batches=2):
+        self._sys = system
+        self._max_batches = max_batches
+        self.queue = list()
+
+    def full(self):
+        return len(self.queue) >= self._max_batches
+
+    def submit(self, ops):
+        d = defer.Deferred()
+        self.queue.append((ops, d))
+        return d
+
+    def finish(self):
+        """Write the oldest submitted batch and report it."""
+        ops, d = self.queue.pop(0)
+        d.callback((self._sys.apply_routes(ops), 0., 0.))
+
+
+class Recorder(object):
+    """Collects the results of Deferreds, in the order they fire."""
+
+    def __init__(self):
+        self.results = list()
+
+    def watch(self, name, d):
+        d.addCallback(lambda result: self.results.append((name, result)))
+        return d
+
+
+class FibWriterTestCase(unittest.TestCase):
+
+    batch_size = 3
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.system = FakeSystem()
+        self.fib = fibwriter.FibWriter(self.system, self.clock,
+                                       batch_size=self.batch_size,
+                                       interval=INTERVAL)
+
+    def _write(self):
+        """Let the interval pass so the queue is written."""
+        self.clock.advance(INTERVAL)
+
+
+class TestCoalescing(FibWriterTestCase):
+
+    def test_install_then_uninstall(self):
+        # The route was never installed, so nothing needs writing.
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.fib.uninstall_route(*NET1)
+        self.assertEqual(len(self.fib), 0)
+        self._write()
+        self.assertEqual(self.system.batches, [ ])
+        self.assertEqual(self.fib.stats()["coalesced"], 2)
+
+    def test_change_then_uninstall_installed(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self._write()
+        self.fib.install_route(NET1[0], NET1[1], 20, NH2)
+        self.fib.uninstall_route(*NET1)
+        self._write()
+        self.assertEqual(self.system.batches[1:],
+                         [ [ NET1 + (None, None) ] ])
+        self.assertEqual(self.fib.stats()["coalesced"], 1)
+
+    def test_newest_change_written(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.fib.install_route(NET1[0], NET1[1], 20, NH2)
+        self.fib.install_route(NET1[0], NET1[1], 30, NH1)
+        self._write()
+        self.assertEqual(self.system.batches, [ [ NET1 + (30, NH1) ] ])
+        self.assertEqual(self.fib.stats()["coalesced"], 2)
+
+    def test_uninstall_missing(self):
+        self.fib.uninstall_route(*NET1)
+        self._write()
+        self.assertEqual(self.system.batches, [ ])
+        self.assertEqual(self.clock.getDelayedCalls(), [ ])
+
+
+class TestUnchanged(FibWriterTestCase):
+
+    def test_installed_route(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self._write()
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.assertEqual(len(self.fib), 0)
+        self._write()
+        self.assertEqual(len(self.system.batches), 1)
+        self.assertEqual(self.fib.stats()["unchanged"], 1)
+
+    def test_change_back(self):
+        # Changed and changed back before the write, so the queued change is
+        # dropped.
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self._write()
+        self.fib.install_route(NET1[0], NET1[1], 20, NH2)
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.assertEqual(len(self.fib), 0)
+        self._write()
+        self.assertEqual(len(self.system.batches), 1)
+        self.assertEqual(self.fib.stats()["coalesced"], 1)
+
+    def test_reconciled_route(self):
+        self.fib.reconcile({ NET1 : (10, NH1), NET2 : (20, NH2) })
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.assertEqual(len(self.fib), 0)
+        self.assertEqual(self.fib.end_reconcile(), 1)
+        self._write()
+        self.assertEqual(self.system.batches, [ [ NET2 + (None, None) ] ])
+
+    def test_failed_write_retried(self):
+        # Whether a route is installed is unknown after a failed write, so
+        # the same change is written again.
+        self.system.fail[NET1] = errno.ENETUNREACH
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self._write()
+        del self.system.fail[NET1]
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self._write()
+        self.assertEqual(len(self.system.batches), 2)
+        self.assertEqual(self.fib.stats()["unchanged"], 0)
+
+
+class TestFlushTriggers(FibWriterTestCase):
+
+    def test_interval(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.clock.advance(INTERVAL / 2)
+        self.fib.install_route(NET2[0], NET2[1], 20, NH2)
+        self.assertEqual(self.system.batches, [ ])
+        # Counted from the first change, not the last.
+        self.clock.advance(INTERVAL / 2)
+        self.assertEqual(self.system.batches, [ [ NET1 + (10, NH1),
+                                                  NET2 + (20, NH2) ] ])
+        self.assertEqual(self.fib.stats()["last_batch_delay"], INTERVAL)
+        self.assertEqual(self.clock.getDelayedCalls(), [ ])
+
+    def test_batch_size(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.fib.install_route(NET2[0], NET2[1], 20, NH2)
+        # A change to a queued prefix doesn't make the queue any longer.
+        self.fib.install_route(NET2[0], NET2[1], 30, NH2)
+        self.assertEqual(self.system.batches, [ ])
+        self.fib.install_route(NET3[0], NET3[1], 30, NH1)
+        self.assertEqual(len(self.system.batches), 1)
+        self.assertEqual(len(self.fib), 0)
+        # The interval's flush was cancelled.
+        self.assertEqual(self.clock.getDelayedCalls(), [ ])
+        self.assertEqual(self.fib.stats()["batches"], 1)
+
+    def test_flush(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        failed = list()
+        self.fib.flush().addCallback(failed.extend)
+        self.assertEqual(len(self.system.batches), 1)
+        self.assertEqual(failed, [ ])
+        self.assertEqual(self.clock.getDelayedCalls(), [ ])
+
+    def test_failures(self):
+        self.system.fail[NET2] = errno.ENETUNREACH
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.fib.install_route(NET2[0], NET2[1], 20, NH2)
+        failed = list()
+        self.fib.when_written().addCallback(failed.extend)
+        self._write()
+        self.assertEqual(failed, [ (NET2, errno.ENETUNREACH) ])
+        self.assertEqual(self.fib.stats()["failed"], 1)
+
+    def test_write_raises(self):
+        self.system.error = RuntimeError("kernel went away")
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        failed = list()
+        self.fib.when_written().addCallback(failed.extend)
+        self._write()
+        self.assertEqual(failed, [ (NET1, errno.EIO) ])
+        # Not known to be installed, so the same change isn't dropped.
+        self.system.error = None
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.assertEqual(len(self.fib), 1)
+        self._write()
+        self.assertEqual(self.system.batches, [ [ NET1 + (10, NH1) ] ])
+
+    def test_write_raises_requeued(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self._write()
+        self.system.error = RuntimeError("kernel went away")
+        self.fib.install_route(NET2[0], NET2[1], 20, NH2)
+        self.fib.uninstall_route(*NET1)
+        self._write()
+        self.assertEqual(len(self.fib), 2)
+        # Retried after the interval, not straight away.
+        self._write()
+        self.assertEqual(len(self.fib), 2)
+        self.system.error = None
+        self._write()
+        self.assertEqual(self.system.batches[1:],
+                         [ [ NET1 + (None, None), NET2 + (20, NH2) ] ])
+        self.assertEqual(len(self.fib), 0)
+        self.assertEqual(self.fib.stats()["requeued"], 4)
+
+
+class TestWorker(FibWriterTestCase):
+
+    def setUp(self):
+        FibWriterTestCase.setUp(self)
+        self.worker = FakeWorker(self.system)
+        self.fib = fibwriter.FibWriter(self.system, self.clock,
+                                       batch_size=self.batch_size,
+                                       interval=INTERVAL, worker=self.worker)
+        self.recorder = Recorder()
+
+    def test_when_written_order(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.recorder.watch("first", self.fib.when_written())
+        self._write()
+        # Nothing queued, so this waits for the batch being written.
+        self.recorder.watch("first inflight", self.fib.when_written())
+        self.fib.install_route(NET2[0], NET2[1], 20, NH2)
+        self.recorder.watch("second", self.fib.when_written())
+        self._write()
+        self.recorder.watch("second inflight", self.fib.when_written())
+        self.assertEqual(self.fib.stats()["inflight"], 2)
+        self.assertEqual(self.recorder.results, [ ])
+
+        self.worker.finish()
+        self.assertEqual(self.recorder.results, [ ("first", [ ]),
+                                                  ("first inflight", [ ]) ])
+        # Still waits for the second batch.
+        self.recorder.watch("after first", self.fib.when_written())
+        self.system.fail[NET2] = errno.ENETUNREACH
+        self.worker.finish()
+        failed = [ (NET2, errno.ENETUNREACH) ]
+        self.assertEqual(self.recorder.results[2:],
+                         [ ("second", failed),
+                           ("second inflight", failed),
+                           ("after first", failed) ])
+
+        self.assertEqual(self.fib.stats()["inflight"], 0)
+        self.recorder.watch("idle", self.fib.when_written())
+        self.assertEqual(self.recorder.results[-1], ("idle", [ ]))
+
+    def test_stalled(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self._write()
+        self.fib.install_route(NET2[0], NET2[1], 20, NH2)
+        self._write()
+        self.assertTrue(self.worker.full())
+
+        self.fib.install_route(NET3[0], NET3[1], 30, NH1)
+        self.recorder.watch("third", self.fib.when_written())
+        self._write()
+        self.assertEqual(self.fib.stats()["stalls"], 1)
+        self.assertEqual(len(self.fib), 1)
+
+        # While stalled, changes are still coalesced, no flush is scheduled,
+        # and reaching batch_size doesn't write the queue.
+        self.fib.install_route(NET3[0], NET3[1], 40, NH2)
+        self.fib.install_route(NET2[0], NET2[1], 50, NH1)
+        self.fib.install_route(NET1[0], NET1[1], 60, NH1)
+        self.assertEqual(self.clock.getDelayedCalls(), [ ])
+        self.assertEqual(len(self.worker.queue), 2)
+        self.fib.flush()
+        self.assertEqual(self.fib.stats()["stalls"], 1)
+
+        # The queue is written as soon as the worker has room.
+        self.worker.finish()
+        self.assertEqual(len(self.worker.queue), 2)
+        self.assertEqual(sorted(self.worker.queue[-1][0]),
+                         [ NET1 + (60, NH1), NET2 + (50, NH1),
+                           NET3 + (40, NH2) ])
+        self.assertEqual(len(self.fib), 0)
+        self.assertEqual(self.recorder.results, [ ])
+
+        self.worker.finish()
+        self.worker.finish()
+        self.assertEqual(self.recorder.results, [ ("third", [ ]) ])
+        stats = self.fib.stats()
+        self.assertEqual(stats["batches"], 3)
+        self.assertEqual(stats["coalesced"], 1)
+        self.assertEqual(stats["inflight"], 0)
+
+        # No longer stalled, so new changes wait for the interval again.
+        self.fib.install_route(NET1[0], NET1[1], 70, NH1)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+    def test_worker_error(self):
+        self.fib.install_route(NET1[0], NET1[1], 10, NH1)
+        self.fib.install_route(NET2[0], NET2[1], 20, NH2)
+        failed = list()
+        self.fib.when_written().addCallback(failed.extend)
+        self._write()
+        # A newer change to NET2 is queued while the batch is written.
+        self.fib.install_route(NET2[0], NET2[1], 30, NH1)
+        ops, d = self.worker.queue.pop(0)
+        d.errback(RuntimeError("kernel went away"))
+        self.assertEqual(sorted(failed), [ (NET1, errno.EIO),
+                                           (NET2, errno.EIO) ])
+        # The batch is queued again, without replacing the newer change.
+        self._write()
+        self.worker.finish()
+        self.assertEqual(self.system.batches, [ [ NET1 + (10, NH1),
+                                                  NET2 + (30, NH1) ] ])
+        self.assertEqual(self.fib.stats()["requeued"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
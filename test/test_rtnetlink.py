@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""Tests for RouteWriter, run against a FakeKernel."""
+
+import os
+import sys
+import errno
+import socket
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import ipv4
+import rtnetlink
+
+TABLE = 52
+
+# from linux/rtnetlink.h
+RTN_BLACKHOLE = 6
+
+NET1 = ipv4.make_prefix("10.1.0.0", 16)
+NET2 = ipv4.make_prefix("10.2.0.0", 16)
+NET3 = ipv4.make_prefix("10.3.0.0", 24)
+NH1 = ipv4.aton("192.0.2.1")
+NH2 = ipv4.aton("192.0.2.2")
+
+
+def route_type(payload, rttype):
+    """Return a pack_route payload with the route's type changed."""
+    index = rtnetlink.RTMSG_FMT.index("I")
+    return payload[:index - 1] + chr(rttype) + payload[index:]
+
+
+class TypedKernel(rtnetlink.FakeKernel):
+    """A FakeKernel whose route dumps also include the routes in
+    self.other, a list of (msgtype, payload), such as non-unicast and IPv6
+    routes."""
+
+    def __init__(self):
+        rtnetlink.FakeKernel.__init__(self)
+        self.other = list()
+
+    def _dump_routes(self):
+        return rtnetlink.FakeKernel._dump_routes(self) + self.other
+
+    _DUMPS = dict(rtnetlink.FakeKernel._DUMPS)
+    _DUMPS[rtnetlink.RTM_GETROUTE] = _dump_routes
+
+
+class TestRouteWriterApply(unittest.TestCase):
+
+    def setUp(self):
+        self.kernel = rtnetlink.FakeKernel()
+        self.writer = rtnetlink.RouteWriter(TABLE, self.kernel)
+
+    def _kernel_routes(self):
+        """Return every route in the table, as {prefix: {metric: nexthop}},
+        including the ones that routes() hides behind a lower metric."""
+        return dict([ (prefix, dict([ (metric, nexthop) for metric,
+                                      (nexthop, protocol)
+                                      in metrics.iteritems() ]))
+                      for prefix, metrics
+                      in self.kernel.tables.get(TABLE, {}).iteritems() ])
+
+    def test_install(self):
+        errors = self.writer.apply([ NET1 + (10, NH1), NET2 + (20, NH2) ])
+        self.assertEqual(errors, [ 0, 0 ])
+        self.assertEqual(self._kernel_routes(), { NET1 : { 10 : NH1 },
+                                                  NET2 : { 20 : NH2 } })
+        self.assertEqual(self.writer.routes, { NET1 : (10, NH1),
+                                               NET2 : (20, NH2) })
+        # Both in one datagram.
+        self.assertEqual(self.kernel.datagrams, 1)
+        for protocol in [ p for metrics in self.kernel.tables[TABLE].values()
+                          for n, p in metrics.values() ]:
+            self.assertEqual(protocol, rtnetlink.RTPROT_EIGRP)
+
+    def test_replace(self):
+        self.writer.apply([ NET1 + (10, NH1) ])
+        errors = self.writer.apply([ NET1 + (10, NH2) ])
+        self.assertEqual(errors, [ 0 ])
+        self.assertEqual(self._kernel_routes(), { NET1 : { 10 : NH2 } })
+        self.assertEqual(self.writer.routes, { NET1 : (10, NH2) })
+
+    def test_delete(self):
+        self.writer.apply([ NET1 + (10, NH1), NET2 + (20, NH2) ])
+        errors = self.writer.apply([ NET1 + (None, None) ])
+        self.assertEqual(errors, [ 0 ])
+        self.assertEqual(self._kernel_routes(), { NET2 : { 20 : NH2 } })
+        self.assertEqual(self.writer.routes, { NET2 : (20, NH2) })
+
+    def test_delete_missing(self):
+        self.writer.apply([ NET1 + (10, NH1) ])
+        del self.kernel.tables[TABLE][NET1]
+        # Reported, but the route is forgotten anyway.
+        errors = self.writer.apply([ NET1 + (None, None) ])
+        self.assertEqual(errors, [ errno.ESRCH ])
+        self.assertEqual(self.writer.routes, { })
+
+    def test_metric_change(self):
+        # Routes with different metrics are different routes to the
+        # kernel, so the old one has to be removed.
+        self.writer.apply([ NET1 + (10, NH1) ])
+        errors = self.writer.apply([ NET1 + (20, NH2) ])
+        self.assertEqual(errors, [ 0 ])
+        self.assertEqual(self._kernel_routes(), { NET1 : { 20 : NH2 } })
+        self.assertEqual(self.writer.routes, { NET1 : (20, NH2) })
+
+    def test_metric_change_in_one_apply(self):
+        errors = self.writer.apply([ NET1 + (10, NH1), NET1 + (20, NH2),
+                                     NET1 + (30, NH1) ])
+        self.assertEqual(errors, [ 0, 0, 0 ])
+        self.assertEqual(self._kernel_routes(), { NET1 : { 30 : NH1 } })
+        self.assertEqual(self.writer.routes, { NET1 : (30, NH1) })
+
+    def test_metric_change_old_route_gone(self):
+        # The old route's removal fails, which isn't the change's error.
+        self.writer.apply([ NET1 + (10, NH1) ])
+        del self.kernel.tables[TABLE][NET1]
+        self.assertEqual(self.writer.apply([ NET1 + (20, NH2) ]), [ 0 ])
+        self.assertEqual(self._kernel_routes(), { NET1 : { 20 : NH2 } })
+
+    def test_errors(self):
+        self.kernel.fail[NET2] = errno.ENETUNREACH
+        errors = self.writer.apply([ NET1 + (10, NH1), NET2 + (20, NH2),
+                                     NET3 + (30, NH1) ])
+        self.assertEqual(errors, [ 0, errno.ENETUNREACH, 0 ])
+        self.assertEqual(self.writer.routes, { NET1 : (10, NH1),
+                                               NET3 : (30, NH1) })
+        self.assertEqual(sorted(self._kernel_routes()), [ NET1, NET3 ])
+
+    def test_errors_across_datagrams(self):
+        self.writer.BATCH_SIZE = 4
+        nets = [ ipv4.make_prefix((10 << 24) | (n << 8), 24)
+                 for n in xrange(10) ]
+        for index in (1, 6, 9):
+            self.kernel.fail[nets[index]] = errno.EINVAL + index
+        errors = self.writer.apply([ net + (10, NH1) for net in nets ])
+        self.assertEqual(self.kernel.datagrams, 3)
+        self.assertEqual(errors, [ 0, errno.EINVAL + 1, 0, 0, 0, 0,
+                                   errno.EINVAL + 6, 0, 0,
+                                   errno.EINVAL + 9 ])
+
+    def test_errors_with_removals(self):
+        # A metric change sends two requests for one change, which moves
+        # the requests after it along.
+        self.writer.BATCH_SIZE = 2
+        self.writer.apply([ NET1 + (10, NH1) ])
+        self.kernel.fail[NET2] = errno.ENETUNREACH
+        errors = self.writer.apply([ NET1 + (20, NH1), NET3 + (30, NH1),
+                                     NET2 + (40, NH1) ])
+        self.assertEqual(errors, [ 0, 0, errno.ENETUNREACH ])
+
+    def test_out_of_range(self):
+        # Only the changes that don't fit in a request fail.
+        errors = self.writer.apply([ NET1 + (10, NH1),
+                                     NET2 + (1 << 32, NH1),
+                                     NET3 + (30, 1 << 32),
+                                     (NET3[0], 33, 30, NH1),
+                                     NET3 + (30, NH2) ])
+        self.assertEqual(errors, [ 0, errno.EINVAL, errno.EINVAL,
+                                   errno.EINVAL, 0 ])
+        self.assertEqual(self._kernel_routes(), { NET1 : { 10 : NH1 },
+                                                  NET3 : { 30 : NH2 } })
+        self.assertEqual(self.writer.routes, { NET1 : (10, NH1),
+                                               NET3 : (30, NH2) })
+        self.assertEqual(self.writer.apply([ NET1 + (rtnetlink.U32_MAX,
+                                                     NH1) ]), [ 0 ])
+
+    def test_send_fails(self):
+        # The second datagram can't be sent. Only its changes fail.
+        self.writer.BATCH_SIZE = 2
+        sendto = self.kernel.sendto
+        sent = list()
+        def fail_second(data, addr):
+            sent.append(data)
+            if len(sent) == 2:
+                raise(socket.error(errno.ENOBUFS, "No buffer space"))
+            return sendto(data, addr)
+        self.kernel.sendto = fail_second
+        nets = [ ipv4.make_prefix((10 << 24) | (n << 8), 24)
+                 for n in xrange(6) ]
+        errors = self.writer.apply([ net + (10, NH1) for net in nets ])
+        self.assertEqual(errors, [ 0, 0, errno.ENOBUFS, errno.ENOBUFS, 0,
+                                   0 ])
+        self.assertEqual(sorted(self.writer.routes),
+                         [ nets[0], nets[1], nets[4], nets[5] ])
+
+    def test_replace_route_raises(self):
+        self.kernel.fail[NET1] = errno.ENETUNREACH
+        try:
+            self.writer.replace_route(NET1[0], NET1[1], 10, NH1)
+        except rtnetlink.NetlinkError as e:
+            self.assertEqual(e.errno, errno.ENETUNREACH)
+        else:
+            self.fail("NetlinkError not raised")
+        try:
+            self.writer.delete_route(NET2[0], NET2[1])
+        except rtnetlink.NetlinkError as e:
+            self.assertEqual(e.errno, errno.ESRCH)
+        else:
+            self.fail("NetlinkError not raised")
+
+
+class TestRouteWriterDump(unittest.TestCase):
+
+    def setUp(self):
+        self.kernel = TypedKernel()
+        self.writer = rtnetlink.RouteWriter(TABLE, self.kernel)
+
+    def _add(self, table, prefix, metric, nexthop,
+             protocol=rtnetlink.RTPROT_EIGRP):
+        tables = self.kernel.tables.setdefault(table, dict())
+        tables.setdefault(prefix, dict())[metric] = nexthop, protocol
+
+    def test_table(self):
+        self._add(TABLE, NET1, 10, NH1)
+        self._add(254, NET2, 0, NH2, rtnetlink.RTPROT_BOOT)
+        self._add(TABLE + 1, NET3, 10, NH1)
+        self.assertEqual(self.writer.dump_routes(), { NET1 : (10, NH1) })
+
+    def test_large_table(self):
+        # Tables above 255 only fit in the RTA_TABLE attribute.
+        writer = rtnetlink.RouteWriter(1000, self.kernel)
+        self._add(1000, NET1, 10, NH1)
+        self._add(1000 & 0xff, NET2, 10, NH1)
+        self.assertEqual(writer.dump_routes(), { NET1 : (10, NH1) })
+
+    def test_type(self):
+        self._add(TABLE, NET1, 10, NH1)
+        self.kernel.other.append((rtnetlink.RTM_NEWROUTE, route_type(
+                                  rtnetlink.pack_route(NET2[0], NET2[1],
+                                                       TABLE, metric=5),
+                                  RTN_BLACKHOLE)))
+        # Not an IPv4 route.
+        payload = rtnetlink.pack_route(NET3[0], NET3[1], TABLE, metric=5)
+        self.kernel.other.append((rtnetlink.RTM_NEWROUTE,
+                                  chr(socket.AF_INET6) + payload[1:]))
+        self.assertEqual(self.writer.dump_routes(), { NET1 : (10, NH1) })
+
+    def test_lowest_metric(self):
+        self._add(TABLE, NET1, 30, NH1)
+        self._add(TABLE, NET1, 10, NH2)
+        self._add(TABLE, NET2, None, NH2)
+        self.assertEqual(self.writer.dump_routes(), { NET1 : (10, NH2),
+                                                      NET2 : (0, NH2) })
+
+    def test_dumped_routes_are_replaced(self):
+        # Routes left by an earlier run are known to the writer once
+        # dumped, so a new metric removes them.
+        self._add(TABLE, NET1, 10, NH1)
+        self.writer.dump_routes()
+        self.assertEqual(self.writer.routes, { NET1 : (10, NH1) })
+        self.writer.apply([ NET1 + (20, NH2) ])
+        self.assertEqual(self.kernel.routes(TABLE), { NET1 : (20, NH2) })
+        self.assertEqual(len(self.kernel.tables[TABLE][NET1]), 1)
+
+    def test_empty(self):
+        self.assertEqual(self.writer.dump_routes(), { })
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+
+"""Tests for in-order delivery of sequenced packets by RTPNeighbor."""
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+from twisted.internet import task
+
+import rtp
+import rtptlv
+import util
+import timerwheel
+
+KVALUES = [ 1, 1, 1, 0, 0 ]
+
+if not hasattr(logging.Logger, "debug5"):
+    util.create_extended_debug_log_levels()
+
+
+class NeighborHarness(object):
+    """An RTPNeighbor whose packets are written to a list instead of the
+    network."""
+
+    def __init__(self, ip, window_size):
+        self.clock = task.Clock()
+        self.sent = list()
+        self._seq = 0
+        self.neighbor = rtp.RTPNeighbor(ip, None, rtp.RTPHeader2,
+                                        logging.getLogger("RTP"),
+                                        self._drop, self._make_pkt,
+                                        self._write, KVALUES,
+                                        window_size=window_size,
+                                        timers=timerwheel.TimerWheel(
+                                            self.clock))
+        self.neighbor._state_receive = self.neighbor._up_receive
+
+    def _drop(self, neighbor, send_upper):
+        pass
+
+    def _make_pkt(self, opcode, tlvs, ack, flags=0):
+        self._seq += 1
+        hdr = rtp.RTPHeader2(opcode=opcode, flags=flags, seq=self._seq,
+                             ack=0, rid=1, asn=1)
+        return rtp.RTPPacket(hdr, tlvs)
+
+    def _write(self, neighbor, pkt):
+        self.sent.append(pkt.pack())
+
+
+class TestInOrderDelivery(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = rtptlv.TLVFactory(lazy=True)
+        self.factory.register_tlvs([rtptlv.TLVMulticastSeq,
+                                    rtptlv.TLVPrevSeq])
+        self.receiver = NeighborHarness("10.0.0.1", 1).neighbor
+
+    def _parse(self, data):
+        return (rtp.RTPHeader2(data),
+                self.factory.build_all(data, rtp.RTPHeader2.LEN))
+
+    def _receive(self, seq, prev=None, flags=0):
+        tlvs = [ rtptlv.TLVMulticastSeq(seq) ]
+        if prev is not None:
+            tlvs.insert(0, rtptlv.TLVPrevSeq(prev))
+        hdr = rtp.RTPHeader2(opcode=rtp.RTPHeader2.OPC_UPDATE, flags=flags,
+                             seq=seq, ack=0, rid=1, asn=1)
+        return self._receive_raw(rtp.RTPPacket(hdr, tlvs).pack())
+
+    def _receive_raw(self, data):
+        hdr, tlvs = self._parse(data)
+        return self.receiver.receive(hdr, tlvs), tlvs
+
+    def test_in_order(self):
+        status, tlvs = self._receive(5)
+        self.assertEqual(status, self.receiver.PROCESS)
+        self.assertEqual(self.receiver.next_ack, 5)
+        status, tlvs = self._receive(9, prev=5)
+        self.assertEqual(status, self.receiver.PROCESS)
+        self.assertEqual(self.receiver.next_ack, 9)
+        # The TLVPrevSeq isn't passed to the upper layer.
+        self.assertEqual([ tlv.type for tlv in tlvs ],
+                         [ rtptlv.TLVMulticastSeq.TYPE ])
+
+    def test_hold_until_gap_filled(self):
+        self._receive(5)
+        status, tlvs = self._receive(9, prev=7)
+        self.assertEqual(status, self.receiver.DROP)
+        self.assertEqual(self.receiver.next_ack, 0)
+        status, tlvs = self._receive(12, prev=9)
+        self.assertEqual(status, self.receiver.DROP)
+        self.assertEqual(self.receiver.held(), 2)
+        self.assertFalse(self.receiver.ready)
+
+        status, tlvs = self._receive(7, prev=5)
+        self.assertEqual(status, self.receiver.PROCESS)
+        self.assertEqual(self.receiver.next_ack, 7)
+        self.assertEqual([ hdr.seq for hdr, tlvs in self.receiver.ready ],
+                         [ 9, 12 ])
+        for hdr, tlvs in self.receiver.ready:
+            self.assertEqual([ tlv.multicastseq.seq for tlv in tlvs ],
+                             [ hdr.seq ])
+        self.assertEqual(self.receiver.held(), 0)
+
+    def test_retransmitted_held_packet_stays_held(self):
+        self._receive(5)
+        self._receive(9, prev=7)
+        status, tlvs = self._receive(9, prev=7)
+        self.assertEqual(status, self.receiver.DROP)
+        self.assertEqual(self.receiver.next_ack, 0)
+        self.assertEqual(self.receiver.held(), 1)
+        self._receive(7, prev=5)
+        self.assertEqual(len(self.receiver.ready), 1)
+
+    def test_drop_delivered(self):
+        self._receive(5)
+        self._receive(7)
+        for seq in (7, 6, 5):
+            status, tlvs = self._receive(seq)
+            self.assertEqual(status, self.receiver.DROP)
+            # Delivered packets are ACKed again.
+            self.assertEqual(self.receiver.next_ack, seq)
+        self.assertEqual(self.receiver.dupes_received, 3)
+
+    def test_init_restarts_sequence(self):
+        self._receive(50)
+        self._receive(60, prev=55)
+        status, tlvs = self._receive(1, flags=rtp.RTPHeader2.FLAG_INIT)
+        self.assertEqual(status, self.receiver.PROCESS)
+        self.assertEqual(self.receiver.held(), 0)
+        status, tlvs = self._receive(2, prev=1)
+        self.assertEqual(status, self.receiver.PROCESS)
+
+    def test_window_delivers_in_order(self):
+        sender = NeighborHarness("10.0.0.2", 4)
+        for n in xrange(4):
+            sender.neighbor.send(rtp.RTPHeader2.OPC_UPDATE,
+                                 [ rtptlv.TLVMulticastSeq(n) ], True)
+        self.assertEqual(len(sender.sent), 4)
+        first, rest = sender.sent[0], sender.sent[1:]
+        # The first packet was sent with nothing in flight ahead of it, so
+        # it doesn't need a TLVPrevSeq.
+        self.assertEqual(self._parse(first)[1][0].type,
+                         rtptlv.TLVMulticastSeq.TYPE)
+
+        delivered = list()
+        for data in reversed(rest):
+            status, tlvs = self._receive_raw(data)
+            self.assertEqual(status, self.receiver.DROP)
+        status, tlvs = self._receive_raw(first)
+        self.assertEqual(status, self.receiver.PROCESS)
+        delivered.append(tlvs)
+        delivered.extend([ tlvs for hdr, tlvs in self.receiver.ready ])
+        self.assertEqual([ tlvs[0].multicastseq.seq for tlvs in delivered ],
+                         [ 0, 1, 2, 3 ])
+
+
+if __name__ == "__main__":
+    unittest.main()
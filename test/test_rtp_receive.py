@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+"""Tests for the handling of packets that the transport reads in a batch."""
+
+import os
+import sys
+import logging
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import rtp
+import util
+
+if not hasattr(logging.Logger, "debug5"):
+    util.create_extended_debug_log_levels()
+
+
+class RecordingRTP(rtp.ReliableTransportProtocol):
+    """An RTP instance that records the packets passed to datagramReceived
+    instead of handling them. Packets whose data is "bad" raise."""
+
+    def __init__(self):
+        self.log = logging.getLogger("RTP")
+        self.received = list()
+
+    def datagramReceived(self, data, addr_and_port):
+        if data == "bad":
+            raise(ValueError("bad packet"))
+        self.received.append((data, addr_and_port))
+
+
+class TestDatagramsReceived(unittest.TestCase):
+    def setUp(self):
+        self.rtp = RecordingRTP()
+
+    def test_in_order(self):
+        datagrams = [ ("one", ("10.0.0.1", 0, 2)),
+                      ("two", ("10.0.0.2", 0, 3)) ]
+        self.rtp.datagramsReceived(datagrams)
+        self.assertEqual(self.rtp.received, datagrams)
+
+    def test_error_keeps_batch(self):
+        """A packet that raises doesn't stop the rest of the batch from
+        being handled."""
+        logging.disable(logging.CRITICAL)
+        try:
+            self.rtp.datagramsReceived([ ("one", ("10.0.0.1", 0, 2)),
+                                         ("bad", ("10.0.0.2", 0, 2)),
+                                         ("two", ("10.0.0.3", 0, 2)) ])
+        finally:
+            logging.disable(logging.NOTSET)
+        self.assertEqual(self.rtp.received,
+                         [ ("one", ("10.0.0.1", 0, 2)),
+                           ("two", ("10.0.0.3", 0, 2)) ])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,153 @@
+#!/usr/bin/env python
+
+"""Tests for building TLVs from packets with bad lengths, and for metrics
+read from the columns of a batch of routes."""
+
+import os
+import sys
+import struct
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import rtptlv
+
+TLVCLASSES = [ rtptlv.TLVParam,
+               rtptlv.TLVAuth,
+               rtptlv.TLVSeq,
+               rtptlv.TLVMulticastSeq,
+               rtptlv.TLVInternal4,
+             ]
+
+
+def make_factories():
+    factories = list()
+    for lazy in (False, True):
+        factory = rtptlv.TLVFactory(lazy=lazy)
+        factory.register_tlvs(TLVCLASSES)
+        factories.append(factory)
+    return factories
+
+
+def with_length(tlv, length):
+    """Return tlv packed with length in its header instead of its real
+    length, followed by a valid TLV so there is data after it to read."""
+    packed = tlv.pack()
+    return struct.pack(rtptlv.TLVBase.HDR_FORMAT, tlv.type, length) + \
+           packed[rtptlv.TLVBase.HDR_LEN:] + \
+           rtptlv.TLVMulticastSeq(7).pack()
+
+
+class TestTLVLength(unittest.TestCase):
+
+    def setUp(self):
+        self.factories = make_factories()
+        self.route = rtptlv.TLVInternal4("10.0.0.1", 1, 2, 1500, 1, 255, 1,
+                                         0, 0, 24, "10.1.2.0")
+        self.param = rtptlv.TLVParam(1, 0, 1, 0, 0, 15)
+
+    def assertRejected(self, raw):
+        for factory in self.factories:
+            self.assertRaises(ValueError, factory.build_all, raw)
+
+    def test_valid(self):
+        for factory in self.factories:
+            tlvs = factory.build_all(self.route.pack() + self.param.pack())
+            self.assertEqual(tlvs[0].dest.plen, 24)
+            self.assertEqual(tlvs[1].param.holdtime, 15)
+
+    def test_zero_length(self):
+        self.assertRejected(with_length(self.route, 0))
+        self.assertRejected(with_length(self.param, 0))
+        self.assertRejected(with_length(rtptlv.TLVSeq("\x0a\x00\x00\x01"),
+                                        0))
+
+    def test_shorter_than_header(self):
+        for length in xrange(1, rtptlv.TLVBase.HDR_LEN):
+            self.assertRejected(with_length(self.param, length))
+
+    def test_shorter_than_values(self):
+        # A TLVInternal4 needs 4 bytes of header, 4 of next hop, 16 of metric
+        # and at least 1 of destination.
+        for length in (4, 8, 24):
+            self.assertRejected(with_length(self.route, length))
+        self.assertRejected(with_length(self.param,
+                                        len(self.param.pack()) - 1))
+
+    def test_empty_variable_length(self):
+        # A sequence TLV with no addresses is just a header.
+        for factory in self.factories:
+            tlvs = factory.build_all(struct.pack(
+                rtptlv.TLVBase.HDR_FORMAT, rtptlv.TLVSeq.TYPE,
+                rtptlv.TLVBase.HDR_LEN))
+            self.assertEqual(tlvs[0].seq.addrs, [ ])
+
+
+class FakeIface(object):
+    """Just enough of an RTP interface for update_for_iface."""
+
+    def __init__(self, bw, dly, load, rel, mtu):
+        self.logical_iface = self
+        self.phy_iface = self
+        self.get_bandwidth = lambda: bw
+        self.get_delay = lambda: dly
+        self.get_load = lambda: load
+        self.get_reliability = lambda: rel
+        self.get_mtu = lambda: mtu
+
+
+class TestMetricFields(unittest.TestCase):
+
+    def setUp(self):
+        self.routes = rtptlv.Internal4Columns()
+        self.metrics = [ rtptlv.ValueClassicMetric(100, 256, 1500, 1, 255,
+                                                   1, 0, 0),
+                         rtptlv.ValueClassicMetric(7, 3000, 9000, 4, 200,
+                                                   30, 5, 1),
+                         rtptlv.ValueClassicMetric(
+                             rtptlv.ValueClassicMetric.METRIC_UNREACHABLE,
+                             256, 1500, 1, 255, 1, 0, 0),
+                       ]
+        for metric in self.metrics:
+            tlv = rtptlv.TLVInternal4("10.0.0.1", metric.dly, metric.bw,
+                                      metric.mtu, metric.hops, metric.rel,
+                                      metric.load, metric.tag, metric.flags,
+                                      24, "10.1.2.0")
+            self.routes.append_tlv(tlv)
+
+    def test_fields(self):
+        for index, metric in enumerate(self.metrics):
+            self.assertEqual(self.routes.fields(index),
+                             tuple([ getattr(metric, field) for field
+                                     in metric.FIELDS ]))
+
+    def test_metric(self):
+        for kvalues in ([ 1, 0, 1, 0, 0 ], [ 1, 2, 3, 4, 5 ],
+                        [ 0, 1, 0, 0, 1 ]):
+            rtptlv.ValueClassicMetric.new_kvalue_generation()
+            for index, metric in enumerate(self.metrics):
+                self.assertEqual(rtptlv.ValueClassicMetric.fields_metric(
+                                     self.routes.fields(index), *kvalues),
+                                 metric.compute_metric(*kvalues))
+
+    def test_reachable(self):
+        self.assertEqual([ rtptlv.ValueClassicMetric.fields_reachable(
+                               self.routes.fields(index))
+                           for index in xrange(len(self.routes)) ],
+                         [ True, True, False ])
+
+    def test_for_iface(self):
+        iface = FakeIface(1000, 10, 50, 250, 1400)
+        for index, metric in enumerate(self.metrics):
+            fields = rtptlv.ValueClassicMetric.fields_for_iface(
+                self.routes.fields(index), iface)
+            metric.update_for_iface(iface)
+            self.assertEqual(fields, [ getattr(metric, field) for field
+                                       in metric.FIELDS ])
+        self.assertEqual(self.metrics[2].dly,
+                         rtptlv.ValueClassicMetric.METRIC_UNREACHABLE)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+
+"""Tests for IpBatchRouteWriter, with the ip command faked."""
+
+import os
+import sys
+import errno
+import subprocess
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+import ipv4
+import rtnetlink
+import sysiface
+
+TABLE = 52
+
+# "ip -4 route show table 52" output, with routes of other types and
+# other protocols mixed in.
+ROUTE_SHOW = """\
+default via 192.0.2.1 dev eth0 proto static metric 100
+10.1.0.0/16 via 10.0.0.2 dev eth0 proto 192 metric 1000
+10.1.0.0/16 via 10.0.0.3 dev eth0 proto 192 metric 500
+10.2.0.1 via 10.0.0.2 dev eth0 proto 192 metric 20 onlink
+10.2.1.0/24 via 10.0.0.4 dev eth0 onlink proto 192 metric 30
+10.3.0.0/24 dev eth1 proto kernel scope link src 10.3.0.1
+blackhole 10.4.0.0/16 proto 192 metric 10
+unreachable 10.5.0.0/16 metric 10
+prohibit 10.6.0.0/16
+local 10.0.0.1 dev eth0 proto kernel scope host src 10.0.0.1
+broadcast 10.0.0.255 dev eth0 proto kernel scope link src 10.0.0.1
+"""
+
+
+class FakeSubprocess(object):
+    """Stands in for the subprocess module in sysiface. Records the
+    commands run, and answers them with self.output."""
+
+    PIPE = subprocess.PIPE
+    STDOUT = subprocess.STDOUT
+    CalledProcessError = subprocess.CalledProcessError
+
+    def __init__(self, output="", returncode=0):
+        self.output = output
+        self.returncode = returncode
+        self.commands = list()
+
+    def check_output(self, cmd, stderr=None):
+        self.commands.append(cmd)
+        if self.returncode:
+            raise(subprocess.CalledProcessError(self.returncode, cmd,
+                                                self.output))
+        return self.output
+
+
+class TestIpBatchRouteWriterDump(unittest.TestCase):
+
+    def setUp(self):
+        self.subprocess = FakeSubprocess(ROUTE_SHOW)
+        self._real_subprocess = sysiface.subprocess
+        sysiface.subprocess = self.subprocess
+        self.writer = sysiface.IpBatchRouteWriter("/sbin/ip", TABLE)
+
+    def tearDown(self):
+        sysiface.subprocess = self._real_subprocess
+
+    def test_command(self):
+        self.writer.dump_routes()
+        self.assertEqual(self.subprocess.commands,
+                         [ [ "/sbin/ip", "-4", "route", "show", "table",
+                             str(TABLE) ] ])
+
+    def test_parse(self):
+        routes = self.writer.dump_routes()
+        self.assertEqual(routes, {
+            (0, 0) : (100, ipv4.aton("192.0.2.1")),
+            ipv4.make_prefix("10.1.0.0", 16) : (500, ipv4.aton("10.0.0.3")),
+            ipv4.make_prefix("10.2.0.1", 32) : (20, ipv4.aton("10.0.0.2")),
+            ipv4.make_prefix("10.2.1.0", 24) : (30, ipv4.aton("10.0.0.4")),
+            ipv4.make_prefix("10.3.0.0", 24) : (0, None),
+          })
+        self.assertEqual(self.writer.routes, routes)
+
+    def test_empty(self):
+        self.subprocess.output = ""
+        self.assertEqual(self.writer.dump_routes(), { })
+
+    def test_failure(self):
+        self.subprocess.output = "Error: ipv4: FIB table does not exist.\n"
+        self.subprocess.returncode = 2
+        try:
+            self.writer.dump_routes()
+        except rtnetlink.NetlinkError as e:
+            self.assertEqual(e.errno, errno.EIO)
+        else:
+            self.fail("NetlinkError not raised")
+
+
+class TestIpBatchRouteWriterApply(unittest.TestCase):
+
+    def setUp(self):
+        self.subprocess = FakeSubprocess()
+        self._real_subprocess = sysiface.subprocess
+        sysiface.subprocess = self.subprocess
+        self.writer = sysiface.IpBatchRouteWriter("/sbin/ip", TABLE)
+
+    def tearDown(self):
+        sysiface.subprocess = self._real_subprocess
+
+    def test_out_of_range(self):
+        # Refused without running ip, which FakeSubprocess can't do.
+        net = ipv4.make_prefix("10.1.0.0", 16)
+        errors = self.writer.apply([ net + (1 << 32, ipv4.aton("10.0.0.2")),
+                                     (1 << 32, 16, None, None) ])
+        self.assertEqual(errors, [ errno.EINVAL, errno.EINVAL ])
+        self.assertEqual(self.writer.routes, { })
+
+
+if __name__ == "__main__":
+    unittest.main()
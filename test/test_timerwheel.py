@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""Tests for the TimerWheel, driven by a fake clock."""
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+from twisted.internet import task
+
+import timerwheel
+
+RESOLUTION = timerwheel.TimerWheel.DEFAULT_RESOLUTION
+
+# Delays that land in the first level, the second, and the third. The second
+# level starts at ROOT_SIZE ticks, the third at ROOT_SIZE * LEVEL_SIZE.
+ROOT_DELAY   = 1.5
+LEVEL1_DELAY = 30.
+LEVEL2_DELAY = 400.
+
+
+class TestTimerWheel(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.wheel = timerwheel.TimerWheel(self.clock)
+        self.fired = list()
+
+    def _call_later(self, seconds, name):
+        return self.wheel.call_later(seconds, self._fire, name)
+
+    def _fire(self, name):
+        self.fired.append((name, self.clock.seconds()))
+
+    def _advance_to(self, when):
+        self.clock.advance(when - self.clock.seconds())
+
+    def assertFiresAt(self, name, when):
+        """Check that name fires within a tick after when, and not
+        before."""
+        count = [ n for n, t in self.fired ].count(name)
+        self._advance_to(when - RESOLUTION / 2)
+        self.assertEqual([ n for n, t in self.fired ].count(name), count)
+        self._advance_to(when + RESOLUTION * 1.5)
+        self.assertEqual([ n for n, t in self.fired ].count(name), count + 1)
+
+    def test_levels(self):
+        self.assertTrue(LEVEL1_DELAY / RESOLUTION >=
+                        timerwheel.TimerWheel.ROOT_SIZE)
+        self.assertTrue(LEVEL2_DELAY / RESOLUTION >=
+                        timerwheel.TimerWheel.ROOT_SIZE *
+                        timerwheel.TimerWheel.LEVEL_SIZE)
+
+    def test_fire(self):
+        self._call_later(ROOT_DELAY, "a")
+        self.assertEqual(len(self.wheel), 1)
+        self.assertFiresAt("a", ROOT_DELAY)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cascade(self):
+        for delay, name in [ (LEVEL2_DELAY, "level2"),
+                             (ROOT_DELAY, "root"),
+                             (LEVEL1_DELAY, "level1"),
+                             (LEVEL2_DELAY + LEVEL1_DELAY, "both") ]:
+            self._call_later(delay, name)
+        self.assertFiresAt("root", ROOT_DELAY)
+        self.assertFiresAt("level1", LEVEL1_DELAY)
+        self.assertFiresAt("level2", LEVEL2_DELAY)
+        self.assertFiresAt("both", LEVEL2_DELAY + LEVEL1_DELAY)
+        self.assertEqual([ n for n, t in self.fired ],
+                         [ "root", "level1", "level2", "both" ])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cascade_after_start(self):
+        # Timers added part way through a rotation of the first level are
+        # cascaded at the right time too.
+        self._advance_to(1.23)
+        self._call_later(LEVEL1_DELAY, "a")
+        self._advance_to(17.1)
+        self._call_later(LEVEL2_DELAY, "b")
+        self.assertFiresAt("a", 1.23 + LEVEL1_DELAY)
+        self.assertFiresAt("b", 17.1 + LEVEL2_DELAY)
+
+    def test_cancel(self):
+        a = self._call_later(ROOT_DELAY, "a")
+        b = self._call_later(LEVEL1_DELAY, "b")
+        c = self._call_later(LEVEL2_DELAY, "c")
+        b.cancel()
+        c.cancel()
+        self.assertFalse(b.active())
+        self.assertEqual(len(self.wheel), 1)
+        self._advance_to(LEVEL2_DELAY + 1)
+        self.assertEqual([ n for n, t in self.fired ], [ "a" ])
+        self.assertEqual(len(self.wheel), 0)
+        # Cancelling a timer that has fired does nothing.
+        a.cancel()
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_cancel_only_timer(self):
+        self._call_later(ROOT_DELAY, "a").cancel()
+        self.clock.advance(LEVEL1_DELAY)
+        self.assertEqual(self.fired, [ ])
+
+    def test_reset_later(self):
+        a = self._call_later(ROOT_DELAY, "a")
+        self._advance_to(1)
+        # Pushed back within the first level, then out to the third, as a
+        # holdtime that keeps being refreshed would be.
+        a.reset(ROOT_DELAY)
+        self.assertEqual(len(self.wheel), 1)
+        self._advance_to(2)
+        a.reset(LEVEL2_DELAY)
+        self.assertFiresAt("a", 2 + LEVEL2_DELAY)
+        self.assertEqual(len(self.fired), 1)
+
+    def test_reset_earlier(self):
+        a = self._call_later(LEVEL2_DELAY, "a")
+        self._advance_to(1)
+        a.reset(ROOT_DELAY)
+        self.assertFiresAt("a", 1 + ROOT_DELAY)
+        self._advance_to(LEVEL2_DELAY + 1)
+        self.assertEqual(len(self.fired), 1)
+
+    def test_reset_many(self):
+        timers = [ self._call_later(ROOT_DELAY, n) for n in xrange(50) ]
+        for step in xrange(1, 20):
+            self._advance_to(step)
+            for timer in timers:
+                timer.reset(ROOT_DELAY)
+        self.assertEqual(self.fired, [ ])
+        self._advance_to(19 + ROOT_DELAY + RESOLUTION * 1.5)
+        self.assertEqual(sorted([ n for n, t in self.fired ]), range(50))
+
+    def test_reset_after_fire(self):
+        a = self._call_later(ROOT_DELAY, "a")
+        self._advance_to(ROOT_DELAY + 1)
+        self.assertFalse(a.active())
+        a.reset(LEVEL1_DELAY)
+        self.assertTrue(a.active())
+        self.assertFiresAt("a", ROOT_DELAY + 1 + LEVEL1_DELAY)
+        self.assertEqual(len(self.fired), 2)
+
+    def test_get_time(self):
+        self._advance_to(3)
+        a = self._call_later(LEVEL1_DELAY, "a")
+        self.assertAlmostEqual(a.getTime(), 3 + LEVEL1_DELAY)
+        a.reset(LEVEL2_DELAY)
+        self.assertAlmostEqual(a.getTime(), 3 + LEVEL2_DELAY)
+
+    def test_one_reactor_call(self):
+        for n in xrange(100):
+            self._call_later(ROOT_DELAY * (n + 1), n)
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
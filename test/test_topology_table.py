@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""Randomized tests comparing TopologyTable with a plain dict."""
+
+import os
+import sys
+import random
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                ".."))
+
+# dualfsm and topology import each other. eigrp imports dualfsm first, and
+# the cycle only resolves in that order.
+import dualfsm
+import ipv4
+import topology
+
+SEEDS = xrange(20)
+OPERATIONS = 500
+
+
+def random_prefix(rand):
+    """Return a random prefix from a small part of the address space, so
+    prefixes often nest and share branches."""
+    addr = 0x0a000000 | rand.choice([ 0, 0x10000, 0x800000 ]) | \
+           rand.getrandbits(10) << rand.choice([ 0, 6, 12 ])
+    if rand.random() < .05:
+        addr = rand.getrandbits(32)
+    plen = rand.choice([ 0, 1, 8, 9, 16, 20, 23, 24, 25, 31, 32,
+                         rand.randint(0, 32) ])
+    return addr & ipv4.MASKS[plen], plen
+
+
+def covers(prefix, addr, plen):
+    return prefix[1] <= plen and addr & ipv4.MASKS[prefix[1]] == prefix[0]
+
+
+class TestTopologyTableEquivalence(unittest.TestCase):
+
+    def _check(self, table, reference, rand):
+        self.assertEqual(len(table), len(reference))
+        self.assertEqual(table.items(), sorted(reference.items()))
+
+        probes = [ random_prefix(rand) for i in xrange(10) ]
+        probes.extend(rand.sample(reference.keys(), min(5, len(reference))))
+        for prefix in probes:
+            addr, plen = prefix
+            self.assertEqual(prefix in table, prefix in reference)
+            self.assertIs(table.get(prefix), reference.get(prefix))
+
+            covering = sorted([ item for item in reference.iteritems()
+                                if covers(item[0], addr, plen) ],
+                              key=lambda item: item[0][1])
+            self.assertEqual(list(table.iter_covering(prefix)), covering)
+            self.assertEqual(table.longest_match(addr, plen),
+                             covering[-1] if covering else None)
+            self.assertEqual(table.longest_match(addr) is None,
+                             not any([ covers(p, addr, ipv4.MAX_PLEN)
+                                       for p in reference ]))
+
+            subtree = sorted([ item for item in reference.iteritems()
+                               if covers(prefix, *item[0]) ])
+            self.assertEqual(list(table.iter_subtree(prefix)), subtree)
+
+            after = sorted([ item for item in reference.iteritems()
+                             if item[0] >= prefix ])
+            self.assertEqual(list(table.iteritems(start=prefix)), after)
+
+    def _run(self, seed):
+        rand = random.Random(seed)
+        table = topology.TopologyTable()
+        reference = dict()
+        for i in xrange(OPERATIONS):
+            prefix = random_prefix(rand)
+            if reference and rand.random() < .4:
+                # Mostly delete prefixes that are there.
+                if rand.random() < .8:
+                    prefix = rand.choice(reference.keys())
+                if prefix in reference:
+                    if rand.random() < .5:
+                        del table[prefix]
+                    else:
+                        self.assertIs(table.pop(prefix), reference[prefix])
+                    del reference[prefix]
+                else:
+                    self.assertRaises(KeyError, table.__delitem__, prefix)
+                    self.assertEqual(table.pop(prefix, None), None)
+            elif rand.random() < .2:
+                t_entry = table.update_prefix(prefix)
+                reference.setdefault(prefix, t_entry)
+                self.assertIs(t_entry, reference[prefix])
+            else:
+                t_entry = topology.TopologyEntry(prefix, None)
+                table[prefix] = t_entry
+                reference[prefix] = t_entry
+            if i % 25 == 0:
+                self._check(table, reference, rand)
+        self._check(table, reference, rand)
+
+        # Empty the table in random order.
+        prefixes = reference.keys()
+        rand.shuffle(prefixes)
+        for prefix in prefixes:
+            del table[prefix]
+            del reference[prefix]
+            if len(reference) % 20 == 0:
+                self._check(table, reference, rand)
+        self.assertEqual(len(table), 0)
+        self.assertEqual(table.items(), [ ])
+
+    def test_equivalence(self):
+        for seed in SEEDS:
+            self._run(seed)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+#!/usr/bin/env python
+
+"""A hierarchical timing wheel for Twisted.
+
+RTP keeps a holdtime timer for every neighbor that is reset on every hello,
+and a retransmit timer for every neighbor with packets in flight. Scheduling
+each of those with reactor.callLater means every reset and cancel goes
+through the reactor's heap. TimerWheel keeps those timers in hashed slots
+instead, so adding, resetting and cancelling a timer are all O(1), and the
+reactor only sees a single call that wakes the wheel up when the next slot
+is due.
+
+Usage is similar to reactor.callLater:
+
+    timers = TimerWheel(reactor)
+    t = timers.call_later(15, drop_neighbor, neighbor)
+    t.reset(15)
+    t.cancel()
+
+The layout is the one used by the classic Linux kernel timer code: the
+first level has one slot per tick, and each higher level has slots that
+each cover a full rotation of the level below it. When the first level
+wraps, the next slot of the level above is "cascaded" down into the
+lower levels.
+"""
+
+# Python-EIGRP (http://python-eigrp.googlecode.com)
+# Copyright (C) 2013 Patrick F. Allen
+#
+# This program is free software; you can redistribute it and/or
+# modify it under the terms of the GNU General Public License
+# as published by the Free Software Foundation; either version 2
+# of the License, or (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
+
+import math
+
+from twisted.python import log
+
+class TimerWheel(object):
+    """A hierarchical timing wheel driven by a single reactor call."""
+
+    DEFAULT_RESOLUTION = .01
+
+    # Bits of the tick counter that index the first level, and each level
+    # after it. 8 + 4 * 6 = 32 bits, so timers up to 2**32 ticks out can be
+    # held without clamping.
+    ROOT_BITS  = 8
+    LEVEL_BITS = 6
+    LEVELS     = 5
+
+    ROOT_SIZE  = 1 << ROOT_BITS
+    ROOT_MASK  = ROOT_SIZE - 1
+    LEVEL_SIZE = 1 << LEVEL_BITS
+    LEVEL_MASK = LEVEL_SIZE - 1
+    MAX_TICKS  = (1 << (ROOT_BITS + (LEVELS - 1) * LEVEL_BITS)) - 1
+
+    def __init__(self, clock, resolution=DEFAULT_RESOLUTION):
+        """clock - An object providing seconds() and callLater(), usually the
+                   reactor
+        resolution - The length of a tick in seconds. Timers will fire up to
+                     one tick late."""
+        if resolution <= 0:
+            raise ValueError("resolution must be positive.")
+        self._clock = clock
+        self._resolution = float(resolution)
+        self._start = clock.seconds()
+
+        self._levels = [[set() for i in xrange(self.ROOT_SIZE)]]
+        for level in xrange(1, self.LEVELS):
+            self._levels.append([set() for i in xrange(self.LEVEL_SIZE)])
+
+        # The next tick to process. Every timer that expires before this
+        # tick has already fired.
+        self._current = 0
+        self._count = 0
+
+        # The reactor call that will run the wheel next, and the tick it is
+        # scheduled for.
+        self._tick_event = None
+        self._wakeup_tick = None
+
+    def __len__(self):
+        """Return the number of pending timers."""
+        return self._count
+
+    def call_later(self, seconds, func, *args, **kwargs):
+        """Call func(*args, **kwargs) after the given number of seconds.
+        Returns a WheelTimer that can be used to reset or cancel the call."""
+        timer = WheelTimer(self, func, args, kwargs)
+        self._schedule(timer, seconds)
+        return timer
+
+    def seconds(self):
+        return self._clock.seconds()
+
+    def run_until_current(self):
+        """Fire all timers that are due. This is called by the wheel's own
+        reactor call, but can also be called directly."""
+        # If the reactor woke us a hair early, still run the tick we were
+        # scheduled for rather than rescheduling for the same tick again.
+        now = max(self._now_ticks(), self._wakeup_tick)
+        self._tick_event = None
+        self._wakeup_tick = None
+        if not self._count:
+            # Nothing to cascade or fire, so skip straight to now.
+            self._current = max(self._current, now + 1)
+            return
+        while self._current <= now:
+            index = self._current & self.ROOT_MASK
+            if not index:
+                self._cascade_all()
+            self._current += 1
+            slot = self._levels[0][index]
+            if not slot:
+                continue
+            self._levels[0][index] = set()
+            due = list()
+            for timer in slot:
+                self._count -= 1
+                if timer.expires >= self._current:
+                    # Reset to a later time since it was put in this slot.
+                    self._add(timer)
+                else:
+                    timer._slot = None
+                    due.append(timer)
+            for timer in due:
+                try:
+                    timer._fire()
+                except:
+                    log.err()
+        self._schedule_tick()
+
+    def _now_ticks(self):
+        return int((self._clock.seconds() - self._start) / self._resolution)
+
+    def _ticks_for(self, seconds):
+        return max(int(math.ceil(seconds / self._resolution)), 1)
+
+    def _schedule(self, timer, seconds):
+        expires = self._now_ticks() + self._ticks_for(seconds)
+        if timer._slot is not None:
+            if expires >= timer.expires:
+                # Pushing a pending timer back, as a holdtime reset does,
+                # only records the new expiry. The timer is moved when the
+                # slot it is in comes up (see run_until_current).
+                timer.expires = expires
+                return
+            self._remove(timer)
+        timer.expires = expires
+        self._add(timer)
+        # Most timers (holdtimes being reset, in particular) expire after
+        # the wheel's next wakeup. Finding the next tick means scanning the
+        # first level, so only do it when the wakeup has to move earlier.
+        if self._tick_event is None or timer.expires < self._wakeup_tick:
+            self._schedule_tick()
+
+    def _add(self, timer):
+        expires = timer.expires
+        delta = expires - self._current
+        if delta < 0:
+            # Already due. Fire on the next tick that is processed.
+            slot = self._levels[0][self._current & self.ROOT_MASK]
+        elif delta < self.ROOT_SIZE:
+            slot = self._levels[0][expires & self.ROOT_MASK]
+        else:
+            if delta > self.MAX_TICKS:
+                expires = self._current + self.MAX_TICKS
+            shift = self.ROOT_BITS
+            for level in xrange(1, self.LEVELS):
+                if delta < 1 << (shift + self.LEVEL_BITS) or \
+                   level == self.LEVELS - 1:
+                    break
+                shift += self.LEVEL_BITS
+            slot = self._levels[level][(expires >> shift) & self.LEVEL_MASK]
+        slot.add(timer)
+        timer._slot = slot
+        self._count += 1
+
+    def _remove(self, timer):
+        timer._slot.discard(timer)
+        timer._slot = None
+        self._count -= 1
+
+    def _cascade_all(self):
+        """Move the timers from the next slot of each higher level down to
+        the lower levels. Called when the first level wraps around. A level
+        is only cascaded when the level below it has wrapped too."""
+        shift = self.ROOT_BITS
+        for level in xrange(1, self.LEVELS):
+            index = (self._current >> shift) & self.LEVEL_MASK
+            slot = self._levels[level][index]
+            self._levels[level][index] = set()
+            for timer in slot:
+                self._count -= 1
+                self._add(timer)
+            if index:
+                break
+            shift += self.LEVEL_BITS
+
+    def _next_tick(self):
+        """Return the tick that the wheel next needs to run at. That is the
+        next non-empty slot in the first level, or the tick at which the
+        first level wraps and the next higher slot must be cascaded."""
+        boundary = (self._current + self.ROOT_MASK) & ~self.ROOT_MASK
+        tick = self._current
+        root = self._levels[0]
+        while tick < boundary:
+            if root[tick & self.ROOT_MASK]:
+                return tick
+            tick += 1
+        return boundary
+
+    def _schedule_tick(self):
+        """Make sure the reactor will call us in time for the earliest
+        timer."""
+        if not self._count:
+            return
+        tick = self._next_tick()
+        if self._tick_event is not None:
+            if self._wakeup_tick <= tick:
+                return
+            self._tick_event.cancel()
+        self._wakeup_tick = tick
+        delay = self._start + tick * self._resolution - self._clock.seconds()
+        self._tick_event = self._clock.callLater(max(delay, 0),
+                                                 self.run_until_current)
+
+
+class WheelTimer(object):
+    """A timer scheduled in a TimerWheel. Provides the active, cancel, reset
+    and getTime methods of Twisted's DelayedCall so it can be used in its
+    place."""
+
+    def __init__(self, wheel, func, args, kwargs):
+        self._wheel = wheel
+        self._slot = None
+        self.expires = None
+        self.func = func
+        self.args = args
+        self.kw = kwargs
+
+    def active(self):
+        return self._slot is not None
+
+    def cancel(self):
+        """Cancel the timer. Does nothing if it already fired or was
+        cancelled."""
+        if self._slot is not None:
+            self._wheel._remove(self)
+
+    def reset(self, seconds):
+        """Reschedule the timer to fire the given number of seconds from now.
+        This also rearms a timer that already fired or was cancelled."""
+        self._wheel._schedule(self, seconds)
+
+    def getTime(self):
+        return self._wheel._start + self.expires * self._wheel._resolution
+
+    def _fire(self):
+        self.func(*self.args, **self.kw)
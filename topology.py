@@ -15,14 +15,382 @@
 # along with this program; if not, write to the Free Software
 # Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301, USA.
 
-import copy
+import array
+import heapq
+import itertools
 
 import dualfsm
+import ipv4
+import rtptlv
+
+# Orders heap items for the same distance, and tells current heap items
+# from stale ones. See TopologyEntry._push.
+_rank_counter = itertools.count()
+
+class TopologyTable(object):
+    """The topology table. Maps ipv4 prefix keys ((address, prefix length)
+    tuples, see the ipv4 module) to TopologyEntry objects.
+
+    Supports the usual dict operations, but is backed by a path-compressed
+    binary trie over the prefix bits, so in addition to exact lookups it
+    can find the longest prefix covering an address and walk all of the
+    more-specific prefixes under a prefix without scanning the whole table.
+    Insert, delete and lookup are O(prefix length). Iteration is always in
+    prefix order, which is the same as sorting the keys:
+
+        table = TopologyTable(get_kvalues)
+        t_entry = table.update_prefix(ipv4.make_prefix("10.1.0.0", 16))
+        table.longest_match(ipv4.aton("10.1.2.3"))
+        for prefix, t_entry in table.iter_subtree((ipv4.aton("10.0.0.0"), 8)):
+            ...
+
+    The table also indexes its entries by the neighbors that reported
+    them and by those neighbors' interfaces (see neighbor_entries and
+    iface_entries), so losing a neighbor or a link only touches the
+    affected entries.
+    """
+
+    def __init__(self, get_kvalues=None):
+        """get_kvalues - a function to retrieve the current K-values. Used
+        for entries created by update_prefix."""
+        self._root = None
+        self._len = 0
+        self._get_kvalues = get_kvalues
+
+        # Reverse indexes, maintained by the entries themselves as neighbors
+        # are added and removed. Maps each neighbor to a dict of
+        # {prefix: TopologyEntry} for the prefixes it has reported, and each
+        # interface to the set of those neighbors seen on it.
+        self._neighbor_index = dict()
+        self._iface_index = dict()
+
+    def update_prefix(self, prefix):
+        """Return the TopologyEntry for prefix, adding a new one with no
+        neighbors first if the prefix isn't in the table yet."""
+        node = self._find(prefix)
+        if node and node.entry is not None:
+            return node.entry
+        t_entry = TopologyEntry(prefix, self._get_kvalues)
+        self[prefix] = t_entry
+        return t_entry
+
+    def __len__(self):
+        return self._len
+
+    def __contains__(self, prefix):
+        node = self._find(prefix)
+        return node is not None and node.entry is not None
+
+    def __getitem__(self, prefix):
+        node = self._find(prefix)
+        if node is None or node.entry is None:
+            raise KeyError(prefix)
+        return node.entry
+
+    def get(self, prefix, default=None):
+        node = self._find(prefix)
+        if node is None or node.entry is None:
+            return default
+        return node.entry
+
+    def __setitem__(self, prefix, t_entry):
+        addr, plen = prefix
+        if not 0 <= plen <= ipv4.MAX_PLEN:
+            raise ValueError("Plen must be between 0 and 32.")
+        if addr & ~ipv4.MASKS[plen]:
+            raise ValueError("Host bits are set in prefix "
+                             "{}.".format(ipv4.prefix_str(prefix)))
+        if t_entry is None:
+            raise ValueError("Entries cannot be None.")
+        if t_entry._table is not None and \
+           (t_entry._table is not self or t_entry._table_prefix != prefix):
+            raise ValueError("Entry is already in a topology table.")
+        old = self._insert(addr, plen, t_entry)
+        if old is t_entry:
+            return
+        if old is not None:
+            old._detach()
+        t_entry._attach(self, prefix)
+
+    def _insert(self, addr, plen, t_entry):
+        """Store t_entry at addr/plen in the trie. Returns the entry it
+        replaced, or None."""
+        parent = None
+        node = self._root
+        while node:
+            common = self._common_len(addr, plen, node.addr, node.plen)
+            if common < node.plen:
+                # The new prefix branches off above node, so node's link
+                # from its parent needs to go through a new node.
+                if common == plen:
+                    new = _TrieNode(addr, plen, t_entry)
+                    new.set_child(node, self._bit(node.addr, plen))
+                else:
+                    new = _TrieNode(addr & ipv4.MASKS[common], common)
+                    leaf = _TrieNode(addr, plen, t_entry)
+                    new.set_child(node, self._bit(node.addr, common))
+                    new.set_child(leaf, self._bit(addr, common))
+                self._replace_child(parent, node, new)
+                self._len += 1
+                return None
+            if plen == node.plen:
+                old = node.entry
+                if old is None:
+                    self._len += 1
+                node.entry = t_entry
+                return old
+            parent = node
+            node = node.child(self._bit(addr, node.plen))
+        leaf = _TrieNode(addr, plen, t_entry)
+        if parent:
+            parent.set_child(leaf, self._bit(addr, parent.plen))
+        else:
+            self._root = leaf
+        self._len += 1
+        return None
+
+    def __delitem__(self, prefix):
+        addr, plen = prefix
+        grandparent = None
+        parent = None
+        node = self._root
+        while node and node.plen < plen:
+            if addr & ipv4.MASKS[node.plen] != node.addr:
+                raise KeyError(prefix)
+            grandparent = parent
+            parent = node
+            node = node.child(self._bit(addr, node.plen))
+        if node is None or node.plen != plen or node.addr != addr or \
+           node.entry is None:
+            raise KeyError(prefix)
+        node.entry._detach()
+        node.entry = None
+        self._len -= 1
+
+        # Remove nodes that no longer hold an entry or join two branches.
+        if node.left and node.right:
+            return
+        self._replace_child(parent, node, node.left or node.right)
+        if parent and parent.entry is None and \
+           not (parent.left and parent.right):
+            self._replace_child(grandparent, parent,
+                                parent.left or parent.right)
+
+    def pop(self, prefix, *default):
+        try:
+            t_entry = self[prefix]
+        except KeyError:
+            if default:
+                return default[0]
+            raise
+        del self[prefix]
+        return t_entry
+
+    def __iter__(self):
+        return self.iterkeys()
+
+    def iterkeys(self, start=None):
+        for prefix, t_entry in self.iteritems(start):
+            yield prefix
+
+    def itervalues(self, start=None):
+        for prefix, t_entry in self.iteritems(start):
+            yield t_entry
+
+    def iteritems(self, start=None):
+        """Yield (prefix, TopologyEntry) tuples in prefix order. If start is
+        given, begin at the first prefix that is not less than start, so
+        the next N entries after a prefix can be read without walking the
+        ones before it."""
+        if start is None:
+            return self._walk(self._root)
+        return self._walk_from(start)
+
+    def keys(self):
+        return list(self.iterkeys())
+
+    def values(self):
+        return list(self.itervalues())
+
+    def items(self):
+        return list(self.iteritems())
+
+    def longest_match(self, addr, plen=ipv4.MAX_PLEN):
+        """Return (prefix, TopologyEntry) for the most specific prefix in the
+        table that covers addr/plen, or None if there isn't one."""
+        best = None
+        node = self._root
+        while node and node.plen <= plen and \
+              addr & ipv4.MASKS[node.plen] == node.addr:
+            if node.entry is not None:
+                best = node
+            if node.plen == plen:
+                break
+            node = node.child(self._bit(addr, node.plen))
+        if best is None:
+            return None
+        return (best.addr, best.plen), best.entry
+
+    def iter_covering(self, prefix):
+        """Yield (prefix, TopologyEntry) for every prefix in the table that
+        covers the given prefix, including the prefix itself, least specific
+        first."""
+        addr, plen = prefix
+        node = self._root
+        while node and node.plen <= plen and \
+              addr & ipv4.MASKS[node.plen] == node.addr:
+            if node.entry is not None:
+                yield (node.addr, node.plen), node.entry
+            if node.plen == plen:
+                break
+            node = node.child(self._bit(addr, node.plen))
+
+    def iter_subtree(self, prefix):
+        """Yield (prefix, TopologyEntry) in prefix order for the given
+        prefix, if present, and every more specific prefix under it."""
+        addr, plen = prefix
+        node = self._root
+        while node:
+            if node.plen >= plen:
+                if node.addr & ipv4.MASKS[plen] == addr:
+                    for item in self._walk(node):
+                        yield item
+                return
+            if addr & ipv4.MASKS[node.plen] != node.addr:
+                return
+            node = node.child(self._bit(addr, node.plen))
+
+    def neighbors(self):
+        """Return a list of the neighbors that have reported at least one
+        prefix in the table."""
+        return self._neighbor_index.keys()
+
+    def neighbor_entries(self, neighbor):
+        """Return a list of (prefix, TopologyEntry) for the prefixes that
+        neighbor has reported. The list is a copy, so entries can be changed
+        or removed while walking it."""
+        return self._neighbor_index.get(neighbor, {}).items()
+
+    def iface_entries(self, iface):
+        """Return a list of (prefix, TopologyEntry) for the prefixes
+        reported by any neighbor on iface, each listed once."""
+        entries = dict()
+        for neighbor in self._iface_index.get(iface, ()):
+            entries.update(self._neighbor_index[neighbor])
+        return entries.items()
+
+    def _index_neighbor(self, prefix, t_entry, neighbor):
+        try:
+            self._neighbor_index[neighbor][prefix] = t_entry
+        except KeyError:
+            self._neighbor_index[neighbor] = {prefix: t_entry}
+            self._iface_index.setdefault(neighbor.iface, set()).add(neighbor)
+
+    def _unindex_neighbor(self, prefix, neighbor):
+        entries = self._neighbor_index[neighbor]
+        del entries[prefix]
+        if entries:
+            return
+        del self._neighbor_index[neighbor]
+        neighbors = self._iface_index[neighbor.iface]
+        neighbors.discard(neighbor)
+        if not neighbors:
+            del self._iface_index[neighbor.iface]
+
+    def _find(self, prefix):
+        """Return the node for exactly this prefix, which may not hold an
+        entry, or None."""
+        addr, plen = prefix
+        node = self._root
+        while node and node.plen < plen:
+            if addr & ipv4.MASKS[node.plen] != node.addr:
+                return None
+            node = node.child(self._bit(addr, node.plen))
+        if node and node.plen == plen and node.addr == addr:
+            return node
+        return None
+
+    def _replace_child(self, parent, old, new):
+        if parent is None:
+            self._root = new
+        elif parent.left is old:
+            parent.left = new
+        else:
+            parent.right = new
+
+    @staticmethod
+    def _walk(node):
+        stack = [node] if node else []
+        while stack:
+            node = stack.pop()
+            if node.entry is not None:
+                yield (node.addr, node.plen), node.entry
+            if node.right:
+                stack.append(node.right)
+            if node.left:
+                stack.append(node.left)
+
+    def _walk_from(self, start):
+        # Same as _walk, but skip subtrees that only hold prefixes before
+        # start. The last prefix in prefix order under a node is its
+        # highest address with a /32.
+        stack = [self._root] if self._root else []
+        while stack:
+            node = stack.pop()
+            last = (node.addr | (~ipv4.MASKS[node.plen] & 0xffffffff),
+                    ipv4.MAX_PLEN)
+            if last < start:
+                continue
+            prefix = node.addr, node.plen
+            if node.entry is not None and prefix >= start:
+                yield prefix, node.entry
+            if node.right:
+                stack.append(node.right)
+            if node.left:
+                stack.append(node.left)
+
+    @staticmethod
+    def _bit(addr, index):
+        """Return the bit of addr after the first index bits."""
+        return (addr >> (ipv4.MAX_PLEN - 1 - index)) & 1
+
+    @staticmethod
+    def _common_len(addr1, plen1, addr2, plen2):
+        """Return the length of the common leading bits of two prefixes."""
+        shortest = min(plen1, plen2)
+        diff = addr1 ^ addr2
+        if not diff:
+            return shortest
+        return min(ipv4.MAX_PLEN - diff.bit_length(), shortest)
+
+
+class _TrieNode(object):
+    """A node in a TopologyTable's trie. Nodes with an entry of None only
+    join two branches."""
+
+    __slots__ = ("addr", "plen", "entry", "left", "right")
+
+    def __init__(self, addr, plen, entry=None):
+        self.addr  = addr
+        self.plen  = plen
+        self.entry = entry
+        self.left  = None
+        self.right = None
+
+    def child(self, bit):
+        return self.right if bit else self.left
+
+    def set_child(self, node, bit):
+        if bit:
+            self.right = node
+        else:
+            self.left = node
+
 
 class TopologyEntry(object):
-    """A topology entry contains the FSM object used for a given prefix,
-    plus all neighbors that have advertised this prefix. The prefix
-    itself is expected to be stored as the key in the dictionary for which
+    """A topology entry contains the DUAL state of a given prefix, plus
+    all neighbors that have advertised this prefix. The prefix
+    itself is expected to be stored as the key in the TopologyTable for which
     this object is a value. Example usage:
     - For initialization example, see TopologyTable.update_prefix
 
@@ -36,11 +404,23 @@ class TopologyEntry(object):
         print(neighbor_info.neighbor)
         print(neighbor_info.reported_distance)
         print(neighbor_info.reply_flag)
+
+    Each entry keeps its neighbors in a heap ordered by full distance, and
+    its feasible successors in both a set and a second heap, so the best
+    neighbor and the best feasible successor can be found in O(log n). Both
+    heaps are updated as neighbors are added, removed or updated through
+    update_neighbor. Old heap items are skipped when they reach the top
+    rather than being searched for and removed.
     """
 
     NO_SUCCESSOR   = 1
     SELF_SUCCESSOR = 2  # Local router is the successor
 
+    __slots__ = ("prefix", "state", "neighbors", "_successor",
+                 "feasible_successors", "_get_kvalues", "feasible_distance",
+                 "_table", "_table_prefix", "_heap", "_fs_heap",
+                 "_heap_generation")
+
     def __init__(self, prefix, get_kvalues):
         """prefix - this network's network address and mask. This is
         just for informational/debugging purposes; it not used to identify the
@@ -48,35 +428,99 @@ class TopologyEntry(object):
         The prefix assigned to the ToplogyEntry is identified by the key used
         in the TopologyTable to access this entry."""
         self.prefix               = prefix
-        self.fsm                  = dualfsm.DualFsm(get_kvalues)
+        self.state                = dualfsm.PASSIVE
         self.neighbors            = dict()
-        self.successor            = self.NO_SUCCESSOR
-        self._feasible_successors = list()
+        self.feasible_successors  = set()
         self._get_kvalues         = get_kvalues
         self.feasible_distance    = None
+        self._heap                = list()
+        self._fs_heap             = list()
+        self._heap_generation     = rtptlv.ValueClassicMetric.kvalue_generation
+        self.successor            = self.NO_SUCCESSOR
+
+        # The TopologyTable holding this entry and the prefix it is stored
+        # under, so the table's neighbor and interface indexes can be kept
+        # up to date.
+        self._table               = None
+        self._table_prefix        = None
+
+    @property
+    def fsm(self):
+        """The DUAL FSM. Shared by all entries, see dualfsm.DUAL_FSM."""
+        return dualfsm.DUAL_FSM
+
+    @property
+    def successor(self):
+        return self._successor
+
+    @successor.setter
+    def successor(self, neighbor_info):
+        """Set the successor, a TopologyNeighborInfo or one of NO_SUCCESSOR
+        and SELF_SUCCESSOR. Switching to one of the feasible successors
+        leaves the feasible distance as it is. Any other successor sets the
+        feasible distance to its full distance."""
+        old = getattr(self, "_successor", self.NO_SUCCESSOR)
+        self._successor = neighbor_info
+        if neighbor_info == self.NO_SUCCESSOR or \
+           neighbor_info == self.SELF_SUCCESSOR:
+            self.feasible_distance = None
+            self.feasible_successors.clear()
+            self._fs_heap = list()
+        elif neighbor_info in self.feasible_successors:
+            self.feasible_successors.discard(neighbor_info)
+            # The old successor may be feasible itself.
+            if isinstance(old, TopologyNeighborInfo) and \
+               self.neighbors.get(old.neighbor) is old:
+                self._update_feasibility(old)
+        else:
+            self.compute_feasible_successors()
 
     def add_neighbor(self, neighbor_info):
         """Add a neighbor to the topology entry.
         neighbor_info - a TopologyNeighborInfo instance"""
-        if neighbor_info.neighbor in self.neighbors:
+        neighbor = neighbor_info.neighbor
+        if neighbor in self.neighbors:
             raise(ValueError("Neighbor already exists."))
-        self.neighbors[neighbor_info.neighbor] = neighbor_info
+        self.neighbors[neighbor] = neighbor_info
+        if self._table is not None:
+            self._table._index_neighbor(self._table_prefix, self, neighbor)
+        self._push(neighbor_info)
+        self._update_feasibility(neighbor_info)
+
+    def remove_neighbor(self, neighbor):
+        """Remove a neighbor from the topology entry and return its
+        TopologyNeighborInfo. Raises KeyError if the neighbor isn't known."""
+        neighbor_info = self.neighbors.pop(neighbor)
+        if self._table is not None:
+            self._table._unindex_neighbor(self._table_prefix, neighbor)
+        # Its heap items are now stale and will be skipped.
+        neighbor_info._rank = None
+        self.feasible_successors.discard(neighbor_info)
+        return neighbor_info
 
     def get_neighbor(self, neighbor):
         """Get the TopologyNeighborInfo entry for this prefix given an
         RTPNeighbor instance."""
         return self.neighbors[neighbor]
 
-    def update_neighbor(self, neighbor, reported_distance):
-        """Update neighbor's reported distance and add/remove to/from
-        list of feasible successors if necessary."""
-        if not self.feasible_distance:
+    def update_neighbor(self, neighbor_info, reported_distance=None):
+        """Record a change in a neighbor's distance, and add it to or remove
+        it from the feasible successors if necessary.
+        neighbor_info - the neighbor's TopologyNeighborInfo
+        reported_distance - the metric the neighbor now reports. If None,
+                            the neighbor info has already been changed, for
+                            example by update_full_distance after an
+                            interface change."""
+        if reported_distance is not None:
+            neighbor_info.reported_distance = reported_distance
+        self._push(neighbor_info)
+        if neighbor_info is self._successor:
+            # The feasible distance is the lowest distance seen through the
+            # successor.
+            if neighbor_info.full_metric() < self.feasible_distance:
+                self.compute_feasible_successors()
             return
-        if reported_distance <= self.feasible_distance:
-            self.feasible_successors.append(neighbor)
-        elif reported_distance > self.feasible_distance:
-            if neighbor in self.feasible_successors:
-                self.feasible_successors.remove(neighbor)
+        self._update_feasibility(neighbor_info)
 
     def all_replies_received(self):
         """Checks if replies from all fully-formed neighbors have been
@@ -107,48 +551,139 @@ class TopologyEntry(object):
         return True
 
     def compute_feasible_successors(self):
-        """Compute a list of all possible feasible successors based on the
-        current successor."""
-        self.feasible_successors = list()
-        if self.successor == self.SELF_SUCCESSOR:
+        """Set the feasible distance to the current successor's full
+        distance, and find the feasible successors again from scratch."""
+        self.feasible_successors = set()
+        self._fs_heap = list()
+        if self._successor == self.SELF_SUCCESSOR or \
+           self._successor == self.NO_SUCCESSOR:
             # XXX ?
+            self.feasible_distance = None
             return
-        self.feasible_distance = self.successor.full_distance.compute_metric(*self._get_kvalues())
-        for n_entry in self.neighbors:
-            if n_entry.metric.compute_metric(*self._get_kvalues()) < \
-               feasible_distance:
-                feasible_successors.append(n_entry)
+        self.feasible_distance = self._successor.full_metric()
+        for n_info in self.neighbors.itervalues():
+            self._update_feasibility(n_info)
 
     def get_feasible_successor(self):
-        """Return the best feasible successor for this route if any exist,
-        otherwise return None."""
-        # XXX Need a better function name; this is used when no FSes currently
-        # exist. See draft 4, page 15 for possible nomenclature.
-        # "recalculate_successor()"? calculate_new_successor()?
-        # XXX Or - this could be used to hide the complexity of only
-        # performing recalculations when no FSes exist. This function
-        # can figure out if there is an FS, if so return that. If not,
-        # choose a new successor by performing a full recalculation.
-        if not self.neighbors:
-            return None
-        min(self.neighbors, key=self._get_min_metric)
+        """Return the TopologyNeighborInfo of the feasible successor with the
+        lowest full distance, or None if there are no feasible successors."""
+        self._check_generation()
+        return self._heap_top(self._fs_heap, self.feasible_successors)
+
+    def get_best_neighbor(self):
+        """Return the TopologyNeighborInfo of the neighbor with the lowest
+        full distance, whether it is feasible or not, or None if there are
+        no neighbors."""
+        self._check_generation()
+        return self._heap_top(self._heap, None)
+
+    def _update_feasibility(self, n_info):
+        """Add n_info to or remove it from the feasible successors, based on
+        the feasibility condition: its reported distance must be less than
+        the feasible distance."""
+        if self.feasible_distance is not None and \
+           n_info is not self._successor and \
+           n_info.reported_metric() < self.feasible_distance:
+            self.feasible_successors.add(n_info)
+            heapq.heappush(self._fs_heap, (n_info.full_metric(), n_info._rank,
+                                           n_info))
+            if len(self._fs_heap) > 2 * len(self.feasible_successors) + 8:
+                self._fs_heap = [ (n.full_metric(), n._rank, n)
+                                  for n in self.feasible_successors ]
+                heapq.heapify(self._fs_heap)
+        else:
+            self.feasible_successors.discard(n_info)
 
-    def _get_min_metric(self, n_entry):
-        return n_entry.full_distance.compute_metric()
+    def _push(self, n_info):
+        """Add n_info to the neighbor heap with its current full distance.
+        Any older item for it becomes stale."""
+        self._check_generation()
+        n_info._rank = next(_rank_counter)
+        heapq.heappush(self._heap, (n_info.full_metric(), n_info._rank,
+                                    n_info))
+        # Don't let stale items pile up.
+        if len(self._heap) > 2 * len(self.neighbors) + 8:
+            self._heap = [ (n.full_metric(), n._rank, n)
+                           for n in self.neighbors.itervalues() ]
+            heapq.heapify(self._heap)
+
+    @staticmethod
+    def _heap_top(heap, members):
+        """Return the neighbor info at the top of heap after dropping stale
+        items, or None if heap is empty. If members is given, items for
+        neighbors that aren't in it are stale as well."""
+        while heap:
+            metric, rank, n_info = heap[0]
+            if n_info._rank == rank and (members is None or n_info in members):
+                return n_info
+            heapq.heappop(heap)
+        return None
+
+    def _check_generation(self):
+        """After the K-values change every composite metric may have too,
+        so the feasible distance and heaps have to be rebuilt."""
+        generation = rtptlv.ValueClassicMetric.kvalue_generation
+        if self._heap_generation == generation:
+            return
+        self._heap_generation = generation
+        self._heap = list()
+        for n_info in self.neighbors.itervalues():
+            self._push(n_info)
+        self.compute_feasible_successors()
+
+    def _attach(self, table, prefix):
+        """Called by a TopologyTable when this entry is stored in it."""
+        self._table = table
+        self._table_prefix = prefix
+        for neighbor in self.neighbors:
+            table._index_neighbor(prefix, self, neighbor)
+
+    def _detach(self):
+        """Called by the TopologyTable when this entry is removed from it."""
+        for neighbor in self.neighbors:
+            self._table._unindex_neighbor(self._table_prefix, neighbor)
+        self._table = None
+        self._table_prefix = None
 
 
 class TopologyNeighborInfo(object):
-    def __init__(self, neighbor, reported_distance, get_kvalues):
+    """What one neighbor has told us about one prefix.
+
+    There is one of these for every neighbor of every prefix, so they are
+    kept small. Rather than holding two metric objects, the fields of the
+    reported and full distances are stored together in one array of
+    integers. reported_distance and full_distance still return metric
+    objects, but each access builds a new one, so changing the returned
+    metric has no effect here. Assign reported_distance, or call
+    set_reported_fields, to change it. Composite metrics are computed from
+    the stored fields, without building metric objects."""
+
+    __slots__ = ("neighbor", "nexthop", "_get_kvalues", "waiting_for_reply",
+                 "_metric_class", "_metrics", "_reported_metric",
+                 "_full_metric", "_metric_generation", "_rank")
+
+    def __init__(self, neighbor, reported_distance, get_kvalues,
+                 nexthop=None):
         """neighbor - an RTPNeighbor instance or None for the local router
         reported_distance - the metric advertised by the neighbor
               (composite metric class such as rtptlv.ValueClassicMetric, not
-              an integer)
-        get_kvalues - a function to retrieve the current K-values"""
+              an integer). If None, set_reported_fields must be called
+              before the neighbor info is used.
+        get_kvalues - a function to retrieve the current K-values
+        nexthop - the nexthop to install routes through, as an integer.
+              This is the neighbor's address unless it advertised another
+              one. None for the local router."""
         # Note that the interface on which a neighbor was observed is stored
         # within the RTPNeighbor instance.
         self.neighbor          = neighbor
+        self.nexthop           = nexthop
         self._get_kvalues      = get_kvalues
-        self.reported_distance = reported_distance
+        if reported_distance is not None:
+            self.reported_distance = reported_distance
+
+        # Set by the TopologyEntry holding this while it is in the entry's
+        # neighbor heap.
+        self._rank             = None
 
         # waiting_for_reply should be init'd to False in normal cases.
         # XXX Need to verify the behavior when a neighbor comes up while a
@@ -157,10 +692,65 @@ class TopologyNeighborInfo(object):
 
     @property
     def reported_distance(self):
-        return self._reported_distance
+        nfields = len(self._metric_class.FIELDS)
+        return self._metric_class(*self._metrics[:nfields])
 
     @reported_distance.setter
     def reported_distance(self, val):
-        self._reported_distance = val
-        self.full_distance = copy.deepcopy(self._reported_distance)
-        self.full_distance.update_for_iface(self.neighbor.iface)
+        self.set_reported_fields(type(val), [ getattr(val, field)
+                                              for field in val.FIELDS ])
+
+    def set_reported_fields(self, metric_class, fields):
+        """Set the reported distance from its field values, in the order of
+        metric_class.FIELDS, without building a metric object."""
+        self._metric_class = metric_class
+        self._metrics = array.array("I", fields) * 2
+        self._metric_generation = None
+        self.update_full_distance()
+
+    def reported_fields(self):
+        """Return the fields of the reported distance as an array of
+        integers, in the order of the metric class's FIELDS."""
+        return self._metrics[:len(self._metric_class.FIELDS)]
+
+    @property
+    def full_distance(self):
+        nfields = len(self._metric_class.FIELDS)
+        return self._metric_class(*self._metrics[nfields:])
+
+    def update_full_distance(self):
+        """Recompute the full distance from the reported distance and the
+        neighbor's interface. Call this when the interface's metrics
+        change."""
+        nfields = len(self._metric_class.FIELDS)
+        self._metrics[nfields:] = array.array("I",
+                self._metric_class.fields_for_iface(self._metrics[:nfields],
+                                                    self.neighbor.iface))
+        self._metric_generation = None
+
+    def reachable(self):
+        """Return True if the reported distance is reachable."""
+        return self._metric_class.fields_reachable(self.reported_fields())
+
+    def reported_metric(self):
+        """Return the composite metric of the reported distance for the
+        current K-values, as an integer."""
+        if self._metric_generation != self._metric_class.kvalue_generation:
+            self._compute_metrics()
+        return self._reported_metric
+
+    def full_metric(self):
+        """Return the composite metric of the full distance for the current
+        K-values, as an integer."""
+        if self._metric_generation != self._metric_class.kvalue_generation:
+            self._compute_metrics()
+        return self._full_metric
+
+    def _compute_metrics(self):
+        kvalues = self._get_kvalues()
+        nfields = len(self._metric_class.FIELDS)
+        fields_metric = self._metric_class.fields_metric
+        self._reported_metric = fields_metric(self._metrics[:nfields],
+                                              *kvalues)
+        self._full_metric = fields_metric(self._metrics[nfields:], *kvalues)
+        self._metric_generation = self._metric_class.kvalue_generation
@@ -38,6 +38,9 @@ from twisted.python import log
 from twisted.internet.main import installReactor
 import twisted
 
+import rtnetlink
+import sockmsg
+
 from twisted.python.runtime import platformType
 if platformType == 'win32':
     from errno import WSAEWOULDBLOCK as EWOULDBLOCK
@@ -60,8 +63,8 @@ else:
 reactor_class = type(reactor)
 del sys.modules['twisted.internet.reactor']
 class ExtendedReactor(reactor_class):
-    def listenIP(self, port, protocol, interface='', maxPacketSize=8192, listenMultiple=False):
-        p = IPTransport(port, protocol, interface, maxPacketSize, self, listenMultiple)
+    def listenIP(self, port, protocol, interface='', maxPacketSize=8192, listenMultiple=False, pktinfo=False, batchSize=1):
+        p = IPTransport(port, protocol, interface, maxPacketSize, self, listenMultiple, pktinfo=pktinfo, batchSize=batchSize)
         p.startListening()
         return p
 
@@ -81,7 +84,7 @@ class NetlinkPort(udp.MulticastPort):
     addressFamily = socket.AF_NETLINK
     socketType = socket.SOCK_RAW
 
-    NETLINK_ROUTE = 0
+    NETLINK_ROUTE = rtnetlink.NETLINK_ROUTE
 
     def __init__(self, netlinkType, *args, **kwargs):
         """The netlinkType should be the netlink type, e.g. NETLINK_ROUTE.
@@ -94,9 +97,8 @@ class NetlinkPort(udp.MulticastPort):
         udp.MulticastPort.__init__(self, *args, **kwargs)
 
     def createInternetSocket(self):
-        s = socket.socket(self.addressFamily, self.socketType, self.netlinkType)
+        s = rtnetlink.open_socket(self.netlinkType)
         s.setblocking(0)
-        fdesc._setCloseOnExec(s.fileno())
         if self.listenMultiple:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             if hasattr(socket, "SO_REUSEPORT"):
@@ -119,14 +121,40 @@ class IPTransport(udp.MulticastPort):
     the Twisted framework.
 
     Using IPTransport is pretty much the same as using UDPPort.
+
+    If pktinfo is True and the platform supports it (see sockmsg), packets
+    are read with IP_PKTINFO and the address passed to datagramReceived is
+    (host, port, ifindex), where ifindex is the index of the interface the
+    packet arrived on. Otherwise it's (host, port).
+
+    If batchSize is more than 1 and the platform supports it, up to
+    batchSize packets are read with each recvmmsg call. If the protocol has
+    a datagramsReceived method, it is called with a list of the
+    (data, addr) of the packets read together, instead of calling
+    datagramReceived for each.
     """
     addressFamily = socket.AF_INET
     socketType = socket.SOCK_RAW
 
+    def __init__(self, *args, **kwargs):
+        self.pktinfo = kwargs.pop("pktinfo", False) and sockmsg.available
+        self.batchSize = kwargs.pop("batchSize", 1)
+        if not sockmsg.batch_available:
+            self.batchSize = 1
+        self._receiver = None
+        udp.MulticastPort.__init__(self, *args, **kwargs)
+
     def createInternetSocket(self):
         s = socket.socket(self.addressFamily, self.socketType, self.port)
         s.setblocking(0)
         fdesc._setCloseOnExec(s.fileno())
+        if self.pktinfo:
+            sockmsg.enable_pktinfo(s)
+        if self.batchSize > 1:
+            self._receiver = sockmsg.BatchReceiver(s, self.maxPacketSize,
+                                                   self.batchSize)
+        elif self.pktinfo:
+            self._receiver = sockmsg.PacketReceiver(s, self.maxPacketSize)
         if self.listenMultiple:
             s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             if hasattr(socket, "SO_REUSEPORT"):
@@ -134,44 +162,106 @@ class IPTransport(udp.MulticastPort):
         return s
 
     def doRead(self):
+        if self.batchSize > 1:
+            self._doReadBatch()
+            return
         read = 0
         while read < self.maxThroughput:
             try:
-                data, addr = self.socket.recvfrom(self.maxPacketSize)
+                if self._receiver:
+                    data, addr, ifindex = self._receiver.recv()
+                    addr += (ifindex,)
+                else:
+                    data, addr = self.socket.recvfrom(self.maxPacketSize)
             except socket.error, se:
-                no = se.args[0]
-                if no in (EAGAIN, EINTR, EWOULDBLOCK):
+                if self._readFailed(se):
                     return
-                if (no == ECONNREFUSED) or (platformType == "win32" and no == WSAECONNRESET):
-                    if self._connectedAddr:
-                        self.protocol.connectionRefused()
-                else:
-                    raise
             else:
                 read += len(data)
                 try:
-                    # Strip IP header (including IP options) before passing to
-                    # transport protocol.
-                    # Possibly all of the validation done here is also done
-                    # by the kernel. If that is true for raw sockets on all
-                    # OSes that Twisted supports (Windows, Linux, Mac OS X,
-                    # FreeBSD), then perhaps these checks could be taken out.
-                    # If not, there are other validation checks that can be
-                    # performed here.
-                    if len(data) < 1:
-                        log.err("Received invalid packet with data length less than 1 from host %s." % addr[0])
-                        continue
-                    iphdrlen = (ord(data[0]) & 0x0f) << 2
-                    if iphdrlen < 20:
-                        log.err("Received malformed packet. IP header len too small: %d bytes" % iphdrlen)
-                        continue
-                    if len(data) <= iphdrlen:
-                        log.err("Received malformed or empty packet from host %s." % addr[0])
-                        continue
-                    totallen = struct.unpack(">H", data[2:4])[0]
-                    if len(data) != totallen:
-                        log.err("Received malformed or partial packet from host %s, total length field didn't match received data length." % addr[0])
+                    iphdrlen = self._ipHeaderLength(data, 0, len(data), addr)
+                    if iphdrlen is None:
                         continue
                     self.protocol.datagramReceived(data[iphdrlen:], addr)
                 except:
                     log.err()
+
+    def _doReadBatch(self):
+        """doRead with recvmmsg. The IP headers are checked in the
+        receiver's buffer pool, so only the payloads are copied."""
+        read = 0
+        buf = self._receiver.buffer
+        while read < self.maxThroughput:
+            try:
+                packets = self._receiver.recv()
+            except socket.error, se:
+                if self._readFailed(se):
+                    return
+                continue
+            datagrams = list()
+            for offset, length, addr, ifindex in packets:
+                read += length
+                iphdrlen = self._ipHeaderLength(buf, offset, length, addr)
+                if iphdrlen is None:
+                    continue
+                if self.pktinfo:
+                    addr += (ifindex,)
+                datagrams.append((buf[offset + iphdrlen:offset + length],
+                                  addr))
+            self._deliver(datagrams)
+            if len(packets) < self.batchSize:
+                # The socket was emptied, so don't make another call just to
+                # be told so.
+                return
+
+    def _deliver(self, datagrams):
+        """Pass the packets read together to the protocol."""
+        datagramsReceived = getattr(self.protocol, "datagramsReceived", None)
+        if datagramsReceived:
+            try:
+                datagramsReceived(datagrams)
+            except:
+                log.err()
+            return
+        for data, addr in datagrams:
+            try:
+                self.protocol.datagramReceived(data, addr)
+            except:
+                log.err()
+
+    def _readFailed(self, se):
+        """Handle a socket.error from reading. Returns True if there is
+        nothing more to read for now."""
+        no = se.args[0]
+        if no in (EAGAIN, EINTR, EWOULDBLOCK):
+            return True
+        if (no == ECONNREFUSED) or (platformType == "win32" and no == WSAECONNRESET):
+            if self._connectedAddr:
+                self.protocol.connectionRefused()
+            return False
+        raise se
+
+    def _ipHeaderLength(self, data, offset, length, addr):
+        """Check the IP header of the packet in data[offset:offset + length].
+        Returns the length of the header, including IP options, or None if
+        the packet is malformed."""
+        # Possibly all of the validation done here is also done by the
+        # kernel. If that is true for raw sockets on all OSes that Twisted
+        # supports (Windows, Linux, Mac OS X, FreeBSD), then perhaps these
+        # checks could be taken out. If not, there are other validation
+        # checks that can be performed here.
+        if length < 1:
+            log.err("Received invalid packet with data length less than 1 from host %s." % addr[0])
+            return None
+        iphdrlen = (ord(data[offset]) & 0x0f) << 2
+        if iphdrlen < 20:
+            log.err("Received malformed packet. IP header len too small: %d bytes" % iphdrlen)
+            return None
+        if length <= iphdrlen:
+            log.err("Received malformed or empty packet from host %s." % addr[0])
+            return None
+        totallen = struct.unpack_from(">H", data, offset + 2)[0]
+        if length != totallen:
+            log.err("Received malformed or partial packet from host %s, total length field didn't match received data length." % addr[0])
+            return None
+        return iphdrlen